@@ -0,0 +1,136 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import islice
+
+from index_format import LazyIndex, is_binary_index
+from search import INDEX_DIR, TOP_K, search_results
+from segments import SegmentedIndex, MANIFEST
+
+# Batch queries: runs a file of queries against one loaded index on a pool of
+# threads or processes and streams one JSON result per line, in input order.
+# Threads share the index object; processes are forked after it is loaded, so
+# they share its memory-mapped files and everything decoded so far. Threads only
+# overlap where the GIL is released (file reads), so processes scale better with
+# cores for CPU-bound queries.
+BATCH_WORKERS = os.cpu_count() or 1
+CHUNK_SIZE = 16  # Queries per task sent to a worker process
+
+_index = None  # Index shared with forked worker processes
+
+def _run_query(index, text, mode, k, snippets):
+    start = time.perf_counter()
+    try:
+        result = search_results(text, index, mode, k, snippets)
+    except ValueError as e:
+        result = {'query': text, 'mode': mode, 'error': str(e)}
+    result['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    return result
+
+def _run_chunk(texts, mode, k, snippets, index=None):
+    return [_run_query(_index if index is None else index, text, mode, k, snippets) for text in texts]
+
+def batch_search(queries, index, mode='phrase', k=TOP_K, workers=BATCH_WORKERS, processes=False, snippets=True):
+    # Yields the search_results of each query (with 'elapsed_ms', or 'error' for
+    # an invalid query) in input order. queries may be a stream; at most two tasks
+    # per worker are in flight, so it is not read arbitrarily far ahead.
+    global _index
+    if processes:
+        # Workers must inherit the loaded index rather than reopen it
+        _index = index
+        executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+        chunk_size, task_index = CHUNK_SIZE, None
+    else:
+        executor = ThreadPoolExecutor(workers, thread_name_prefix='batch')
+        chunk_size, task_index = 1, index
+    queries = iter(queries)
+    pending = deque()
+    try:
+        with executor:
+            try:
+                while True:
+                    chunk = list(islice(queries, chunk_size))
+                    if chunk:
+                        pending.append(executor.submit(_run_chunk, chunk, mode, k, snippets, task_index))
+                    if pending and (not chunk or len(pending) >= workers * 2):
+                        yield from pending.popleft().result()
+                    if not chunk and not pending:
+                        break
+            finally:
+                # When the results stop being read, queries not started are dropped
+                for future in pending:
+                    future.cancel()
+    finally:
+        _index = None
+
+def read_queries(lines):
+    # One query per line; blank lines and lines starting with # are skipped
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+def run_batch(lines, output, index, mode='phrase', k=TOP_K, workers=BATCH_WORKERS, processes=False, snippets=True):
+    # Writes a JSON line per query to output as results arrive; returns
+    # {'queries', 'errors', 'seconds', 'qps'}
+    count = errors = 0
+    start = time.perf_counter()
+    for result in batch_search(read_queries(lines), index, mode, k, workers, processes, snippets):
+        output.write(json.dumps(result) + '\n')
+        count += 1
+        errors += 'error' in result
+    seconds = time.perf_counter() - start
+    return {'queries': count, 'errors': errors, 'seconds': round(seconds, 3),
+            'qps': round(count / seconds, 1) if seconds else 0.0}
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a file of queries against the index and write JSON lines.")
+    parser.add_argument('queries', help="file with one query per line, or - for stdin")
+    parser.add_argument('--index', default=INDEX_DIR,
+                        help=f"segmented index directory or binary index file (default: {INDEX_DIR})")
+    parser.add_argument('--mode', default='phrase', choices=('phrase', 'bm25', 'bool'))
+    parser.add_argument('-k', type=int, default=TOP_K, help="results per list")
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS)
+    parser.add_argument('--processes', action='store_true', help="use worker processes instead of threads")
+    parser.add_argument('--no-snippets', dest='snippets', action='store_false')
+    parser.add_argument('--output', help="JSON lines file to write (default: stdout)")
+    args = parser.parse_args()
+
+    # Opened read-only: nothing in the directory is created, imported or removed,
+    # so a build may run into it at the same time
+    try:
+        if os.path.isdir(args.index):
+            if not SegmentedIndex.exists(args.index):
+                parser.error(f"{args.index} has no {MANIFEST}; it is not a segmented index")
+            index = SegmentedIndex(args.index, read_only=True)
+        elif os.path.isfile(args.index) and is_binary_index(args.index):
+            index = LazyIndex(args.index)
+        else:
+            parser.error(f"{args.index} is not a segmented index directory or binary index file")
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        parser.error(f"Could not open {args.index}: {e}")
+    # Vocabulary indexes for wildcard and typo-tolerant lookups, built once
+    # before the workers start
+    index.term_dictionary().fuzzy()
+    print(f"Loaded {args.index} ({len(index.urls)} pages)", file=sys.stderr)
+
+    lines = sys.stdin if args.queries == '-' else open(args.queries)
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        stats = run_batch(lines, output, index, args.mode, args.k, args.workers, args.processes, args.snippets)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+        if output is not sys.stdout:
+            output.close()
+    print(f"{stats['queries']} queries, {stats['errors']} errors in {stats['seconds']:.2f} s: "
+          f"{stats['qps']:.1f} queries/sec ({'processes' if args.processes else 'threads'}, {args.workers} workers)",
+          file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,871 @@
+import time
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import asyncio
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from urllib.parse import urljoin
+from collections import defaultdict
+
+from crawler import crawl_website, CrawlMetadata
+from extractor import extract, clean_text
+from index_format import convert_json_index, write_index, read_index
+from inverted_index import InvertedIndex
+from tokenizer import tokenize, token_spans, term_positions
+from positional import phrase_positions, pair_positions
+from ranking import bm25_top_k, bm25_idf, K1, B
+from query import evaluate_query
+from segments import SegmentedIndex
+from dedupe import DuplicateDetector, filter_duplicates
+from docstore import snippet
+from termdict import TermDictionary
+from fuzzy import FuzzyIndex, edit_distance, max_edits
+from server import serve_in_background
+from loadtest import run_load
+from search import (build_inverted_index, stream_build_index, peak_rss_mb, load_index, save_index, open_index, find_pages,
+                    match_phrase, query_terms, search_results, RESULT_CACHE, CRAWL_WORKERS, TOKENIZER)
+from fixture_site import generate_site, serve_site, duplicate_source
+from spimi import block_bytes
+from shards import ShardPool, build_shards
+from batch import batch_search
+
+def benchmark_crawl(levels=(1, 2, 4, 8, 16), pages=100, latency=0.02):
+    site = generate_site(pages=pages)
+    results = []
+    with serve_site(site, latency=latency) as base_url:
+        for workers in levels:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                crawled = crawl_website(base_url, max_workers=workers)
+            elapsed = time.perf_counter() - start
+            results.append((workers, len(crawled), elapsed))
+            print(f"crawl workers={workers:<3} pages={len(crawled):<5} {elapsed:7.3f}s  {len(crawled) / elapsed:8.1f} pages/sec")
+    return results
+
+def benchmark_recrawl(pages=200, words_per_page=2000):
+    # Full crawl and index, then a recrawl of the unchanged site with ETags (304s)
+    # and with content hashes only. CPU time includes the in-process fixture server.
+    site = generate_site(pages=pages, words_per_page=words_per_page)
+    results = {}
+    for validators in (True, False):
+        with serve_site(site, validators=validators) as base_url:
+            metadata = CrawlMetadata()
+            for name in ('full', 'recrawl'):
+                metadata = CrawlMetadata(metadata.pages if name == 'recrawl' else None)
+                cpu = time.process_time()
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    crawled = crawl_website(base_url, max_workers=8, metadata=metadata)
+                    build_inverted_index(crawled)
+                elapsed = time.perf_counter() - start
+                cpu = time.process_time() - cpu
+                mode = f"{name}{'' if name == 'full' else ' (etag)' if validators else ' (hash)'}"
+                results[mode] = (metadata.counters, cpu)
+                print(f"recrawl {mode:<15} pages={pages} indexed={len(crawled):<4} {metadata.counters['bytes'] / 1e6:7.2f} MB  "
+                      f"cpu {cpu * 1000:7.1f} ms  wall {elapsed * 1000:7.1f} ms")
+    return results
+
+def _soup_extract(html, base_url):
+    # The previous crawler path: a BeautifulSoup tree, get_text, then find_all('a')
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    text = clean_text(soup.get_text(separator=' '))
+    links = [urljoin(base_url, link.get('href')) for link in soup.find_all('a') if link.get('href')]
+    return text, links
+
+def _tag_words(html):
+    head, rest = html.split('<p>', 1)
+    text, tail = rest.split('</p>', 1)
+    words = ''.join(f'<span class="w">{word}</span> ' for word in text.split())
+    return f"{head}<p>{words}</p>{tail}"
+
+def benchmark_html_extraction(pages=200, words_per_page=2000, repeat=3):
+    # Fixture pages as generated (mostly text), and with every word in its own
+    # element as a markup-heavy variant
+    site = generate_site(pages=pages, words_per_page=words_per_page)
+    plain = list(site.values())
+    tagged = [_tag_words(html) for html in plain]
+    for markup, documents in (('plain', plain), ('tagged', tagged)):
+        size = sum(len(html.encode('utf-8')) for html in documents)
+        for name, function in (('bs4', _soup_extract), ('html.parser', extract)):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for html in documents:
+                    function(html, 'http://127.0.0.1')
+            elapsed = (time.perf_counter() - start) / repeat
+            print(f"extract {markup:<6} {name:<12} pages={pages} {pages / elapsed:8.1f} pages/sec  "
+                  f"{size / elapsed / 1e6:6.2f} MB/s")
+
+def benchmark_frontier(pages=200, fanout=20):
+    # A link-dense site: the old list frontier appended every same-host link it saw,
+    # so its queue grew by roughly links_seen entries.
+    site = generate_site(pages=pages, fanout=fanout)
+    with serve_site(site) as base_url:
+        stats = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            crawl_website(base_url, max_workers=8, stats=stats)
+    print(f"frontier links_seen={stats['links_seen']} enqueued={stats['enqueued']} "
+          f"duplicates={stats['duplicates']} peak_size={stats['peak_size']}")
+    return stats
+
+# Fresh interpreters, so a child's ru_maxrss is not inherited from this process
+SPAWN = multiprocessing.get_context('spawn')
+
+def _build_peak_rss(mode, base_url, results):
+    with contextlib.redirect_stdout(io.StringIO()):
+        if mode == 'batch':
+            build_inverted_index(crawl_website(base_url, max_workers=8))
+        else:
+            stream_build_index(base_url)
+    results.put(peak_rss_mb())
+
+def benchmark_build_memory(pages=300, words_per_page=5000):
+    # Each mode runs in a fresh process so ru_maxrss only reflects that build
+    site = generate_site(pages=pages, words_per_page=words_per_page)
+    results = {}
+    with serve_site(site) as base_url:
+        for mode in ('batch', 'stream'):
+            queue = SPAWN.Queue()
+            process = SPAWN.Process(target=_build_peak_rss, args=(mode, base_url, queue))
+            process.start()
+            results[mode] = queue.get()
+            process.join()
+            print(f"build mode={mode:<6} peak RSS {results[mode]:8.1f} MB")
+    return results
+
+def benchmark_index_format(json_path='index.json', repeat=3):
+    with tempfile.TemporaryDirectory() as tmp:
+        if not os.path.exists(json_path):
+            with contextlib.redirect_stdout(io.StringIO()):
+                pages = crawl_website_fixture(pages=200)
+                json_path = os.path.join(tmp, 'index.json')
+                save_index(build_inverted_index(pages), json_path)
+        binary_path = os.path.join(tmp, 'index.bin')
+        convert_json_index(json_path, binary_path)
+
+        results = {}
+        for name, path in (('json', json_path), ('binary', binary_path)):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                load_index(path)
+            elapsed = (time.perf_counter() - start) / repeat
+            results[name] = (os.path.getsize(path), elapsed)
+            print(f"index format={name:<6} size {os.path.getsize(path) / 1024:9.1f} KB  load {elapsed * 1000:8.1f} ms")
+    return results
+
+def crawl_website_fixture(**site_options):
+    with serve_site(generate_site(**site_options)) as base_url:
+        return crawl_website(base_url, max_workers=8)
+
+def synthetic_index(terms=50000, docs=2000, docs_per_term=20, positions_per_doc=4, seed=0):
+    rng = random.Random(seed)
+    urls = [f"http://example.com/doc/{i}" for i in range(docs)]
+    return {
+        f"term{t}": {url: sorted(rng.sample(range(5000), positions_per_doc)) for url in rng.sample(urls, docs_per_term)}
+        for t in range(terms)
+    }
+
+def _startup(loader, path, results):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        index, _, _ = loader(path)
+        loaded = time.perf_counter() - start
+        find_pages('term1 term2', index)
+    results.put((loaded, time.perf_counter() - start, peak_rss_mb()))
+
+def benchmark_lazy_load(terms=50000):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'index.bin')
+        write_index(InvertedIndex.from_dict(synthetic_index(terms=terms)), path)
+        results = {}
+        for name, loader in (('full', load_index), ('mmap', open_index)):
+            queue = SPAWN.Queue()
+            process = SPAWN.Process(target=_startup, args=(loader, path, queue))
+            process.start()
+            results[name] = queue.get()
+            process.join()
+            loaded, first_query, rss = results[name]
+            print(f"load mode={name:<4} terms={terms} load {loaded * 1000:8.1f} ms  "
+                  f"first query after {first_query * 1000:8.1f} ms  peak RSS {rss:8.1f} MB")
+    return results
+
+def _traced_size(build):
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+def benchmark_index_memory(docs=500, words_per_doc=2000, vocabulary=5000, seed=0):
+    rng = random.Random(seed)
+    documents = [(f"http://example.com/doc/{d}", [f"w{rng.randrange(vocabulary)}" for _ in range(words_per_doc)])
+                 for d in range(docs)]
+
+    def build_dicts():
+        index = defaultdict(lambda: defaultdict(list))
+        for url, words in documents:
+            for position, word in enumerate(words):
+                index[word][url].append(position)
+        return index
+
+    def build_arrays():
+        index = InvertedIndex()
+        for url, words in documents:
+            term_positions = defaultdict(list)
+            for position, word in enumerate(words):
+                term_positions[word].append(position)
+            index.add_document(url, term_positions)
+        return index
+
+    positions = docs * words_per_doc
+    results = {}
+    for name, build in (('dicts', build_dicts), ('arrays', build_arrays)):
+        _, size = _traced_size(build)
+        results[name] = size
+        print(f"index memory={name:<6} {size / 1024 / 1024:8.1f} MB  {size / positions:6.1f} bytes/position")
+    print(f"index memory reduction {results['dicts'] / results['arrays']:.1f}x")
+    return results
+
+def benchmark_parallel_build(pages=400, words_per_page=2000):
+    site = generate_site(pages=pages, words_per_page=words_per_page)
+    documents = list(site.items())
+    levels = sorted({1, 2, 4, os.cpu_count() or 1})
+    results = []
+    for workers in levels:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            build_inverted_index(documents, workers=workers)
+        elapsed = time.perf_counter() - start
+        results.append((workers, elapsed))
+        print(f"build workers={workers:<3} pages={pages:<5} {elapsed:7.3f}s  {pages / elapsed:8.1f} pages/sec")
+    return results
+
+def benchmark_tokenizer(pages=200, words_per_page=2000):
+    texts = [html for html in generate_site(pages=pages, words_per_page=words_per_page).values()]
+    results = {}
+    for backend in ('regex', 'nltk'):
+        start = time.perf_counter()
+        try:
+            tokens = sum(len(tokenize(text.lower(), backend)) for text in texts)
+        except (ImportError, LookupError) as e:
+            print(f"tokenizer backend={backend:<5} unavailable ({type(e).__name__})")
+            continue
+        elapsed = time.perf_counter() - start
+        results[backend] = tokens / elapsed
+        print(f"tokenizer backend={backend:<5} {tokens} tokens {elapsed:7.3f}s  {tokens / elapsed:12.0f} tokens/sec")
+    return results
+
+def _legacy_phrase_positions(word_positions):
+    # The pointer walk find_pages used before the positional engine, kept as a baseline
+    word_count = len(word_positions)
+    phrase = []
+    pos_indices = [0] * word_count
+    while True:
+        current_positions = [word_positions[i][pos_indices[i]] for i in range(word_count)]
+        if all((current_positions[0] + i) == current_positions[i] for i in range(word_count)):
+            phrase.append(current_positions[0])
+            for i in range(word_count):
+                pos_indices[i] += 1
+                if pos_indices[i] >= len(word_positions[i]):
+                    pos_indices[i] = float('inf')
+        min_index = current_positions.index(min(current_positions))
+        pos_indices[min_index] += 1
+        if any(pos_indices[i] >= len(word_positions[i]) for i in range(word_count)):
+            break
+    return phrase
+
+def _legacy_pair_positions(first, second):
+    return [pos for pos in first if (pos + 1) in second]
+
+def benchmark_phrase_matching(frequent=20000, rare=50, span=200000, seed=0):
+    rng = random.Random(seed)
+    common_a = sorted(rng.sample(range(span), frequent))
+    common_b = sorted(rng.sample(range(span), frequent))
+    uncommon = sorted(rng.sample(range(span), rare))
+    cases = {
+        'pair frequent+frequent': (_legacy_pair_positions, pair_positions, (common_a, common_b)),
+        'phrase frequent+frequent': (_legacy_phrase_positions, phrase_positions, ([common_a, common_b],)),
+        'phrase rare+frequent+frequent': (_legacy_phrase_positions, phrase_positions, ([uncommon, common_a, common_b],)),
+    }
+    results = {}
+    for name, (legacy, engine, args) in cases.items():
+        timings = []
+        for function in (legacy, engine):
+            start = time.perf_counter()
+            function(*args)
+            timings.append(time.perf_counter() - start)
+        results[name] = timings
+        print(f"{name:<30} legacy {timings[0] * 1000:9.2f} ms  engine {timings[1] * 1000:8.2f} ms  "
+              f"{timings[0] / timings[1]:8.1f}x")
+    return results
+
+def synthetic_corpus(docs, words_per_doc=80, vocabulary=20000, seed=0):
+    # Zipf-like term distribution: a few very common words and a long tail
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(vocabulary)]
+    index = InvertedIndex()
+    for d in range(docs):
+        words = rng.choices(range(vocabulary), weights, k=words_per_doc)
+        positions = defaultdict(list)
+        for position, word in enumerate(words):
+            positions[f"w{word}"].append(position)
+        index.add_document(f"http://example.com/doc/{d}", positions)
+    return index
+
+def _exhaustive_bm25(terms, index, k):
+    avg_length = index.average_doc_length()
+    scores = defaultdict(float)
+    for term in terms:
+        idf = bm25_idf(len(index.urls), index.document_frequency(term))
+        for url, positions in index.postings(term):
+            tf = len(positions)
+            norm = K1 * (1 - B + B * index.doc_lengths[index.doc_ids[url]] / avg_length)
+            scores[url] += idf * tf * (K1 + 1) / (tf + norm)
+    return sorted(scores.items(), key=lambda item: -item[1])[:k]
+
+def benchmark_ranking(sizes=(2000, 8000, 32000), k=10, repeat=20):
+    queries = [['w0', 'w1', 'w500'], ['w2', 'w5', 'w3000'], ['w0', 'w10', 'w100', 'w1000']]
+    results = {}
+    for docs in sizes:
+        index = synthetic_corpus(docs)
+        timings = []
+        for function in (_exhaustive_bm25, bm25_top_k):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for query in queries:
+                    function(query, index, k)
+            timings.append((time.perf_counter() - start) / (repeat * len(queries)))
+        results[docs] = timings
+        print(f"bm25 docs={docs:<6} exhaustive {timings[0] * 1000:8.2f} ms/query  "
+              f"top-{k} maxscore {timings[1] * 1000:8.2f} ms/query")
+    return results
+
+def _set_conjunction(terms, index):
+    # Baseline: intersect full doc ID sets in query order, no planning or galloping
+    docs = None
+    for term in terms:
+        postings = index.term_postings(term)
+        term_docs = set(postings.docs) if postings is not None else set()
+        docs = term_docs if docs is None else docs & term_docs
+    return sorted(docs)
+
+def benchmark_query_latency(docs=32000, repeat=20):
+    index = synthetic_corpus(docs)
+    conjunctions = [['w0', 'w1', 'w2000'], ['w1', 'w3', 'w5', 'w800']]
+    for terms in conjunctions:
+        expression = ' and '.join(terms)
+        assert evaluate_query(expression, index) == _set_conjunction(terms, index)
+        timings = []
+        for function in (lambda: _set_conjunction(terms, index), lambda: evaluate_query(expression, index)):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                function()
+            timings.append((time.perf_counter() - start) / repeat)
+        print(f"query {expression!r:<28} set intersection {timings[0] * 1000:7.2f} ms  "
+              f"planned galloping {timings[1] * 1000:7.2f} ms")
+    for expression in ['w0 or w1 or w2', 'w0 and not w1', '"w0 w1" and w2', 'w0 near/3 w50']:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            matches = evaluate_query(expression, index)
+        print(f"query {expression!r:<28} {(time.perf_counter() - start) / repeat * 1000:7.2f} ms ({len(matches)} docs)")
+
+def benchmark_incremental_build(docs=20000, changed=(50, 500)):
+    # Cost of adding a build's changed pages: the old flow merged them into the full
+    # index and rewrote the whole file, a segmented index writes one small segment
+    base = synthetic_corpus(docs)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'index.bin')
+        write_index(base, path)
+        segments = SegmentedIndex(os.path.join(tmp, 'segments'))
+        segments.add_documents(base, background=False)
+        for count in changed:
+            update = synthetic_corpus(count, seed=count)
+            start = time.perf_counter()
+            write_index(read_index(path).merge(update), path)
+            rewrite = time.perf_counter() - start
+            start = time.perf_counter()
+            segments.add_documents(update)
+            segment = time.perf_counter() - start
+            segments.wait()
+            print(f"incremental build docs={docs} changed={count:<4} full rewrite {rewrite * 1000:8.1f} ms  "
+                  f"new segment {segment * 1000:8.1f} ms")
+
+def benchmark_duplicates(pages=300, words_per_page=1000, duplicates=100, thresholds=(0.95, 0.9, 0.85)):
+    # Build time and index size with every page indexed, and with near-duplicates
+    # left out at several similarity thresholds
+    site = generate_site(pages=pages, words_per_page=words_per_page, duplicates=duplicates)
+    paths = list(site)
+    originals = pages - duplicates
+    expected = {paths[i]: paths[duplicate_source(i, originals)] for i in range(originals, pages)}
+    texts = [(path, extract(html, 'http://127.0.0.1' + path)[0]) for path, html in site.items()]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'index.bin')
+        for similarity in (None,) + tuple(thresholds):
+            found = {}
+            start = time.perf_counter()
+            pipeline = texts if similarity is None else filter_duplicates(texts, DuplicateDetector(similarity), found)
+            with contextlib.redirect_stdout(io.StringIO()):
+                index = build_inverted_index(pipeline)
+            elapsed = time.perf_counter() - start
+            write_index(index, path)
+            correct = sum(expected.get(url) == canonical for url, canonical in found.items())
+            label = 'all pages' if similarity is None else f"similarity>={similarity}"
+            print(f"dedupe {label:<16} indexed={len(index.urls):<4} build {elapsed * 1000:7.1f} ms  "
+                  f"index {os.path.getsize(path) / 1e6:6.2f} MB  duplicates {correct}/{len(expected)} found, "
+                  f"{len(found) - correct} wrong")
+
+def benchmark_snippets(pages=400, words_per_page=2000, queries=('love', 'life truth', 'world'), k=10):
+    # Build overhead and size of the document store, and the latency of one result
+    # snippet read from the store against re-tokenizing the raw page text
+    site = generate_site(pages=pages, words_per_page=words_per_page)
+    texts = [(path, extract(html, 'http://127.0.0.1' + path)[0]) for path, html in site.items()]
+    raw = dict(texts)
+    with tempfile.TemporaryDirectory() as tmp:
+        segments = SegmentedIndex(os.path.join(tmp, 'segments'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            build_inverted_index(texts)
+            plain = time.perf_counter() - start
+            documents = segments.document_writer()
+            start = time.perf_counter()
+            index = build_inverted_index(texts, documents=documents)
+            stored = time.perf_counter() - start
+        segments.add_documents(index, background=False, documents=documents)
+        store_size = os.path.getsize(os.path.join(tmp, 'segments', segments.segment_names()[0][:-4] + '.docs'))
+        raw_size = sum(len(text.encode('utf-8')) for text in raw.values())
+        print(f"snippets build {plain * 1000:7.1f} ms -> {stored * 1000:7.1f} ms with the store, "
+              f"store {store_size / 1e6:5.2f} MB for {raw_size / 1e6:5.2f} MB of text")
+
+        for query in queries:
+            terms = tokenize(query)
+            results = [url for url, _ in bm25_top_k(terms, segments, k)]
+            timings = {}
+            for label, load in (('store', segments.document),
+                                ('re-tokenize', lambda url: (raw[url], [(s, e) for _, s, e in token_spans(raw[url])]))):
+                start = time.perf_counter()
+                for url in results:
+                    text, spans = load(url)
+                    matches = [(position, 1) for position, (s, e) in enumerate(spans) if text[s:e].lower() in terms]
+                    snippet(text, spans, matches)
+                timings[label] = (time.perf_counter() - start) / max(len(results), 1)
+            print(f"snippets '{query}' {len(results)} results: " + "  ".join(
+                f"{label} {seconds * 1000:6.3f} ms/result" for label, seconds in timings.items()))
+
+def benchmark_wildcards(terms=500000, patterns=('qu*', 'zyx*', '*ing', '*qzv', 'st*ed'), repeat=20, seed=0):
+    # Wildcard expansion through the sorted term dictionary against scanning every
+    # term of a large vocabulary
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    vocabulary = {''.join(rng.choice(letters) for _ in range(rng.randint(3, 12))) for _ in range(terms)}
+    start = time.perf_counter()
+    dictionary = TermDictionary(sorted(vocabulary))
+    dictionary.expand('*a', 1)
+    print(f"wildcards {len(vocabulary)} terms: dictionary built in {(time.perf_counter() - start) * 1000:.0f} ms "
+          f"(sorted and reversed)")
+    for pattern in patterns:
+        regex = re.compile(pattern.replace('*', '.*'))
+        timings = {}
+        for label, expand in (('dictionary', lambda: dictionary.expand(pattern)),
+                              ('scan', lambda: sorted(term for term in vocabulary if regex.fullmatch(term))[:64])):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                matches = expand()
+            timings[label] = (time.perf_counter() - start) / repeat
+        print(f"wildcards {pattern:<6} {len(matches):>3} terms: " + "  ".join(
+            f"{label} {seconds * 1000:8.3f} ms" for label, seconds in timings.items()))
+
+def _typo(word, rng, letters='abcdefghijklmnopqrstuvwxyz'):
+    # word with one random substitution, deletion, insertion or adjacent swap
+    i = rng.randrange(len(word))
+    edit = rng.randrange(4)
+    if edit == 0:
+        return word[:i] + rng.choice(letters) + word[i + 1:]
+    if edit == 1 and len(word) > 1:
+        return word[:i] + word[i + 1:]
+    if edit == 3 and i + 1 < len(word):
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    return word[:i] + rng.choice(letters) + word[i:]
+
+def benchmark_fuzzy(sizes=(10000, 40000, 160000), queries=50, checked=10, seed=0):
+    # Typo lookups walking the sorted terms as a trie against computing the edit
+    # distance to every term (for the first `checked` words). Words are built from
+    # syllables, so unlike random strings they share many prefixes, as real words do.
+    rng = random.Random(seed)
+    syllables = [c + v for c in 'bcdfghklmnprstvwz' for v in 'aeiou'] + ['ing', 'er', 'tion', 'st', 'ed']
+    for size in sizes:
+        vocabulary = set()
+        while len(vocabulary) < size:
+            vocabulary.add(''.join(rng.choice(syllables) for _ in range(rng.randint(1, 5))))
+        vocabulary = sorted(vocabulary)
+        fuzzy = FuzzyIndex(vocabulary)
+        words = [_typo(rng.choice(vocabulary), rng) for _ in range(queries)]
+        found, visited = [], 0
+        start = time.perf_counter()
+        for word in words:
+            stats = {}
+            found.append(fuzzy.search(word, stats=stats))
+            visited += stats['prefixes']
+        indexed = (time.perf_counter() - start) / queries
+        start = time.perf_counter()
+        expected = [sorted((d, term) for term in vocabulary
+                           for d in [edit_distance(word, term, max_edits(word))] if d <= max_edits(word))
+                    for word in words[:checked]]
+        brute = (time.perf_counter() - start) / checked
+        assert found[:checked] == expected
+        print(f"fuzzy {size:>6} terms: lookup {indexed * 1000:7.2f} ms ({visited / queries:7.0f} prefixes)  "
+              f"brute force {brute * 1000:8.2f} ms  ({sum(map(len, found)) / queries:.1f} matches per word)")
+
+def benchmark_server(pages=400, words_per_page=1000, requests=500, levels=(1, 8, 32)):
+    # Queries/s and latency of the search server at several client concurrencies,
+    # then the same load while a new segment is built and swapped in
+    site = generate_site(pages=pages, words_per_page=words_per_page)
+    texts = [('http://127.0.0.1' + path, extract(html, 'http://127.0.0.1' + path)[0]) for path, html in site.items()]
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, 'segments')
+        segments = SegmentedIndex(directory)
+
+        def add(pages):
+            documents = segments.document_writer()
+            with contextlib.redirect_stdout(io.StringIO()):
+                index = build_inverted_index(pages, documents=documents)
+            segments.add_documents(index, background=False, documents=documents)
+
+        add(texts[:pages // 2])
+        with contextlib.redirect_stdout(io.StringIO()), serve_in_background(directory, reload_interval=0.1) as base_url:
+            results = [(mode, concurrency, asyncio.run(run_load(base_url, requests=requests,
+                                                                concurrency=concurrency, mode=mode)))
+                       for mode in ('phrase', 'bm25') for concurrency in levels]
+
+            async def load_during_build():
+                load = asyncio.ensure_future(run_load(base_url, requests=requests, concurrency=levels[-1]))
+                await asyncio.get_running_loop().run_in_executor(None, add, texts[pages // 2:])
+                return await load
+            swap = asyncio.run(load_during_build())
+        for mode, concurrency, result in results:
+            print(f"server {mode:<6} concurrency {concurrency:>2}: {result['qps']:7.1f} queries/s  "
+                  f"p50 {result['p50_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms  errors {result['errors']}")
+        print(f"server during a build and swap: {swap['qps']:7.1f} queries/s  p50 {swap['p50_ms']:7.2f} ms  "
+              f"p99 {swap['p99_ms']:7.2f} ms  errors {swap['errors']}")
+
+def benchmark_spimi(docs=1000, words_per_doc=500, vocabulary=20000, fractions=(4, 16), seed=0):
+    # Peak traced memory and time of an in-memory build against out-of-core builds
+    # whose budget is a fraction of the in-memory index. Pages are generated
+    # lazily so only the index is held; times come from a separate untraced build.
+    def pages():
+        rng = random.Random(seed)
+        for d in range(docs):
+            yield f"http://example.com/doc/{d}", ' '.join(f"w{rng.randrange(vocabulary)}" for _ in range(words_per_doc))
+
+    def build(**options):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            index = build_inverted_index(pages(), **options)
+        return index, time.perf_counter() - start
+
+    def measure(**options):
+        _, elapsed = build(**options)
+        tracemalloc.start()
+        index, _ = build(**options)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return index, elapsed, peak
+
+    index, elapsed, peak = measure()
+    size = block_bytes(index)
+    del index
+    results = [('in-memory', None, elapsed, peak)]
+    with tempfile.TemporaryDirectory() as tmp:
+        for fraction in fractions:
+            budget = size // fraction
+            _, elapsed, peak = measure(memory_budget=budget, file_path=os.path.join(tmp, 'index.bin'))
+            results.append((f"spimi 1/{fraction}", budget, elapsed, peak))
+    for name, budget, elapsed, peak in results:
+        budget_text = f"budget {budget / 1024 / 1024:6.1f} MB" if budget else ' ' * 16
+        print(f"build {name:<10} {budget_text}  peak {peak / 1024 / 1024:7.1f} MB  {elapsed:7.3f}s  "
+              f"{docs / elapsed:8.1f} docs/sec")
+    return results
+
+def benchmark_shards(pages=2000, words_per_page=500, vocabulary=20000, levels=(1, 2, 4), queries=50, k=10, seed=0):
+    # Build time and query latency of a sharded index at several shard counts,
+    # against a single segmented index queried in this process
+    rng = random.Random(seed)
+    words = [f"w{i}" for i in range(vocabulary)]
+    documents = [(f"http://example.com/doc/{d}", ' '.join(rng.choice(words) for _ in range(words_per_page)))
+                 for d in range(pages)]
+    phrases = [' '.join(rng.choice(documents)[1].split()[:2]) for _ in range(queries)]
+    print(f"shards: {os.cpu_count()} cores")
+
+    def latency(run):
+        start = time.perf_counter()
+        for phrase in phrases:
+            run(phrase)
+        return (time.perf_counter() - start) / len(phrases) * 1000
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        segments = SegmentedIndex(os.path.join(tmp, 'segments'))
+        writer = segments.document_writer()
+        segments.add_documents(build_inverted_index(documents, documents=writer), background=False, documents=writer)
+        elapsed = time.perf_counter() - start
+        phrase_ms = latency(lambda phrase: match_phrase(phrase, segments))
+        bm25_ms = latency(lambda phrase: bm25_top_k(query_terms(phrase, segments), segments, k))
+        results.append(('unsharded', elapsed, phrase_ms, bm25_ms))
+        for shards in levels:
+            directory = os.path.join(tmp, f"shards-{shards}")
+            start = time.perf_counter()
+            build_shards(documents, directory, shards)
+            elapsed = time.perf_counter() - start
+            with ShardPool(directory) as pool:
+                phrase_ms = latency(lambda phrase: pool.match_phrase(phrase, k))
+                bm25_ms = latency(lambda phrase: pool.rank(phrase, k))
+            results.append((f"{shards} shards", elapsed, phrase_ms, bm25_ms))
+    for name, elapsed, phrase_ms, bm25_ms in results:
+        print(f"shards {name:<10} build {elapsed:7.3f}s  {pages / elapsed:8.1f} pages/sec  "
+              f"find {phrase_ms:7.2f} ms  bm25 {bm25_ms:7.2f} ms")
+    return results
+
+def benchmark_query_cache(pages=400, words_per_page=1000, distinct=200, requests=2000, skew=1.1, seed=0):
+    # find latency for a repeated-query workload, the query frequencies following a
+    # Zipf distribution as in search logs, without and with the result cache
+    site = generate_site(pages=pages, words_per_page=words_per_page)
+    texts = [(path, extract(html, 'http://127.0.0.1' + path)[0]) for path, html in site.items()]
+    rng = random.Random(seed)
+    phrases = [' '.join(rng.choice(texts)[1].split()[:rng.randint(1, 3)]) for _ in range(distinct)]
+    workload = rng.choices(phrases, weights=[1 / rank ** skew for rank in range(1, distinct + 1)], k=requests)
+    capacity = RESULT_CACHE.capacity
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        segments = SegmentedIndex(os.path.join(tmp, 'segments'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            segments.add_documents(build_inverted_index(texts), background=False)
+        try:
+            for label, size in (('uncached', 0), ('cached', capacity)):
+                RESULT_CACHE.capacity = size
+                RESULT_CACHE.clear()
+                hits, misses = RESULT_CACHE.hits, RESULT_CACHE.misses
+                start = time.perf_counter()
+                for phrase in workload:
+                    match_phrase(phrase, segments, report=lambda note: None)
+                elapsed = time.perf_counter() - start
+                hit_rate = (RESULT_CACHE.hits - hits) / max(RESULT_CACHE.hits - hits + RESULT_CACHE.misses - misses, 1)
+                results[label] = elapsed / requests
+                print(f"query cache {label:<8} {elapsed / requests * 1000:7.3f} ms/query  "
+                      f"{requests / elapsed:9.1f} queries/sec  hit rate {hit_rate:5.1%}  "
+                      f"({len(RESULT_CACHE)} results, {RESULT_CACHE.cost} pages)")
+        finally:
+            RESULT_CACHE.capacity = capacity
+            RESULT_CACHE.clear()
+    print(f"query cache speedup {results['uncached'] / results['cached']:.1f}x")
+    return results
+
+def benchmark_batch(pages=400, words_per_page=1000, queries=300, modes=('phrase', 'bm25'), seed=0):
+    # Batch throughput in queries/sec on thread and process pools of several sizes.
+    # Queries are distinct and the result cache is cleared, so every query is run.
+    site = generate_site(pages=pages, words_per_page=words_per_page)
+    texts = [(path, extract(html, 'http://127.0.0.1' + path)[0]) for path, html in site.items()]
+    rng = random.Random(seed)
+    phrases = list(dict.fromkeys(' '.join(rng.choice(texts)[1].split()[i:i + 2])
+                                 for i in (rng.randrange(words_per_page - 2) for _ in range(queries * 2))))[:queries]
+    levels = sorted({1, 2, 4, os.cpu_count() or 1})
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        segments = SegmentedIndex(os.path.join(tmp, 'segments'))
+        documents = segments.document_writer()
+        with contextlib.redirect_stdout(io.StringIO()):
+            index = build_inverted_index(texts, documents=documents)
+        segments.add_documents(index, background=False, documents=documents)
+        segments.term_dictionary().fuzzy()
+        for mode in modes:
+            for processes in (False, True):
+                for workers in levels:
+                    RESULT_CACHE.clear()
+                    start = time.perf_counter()
+                    for _ in batch_search(phrases, segments, mode, workers=workers, processes=processes):
+                        pass
+                    elapsed = time.perf_counter() - start
+                    pool = 'processes' if processes else 'threads'
+                    results.append((mode, pool, workers, len(phrases) / elapsed))
+                    print(f"batch {mode:<6} {pool:<9} workers={workers:<3} {len(phrases) / elapsed:8.1f} queries/sec")
+    RESULT_CACHE.clear()
+    return results
+
+# Regression suite: every stage of search.py, from crawling a generated site served
+# on localhost to several query shapes, timed at a fixed size and written as JSON,
+# so a run can be compared with an earlier one (e.g. before a change) by --compare.
+# A stage's timing is the median of its runs; queries run on the memory-mapped
+# binary index, which has no result cache, so every run is a full query.
+# Runs are written here, one timestamped file each, unless --output is given
+SUITE_RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results')
+SUITE_TOLERANCE = 0.25  # Slowdown of a median, as a fraction, reported as a regression
+SUITE_NOISE = 50e-6  # Seconds; smaller slowdowns are jitter and not reported
+SUITE_QUERIES = {
+    'word': ('phrase', 'love'),
+    'phrase': ('phrase', 'the world'),
+    'long_phrase': ('phrase', 'love is the light of the world'),
+    'wildcard': ('phrase', 'lov* w*'),
+    'typo': ('phrase', 'wisdon'),
+    'bm25': ('bm25', 'truth courage hope'),
+    'bool': ('bool', 'love and (life or "the world") not fear'),
+}
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_suite(pages=300, fanout=5, words_per_page=500, vocabulary=5000, repeat=5, query_repeat=50, seed=0):
+    # Returns {'created', 'environment', 'site', 'timings', 'counts'}: timings maps
+    # each stage to {'median', 'min', 'runs'} in seconds (query.<shape> stages time
+    # one query), counts holds the sizes behind them, e.g. the results of each query.
+    site_options = dict(pages=pages, fanout=fanout, words_per_page=words_per_page, vocabulary=vocabulary, seed=seed)
+    site = generate_site(**site_options)
+    timings, counts = {}, {}
+
+    def measure(stage, function, runs=repeat):
+        durations = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            result = function()
+            durations.append(time.perf_counter() - start)
+        timings[stage] = {'median': statistics.median(durations), 'min': min(durations), 'runs': runs}
+        return result
+
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        with serve_site(site) as base_url:
+            pages_crawled = measure('crawl', lambda: crawl_website(base_url, max_workers=CRAWL_WORKERS))
+        measure('tokenize', lambda: [list(term_positions(content, TOKENIZER)) for _, content in pages_crawled])
+        index = measure('build', lambda: build_inverted_index(pages_crawled))
+        counts.update(pages=len(pages_crawled), terms=len(index),
+                      site_bytes=sum(len(html.encode('utf-8')) for html in site.values()))
+        for name in ('binary', 'json'):
+            path = os.path.join(tmp, 'index.bin' if name == 'binary' else 'index.json')
+            measure(f'save.{name}', lambda: save_index(index, path))
+            measure(f'load.{name}', lambda: load_index(path))
+            counts[f'{name}_bytes'] = os.path.getsize(path)
+        path = os.path.join(tmp, 'index.bin')
+        queried = measure('load.mmap', lambda: open_index(path)[0])
+        measure('vocabulary', lambda: TermDictionary(list(queried.terms)).fuzzy())
+        queried.term_dictionary().fuzzy()
+        for shape, (mode, text) in SUITE_QUERIES.items():
+            result = measure(f'query.{shape}', lambda: search_results(text, queried, mode, snippets=False),
+                             query_repeat)
+            counts[f'query.{shape}'] = result.get('totals', {'results': len(result.get('results', []))})
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count(), 'commit': _git_commit()},
+        'site': site_options,
+        'timings': timings,
+        'counts': counts,
+    }
+
+def compare_results(previous, current, tolerance=SUITE_TOLERANCE, noise=SUITE_NOISE):
+    # Stages whose median got slower by more than tolerance (and noise seconds), as
+    # (stage, previous median, current median). Raises ValueError when the runs
+    # used different fixture sites, whose timings cannot be compared.
+    if previous['site'] != current['site']:
+        raise ValueError(f"The runs used different sites: {previous['site']} and {current['site']}")
+    regressions = []
+    for stage, timing in current['timings'].items():
+        before = previous['timings'].get(stage)
+        if before is None:
+            continue
+        if timing['median'] > before['median'] * (1 + tolerance) and timing['median'] - before['median'] > noise:
+            regressions.append((stage, before['median'], timing['median']))
+    return regressions
+
+def print_suite(results, previous=None):
+    site = results['site']
+    print(f"suite pages={site['pages']} fanout={site['fanout']} words_per_page={site['words_per_page']} "
+          f"vocabulary={site['vocabulary']} ({results['counts']['pages']} crawled, {results['counts']['terms']} terms)")
+    for stage, timing in results['timings'].items():
+        line = f"suite {stage:<18} median {timing['median'] * 1000:10.3f} ms  min {timing['min'] * 1000:10.3f} ms"
+        before = previous and previous['timings'].get(stage)
+        if before:
+            line += f"  previous {before['median'] * 1000:10.3f} ms  {timing['median'] / before['median']:6.2f}x"
+        print(line)
+
+def run_benchmarks():
+    benchmark_crawl()
+    benchmark_recrawl()
+    benchmark_html_extraction()
+    benchmark_frontier()
+    benchmark_build_memory()
+    benchmark_tokenizer()
+    benchmark_parallel_build()
+    benchmark_index_format()
+    benchmark_index_memory()
+    benchmark_lazy_load()
+    benchmark_phrase_matching()
+    benchmark_ranking()
+    benchmark_query_latency()
+    benchmark_incremental_build()
+    benchmark_duplicates()
+    benchmark_snippets()
+    benchmark_wildcards()
+    benchmark_fuzzy()
+    benchmark_server()
+    benchmark_spimi()
+    benchmark_shards()
+    benchmark_query_cache()
+    benchmark_batch()
+
+def main():
+    parser = argparse.ArgumentParser(description="Search tool benchmarks. Without a command, every benchmark is run.")
+    commands = parser.add_subparsers(dest='command')
+    suite = commands.add_parser('suite', help="time each stage on a local fixture site and write the results as JSON")
+    suite.add_argument('--pages', type=int, default=300)
+    suite.add_argument('--fanout', type=int, default=5, help="links from each page to other pages")
+    suite.add_argument('--words', type=int, default=500, help="words of text per page")
+    suite.add_argument('--vocabulary', type=int, default=5000, help="distinct words of the generated text")
+    suite.add_argument('--repeat', type=int, default=5, help="runs of each build stage")
+    suite.add_argument('--query-repeat', type=int, default=50, help="runs of each query")
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--output', help=f"results file to write (default: a new file in {SUITE_RESULTS_DIR})")
+    suite.add_argument('--compare', metavar='PREVIOUS', help="results file of an earlier run to check for regressions")
+    suite.add_argument('--tolerance', type=float, default=SUITE_TOLERANCE,
+                       help=f"slowdown reported as a regression (default: {SUITE_TOLERANCE})")
+    args = parser.parse_args()
+
+    if args.command is None:
+        run_benchmarks()
+        return
+    # Read first, so --compare may name the file being replaced
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    results = run_suite(args.pages, args.fanout, args.words, args.vocabulary, args.repeat, args.query_repeat, args.seed)
+    if args.output is None:
+        os.makedirs(SUITE_RESULTS_DIR, exist_ok=True)
+        args.output = os.path.join(SUITE_RESULTS_DIR, f"suite-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print_suite(results, previous)
+    print(f"Results written to {args.output}")
+    if previous is not None:
+        try:
+            regressions = compare_results(previous, results, args.tolerance)
+        except ValueError as e:
+            sys.exit(str(e))
+        for stage, before, after in regressions:
+            print(f"Regression: {stage} {before * 1000:.3f} ms -> {after * 1000:.3f} ms ({after / before:.2f}x)")
+        if regressions:
+            sys.exit(1)
+        print(f"No stage slower than {args.tolerance:.0%} over {args.compare}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import concurrent.futures
+from collections import deque
+from functools import lru_cache
+from urllib.parse import urlparse, urldefrag
+
+import requests
+
+from extractor import extract
+
+GONE_STATUSES = (404, 410)  # Responses that mean a page was removed
+
+@lru_cache(maxsize=65536)
+def normalize_url(url):
+    url = urldefrag(url)[0]
+    parsed_url = urlparse(url)
+    normalized_url = f"{parsed_url.scheme}://{parsed_url.netloc}{parsed_url.path}"
+    if normalized_url.endswith('/'):
+        normalized_url = normalized_url[:-1]
+    return normalized_url
+
+@lru_cache(maxsize=65536)
+def url_host(url):
+    return urlparse(url).netloc
+
+class Frontier:
+    # FIFO crawl frontier that deduplicates on the normalized URL when a link is
+    # enqueued, so every page is queued at most once however often it is linked.
+    def __init__(self, host, seen=None, max_depth=None, max_pages=None):
+        self.host = host
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.seen = set(seen or ())
+        self.queue = deque()
+        self.popped = 0
+        self.links_seen = 0
+        self.enqueued = 0
+        self.peak_size = 0
+
+    def push(self, url, depth=0):
+        self.links_seen += 1
+        if self.max_depth is not None and depth > self.max_depth:
+            return False
+        if url_host(url) != self.host:
+            return False
+        normalized_url = normalize_url(url)
+        if normalized_url in self.seen:
+            return False
+        self.seen.add(normalized_url)
+        self.queue.append((url, normalized_url, depth))
+        self.enqueued += 1
+        self.peak_size = max(self.peak_size, len(self.queue))
+        return True
+
+    def pop(self):
+        self.popped += 1
+        return self.queue.popleft()
+
+    def mark_done(self, normalized_urls):
+        # Drops already crawled URLs from the queue and counts them as popped
+        self.queue = deque(item for item in self.queue if item[1] not in normalized_urls)
+        self.popped += len(normalized_urls)
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __bool__(self):
+        if self.max_pages is not None and self.popped >= self.max_pages:
+            return False
+        return bool(self.queue)
+
+    def stats(self):
+        return {
+            'links_seen': self.links_seen,
+            'enqueued': self.enqueued,
+            'duplicates': self.links_seen - self.enqueued,
+            'peak_size': self.peak_size,
+            'popped': self.popped,
+        }
+
+class HostLimiter:
+    # Caps the number of in-flight requests per host and spaces request starts
+    # to the same host at least min_interval seconds apart.
+    def __init__(self, max_per_host=1, min_interval=0):
+        self.max_per_host = max_per_host
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._next_start = {}
+
+    def acquire(self, host):
+        with self._lock:
+            slots = self._slots.setdefault(host, threading.BoundedSemaphore(self.max_per_host))
+        slots.acquire()
+        if self.min_interval > 0:
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_start.get(host, now))
+                self._next_start[host] = start + self.min_interval
+            if start > now:
+                time.sleep(start - now)
+
+    def release(self, host):
+        self._slots[host].release()
+
+class CrawlMetadata:
+    # Per-URL state from earlier crawls: the ETag and Last-Modified validators, a
+    # hash of the body, the page's links and when it was last fetched. A recrawl
+    # sends conditional requests from it and skips parsing pages that did not
+    # change, reusing their stored links to keep crawling. Counters record how
+    # each fetch went and how many body bytes were downloaded.
+    COUNTERS = ('fetched', 'not_modified', 'unchanged', 'changed', 'bytes')
+
+    def __init__(self, pages=None):
+        self.pages = dict(pages or {})
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, file_path):
+        if not os.path.exists(file_path):
+            return cls()
+        try:
+            with open(file_path) as f:
+                return cls(json.load(f))
+        except (json.JSONDecodeError, ValueError):
+            return cls()
+
+    def save(self, file_path):
+        temp_path = file_path + '.tmp'
+        with self._lock, open(temp_path, 'w') as f:
+            json.dump(self.pages, f)
+        os.replace(temp_path, file_path)
+
+    def get(self, url):
+        with self._lock:
+            return self.pages.get(url)
+
+    def retain(self, urls):
+        # Forgets pages that are not in urls (e.g. no longer indexed), so they are
+        # fetched and indexed again rather than skipped as unchanged
+        urls = set(urls)
+        with self._lock:
+            self.pages = {url: page for url, page in self.pages.items() if url in urls}
+
+    def record(self, url, outcome, size, **fields):
+        with self._lock:
+            self.counters['fetched'] += 1
+            self.counters[outcome] += 1
+            self.counters['bytes'] += size
+            page = self.pages.setdefault(url, {})
+            page.update(fields, crawled=time.time())
+
+    def summary(self):
+        counters = self.counters
+        return (f"Recrawl: {counters['fetched']} fetched, {counters['not_modified']} not modified, "
+                f"{counters['unchanged']} unchanged, {counters['changed']} new or changed, "
+                f"{counters['bytes']} body bytes")
+
+class CrawlJournal:
+    # Append-only record of a crawl in progress, one JSON line per finished page:
+    # its URL, depth, links, text (None when it was not to be re-indexed) and
+    # metadata entry. Lines are forced to disk every checkpoint_every pages.
+    # Replaying the journal restores the crawled set and the frontier, and gives
+    # back the pages that were fetched but never made it into a saved index.
+    def __init__(self, file_path, checkpoint_every=50):
+        self.file_path = file_path
+        self.checkpoint_every = checkpoint_every
+        self._file = None
+        self._unsynced = 0
+
+    def exists(self):
+        return os.path.exists(self.file_path)
+
+    def _read(self):
+        start_url, records = None, []
+        with open(self.file_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # Torn last line from a crash mid-write
+                if start_url is None:
+                    start_url = record.get('start_url')
+                else:
+                    records.append(record)
+        return start_url, records
+
+    def open(self, start_url):
+        # Returns the records of an earlier crawl of start_url and appends after
+        # them; a missing journal or one for another site starts empty
+        records = []
+        if self.exists():
+            journal_start, records = self._read()
+            if journal_start != start_url:
+                records = []
+        # Rewritten so a torn last line does not precede new records
+        temp_path = self.file_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            for record in [{'start_url': start_url}] + records:
+                f.write(json.dumps(record) + '\n')
+        os.replace(temp_path, self.file_path)
+        self._file = open(self.file_path, 'a')
+        return records
+
+    def record(self, url, depth, links, text, metadata=None):
+        self._file.write(json.dumps({'url': url, 'depth': depth, 'links': links, 'text': text,
+                                     'metadata': metadata}) + '\n')
+        self._unsynced += 1
+        if self._unsynced >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        if self._file is not None and self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def close(self):
+        if self._file is not None:
+            self.checkpoint()
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        # Called once the crawled pages are saved, or to start over
+        self.close()
+        if self.exists():
+            os.remove(self.file_path)
+
+_thread_state = threading.local()
+
+def _session():
+    # One keep-alive session per worker thread; requests.Session is not thread-safe
+    session = getattr(_thread_state, 'session', None)
+    if session is None:
+        session = _thread_state.session = requests.Session()
+    return session
+
+def fetch_page(url, limiter, timeout, metadata=None, extractor='html.parser'):
+    # Returns (outcome, cleaned text, links): outcome is 'ok', 'gone' when the page
+    # answers 404 or 410, or 'failed' for any other error. With metadata, a page
+    # that answers 304 or whose body hash is unchanged is returned as
+    # ('ok', None, stored links) without being parsed
+    host = url_host(url)
+    key = normalize_url(url)
+    known = metadata.get(key) if metadata is not None else None
+    headers = {}
+    if known:
+        if known.get('etag'):
+            headers['If-None-Match'] = known['etag']
+        if known.get('last_modified'):
+            headers['If-Modified-Since'] = known['last_modified']
+
+    limiter.acquire(host)
+    try:
+        response = _session().get(url, timeout=timeout, headers=headers)
+    except requests.RequestException as e:
+        print(f"Failed to retrieve URL: {url} ({e})")
+        return 'failed', None, []
+    finally:
+        limiter.release(host)
+
+    if response.status_code == 304 and known:
+        metadata.record(key, 'not_modified', 0)
+        return 'ok', None, known['links']
+    if response.status_code != 200:
+        print(f"Failed to retrieve URL: {url} with status code: {response.status_code}")
+        return ('gone' if response.status_code in GONE_STATUSES else 'failed'), None, []
+
+    body = response.content
+    validators = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+    digest = hashlib.sha1(body).hexdigest()
+    if known and known.get('hash') == digest:
+        metadata.record(key, 'unchanged', len(body), **validators)
+        return 'ok', None, known['links']
+
+    # Links resolve against the final URL, so relative hrefs work after redirects
+    cleaned_text, links = extract(response.text, response.url, extractor)
+    if metadata is not None:
+        metadata.record(key, 'changed', len(body), hash=digest, links=links, **validators)
+    return 'ok', cleaned_text, links
+
+def crawl_pages(start_url, delay=0, existing_urls=None, max_workers=1, max_per_host=None, timeout=10,
+                max_depth=None, max_pages=None, stats=None, metadata=None, extractor='html.parser',
+                journal=None, outcomes=None):
+    # Yields (normalized_url, cleaned_text) as pages arrive. max_workers bounds the
+    # fetches in flight overall, max_per_host bounds them per host, and delay is the
+    # minimum gap between two request starts to the same host. max_depth and
+    # max_pages cap link depth from start_url and the number of fetches. Pages that
+    # metadata (a CrawlMetadata) shows to be unchanged are followed but not yielded.
+    # extractor names the HTML backend ('html.parser', or 'lxml' when installed).
+    # With a CrawlJournal, a crawl interrupted earlier resumes where it stopped:
+    # its journaled pages are yielded again without being fetched.
+    # outcomes, a dict, receives the fetch outcome ('ok', 'gone' or 'failed', see
+    # fetch_page) of every normalized URL crawled.
+    # No new fetch is dispatched while the consumer is busy, so at most max_workers
+    # fetched pages are ever buffered ahead of it.
+    if max_per_host is None:
+        max_per_host = max_workers
+    limiter = HostLimiter(max_per_host, delay)
+    frontier = Frontier(url_host(start_url), existing_urls, max_depth, max_pages)
+    frontier.push(start_url)
+
+    replayed = journal.open(start_url) if journal is not None else []
+    for record in replayed:
+        for new_url in record['links']:
+            frontier.push(new_url, record['depth'] + 1)
+        if metadata is not None and record['metadata'] is not None:
+            metadata.pages[record['url']] = record['metadata']
+    frontier.mark_done({record['url'] for record in replayed})
+    if outcomes is not None:
+        outcomes.update((record['url'], 'ok') for record in replayed)
+    for record in replayed:
+        if record['text']:
+            yield record['url'], record['text']
+
+    in_flight = {}
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while frontier or in_flight:
+                while frontier and len(in_flight) < max_workers:
+                    url, normalized_url, depth = frontier.pop()
+                    print(f"Crawling URL: {url}")
+                    future = executor.submit(fetch_page, url, limiter, timeout, metadata, extractor)
+                    in_flight[future] = (normalized_url, depth)
+
+                if not in_flight:
+                    continue
+
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    normalized_url, depth = in_flight.pop(future)
+                    outcome, cleaned_text, links = future.result()
+                    if outcomes is not None:
+                        outcomes[normalized_url] = outcome
+                    if outcome != 'ok':
+                        continue
+                    for new_url in links:
+                        frontier.push(new_url, depth + 1)
+                    if journal is not None:
+                        journal.record(normalized_url, depth, links, cleaned_text,
+                                       metadata.get(normalized_url) if metadata is not None else None)
+                    if cleaned_text:
+                        yield normalized_url, cleaned_text
+    finally:
+        # Also reached when the consumer stops early or is interrupted
+        if journal is not None:
+            journal.checkpoint()
+
+    frontier_stats = frontier.stats()
+    print(f"Frontier: {frontier_stats['enqueued']} URLs enqueued from {frontier_stats['links_seen']} links, "
+          f"peak size {frontier_stats['peak_size']}")
+    if metadata is not None:
+        print(metadata.summary())
+        frontier_stats.update(metadata.counters)
+    if stats is not None:
+        stats.update(frontier_stats)
+
+def crawl_website(start_url, delay=0, existing_urls=None, **options):
+    return list(crawl_pages(start_url, delay, existing_urls, **options))
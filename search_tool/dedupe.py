@@ -0,0 +1,92 @@
+from array import array
+from functools import lru_cache
+from hashlib import blake2b
+import struct
+
+# Near-duplicate detection with 64-bit SimHash fingerprints over word shingles.
+# Two pages are near-duplicates when the fraction of equal fingerprint bits is at
+# least the similarity threshold; a near-duplicate is attributed to the first
+# such page seen (the canonical page).
+BITS = 64
+SHINGLE = 3  # Words per shingle, at most 4
+SIMILARITY = 0.9  # At most 6 of 64 bits differ
+
+_WORD_HASHES = struct.Struct('<4Q')
+
+@lru_cache(maxsize=1 << 16)
+def _word_hashes(word):
+    # One independent 64-bit hash per position of the word in a shingle, so a
+    # shingle's hash (their XOR) depends on word order
+    return _WORD_HASHES.unpack(blake2b(word.encode('utf-8'), digest_size=_WORD_HASHES.size).digest())
+
+# _BIT_TABLES[k] maps a byte to 1 if its bit k is set, else to 0
+_BIT_TABLES = [bytes((value >> bit) & 1 for value in range(256)) for bit in range(8)]
+
+def simhash(words, shingle=SHINGLE):
+    # Every shingle occurrence votes +1 / -1 per bit with the bits of its hash; the
+    # fingerprint keeps the bits with a positive total. Shingle hashes XOR the
+    # cached per-position hashes of their words, and are laid out back to back so each bit is
+    # counted by bytes.translate and bytes.count in C.
+    hashes = list(map(_word_hashes, words))
+    shingle = max(min(shingle, len(hashes)), 1)
+    combined = [h[0] for h in hashes[:len(hashes) - shingle + 1]]
+    for offset in range(1, shingle):
+        combined = [c ^ h[offset] for c, h in zip(combined, hashes[offset:])]
+    digests = array('Q', combined).tobytes()
+    fingerprint = 0
+    for i in range(BITS // 8):
+        column = digests[i::BITS // 8]
+        for bit, table in enumerate(_BIT_TABLES):
+            if 2 * column.translate(table).count(1) > len(combined):
+                fingerprint |= 1 << (i * 8 + bit)
+    return fingerprint
+
+def text_fingerprint(text):
+    return simhash(text.lower().split())
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+class DuplicateDetector:
+    # Splits fingerprints into max_distance + 1 bands: two fingerprints within
+    # max_distance bits agree exactly on at least one band, so only pages sharing a
+    # band are compared.
+    def __init__(self, similarity=SIMILARITY):
+        if not 0 < similarity <= 1:
+            raise ValueError(f"Similarity threshold must be in (0, 1], got {similarity}")
+        self.max_distance = max_distance = int((1 - similarity) * BITS + 1e-9)
+        bands = max_distance + 1
+        edges = [BITS * i // bands for i in range(bands + 1)]
+        self.bands = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(edges, edges[1:])]
+        self.tables = [{} for _ in self.bands]
+
+    def _keys(self, fingerprint):
+        return [fingerprint >> shift & mask for shift, mask in self.bands]
+
+    def add(self, url, fingerprint):
+        for table, key in zip(self.tables, self._keys(fingerprint)):
+            table.setdefault(key, []).append((url, fingerprint))
+
+    def find(self, fingerprint, url=None):
+        # The first page added within max_distance bits, other than url itself
+        for table, key in zip(self.tables, self._keys(fingerprint)):
+            for other_url, other in table.get(key, ()):
+                if other_url != url and hamming(fingerprint, other) <= self.max_distance:
+                    return other_url
+        return None
+
+def filter_duplicates(pages, detector, duplicates=None, fingerprints=None):
+    # Passes (url, text) pages through, dropping near-duplicates of pages already
+    # in detector; dropped pages are recorded in duplicates as {url: canonical URL}.
+    # The fingerprint of every page passed on is stored in fingerprints when given.
+    for url, text in pages:
+        fingerprint = text_fingerprint(text)
+        canonical = detector.find(fingerprint, url)
+        if canonical is not None:
+            if duplicates is not None:
+                duplicates[url] = canonical
+            continue
+        detector.add(url, fingerprint)
+        if fingerprints is not None:
+            fingerprints[url] = fingerprint
+        yield url, text
@@ -0,0 +1,136 @@
+import mmap
+import os
+import struct
+import zlib
+
+from index_format import encode_varints, decode_varints
+
+# Document store written next to an index segment: one zlib-compressed block per
+# document, in doc ID order, holding the page text and the character span of each
+# of its tokens (so token positions from the index map back onto the text). A
+# fixed-size offset table at the end gives any block in O(1).
+#
+# Layout: header | blocks | offset table (doc count x (block offset, block length))
+# Block (before compression): varint section length (u32) | varints: token count,
+# then (gap from previous token end, token length) per token | UTF-8 text
+MAGIC = b'SDOC'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIQ')  # magic, version, reserved, doc count, offset table offset
+ENTRY = struct.Struct('<QI')
+SECTION = struct.Struct('<I')
+LEVEL = 6
+
+def encode_document(text, spans):
+    # spans: (start, end) character offsets of every token in text, in order
+    values = [len(spans)]
+    previous = 0
+    for start, end in spans:
+        values.append(start - previous)
+        values.append(end - start)
+        previous = end
+    varints = bytearray()
+    encode_varints(values, varints)
+    return zlib.compress(SECTION.pack(len(varints)) + bytes(varints) + text.encode('utf-8'), LEVEL)
+
+def decode_document(block):
+    # Inverse of encode_document: (text, spans)
+    data = zlib.decompress(block)
+    (length,) = SECTION.unpack_from(data)
+    values = decode_varints(data, SECTION.size, SECTION.size + length)
+    spans = []
+    previous = 0
+    for i in range(1, 2 * values[0], 2):
+        start = previous + values[i]
+        previous = start + values[i + 1]
+        spans.append((start, previous))
+    return data[SECTION.size + length:].decode('utf-8'), spans
+
+class DocStoreWriter:
+    # Streams blocks to file_path + '.tmp'; close() adds the offset table and
+    # renames the file into place. append takes an encoded block, so blocks made
+    # in worker processes are written as they are.
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.temp_path = file_path + '.tmp'
+        self._file = open(self.temp_path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0))
+        self._offset = HEADER.size
+        self._entries = []
+
+    def append(self, block):
+        self._file.write(block)
+        self._entries.append((self._offset, len(block)))
+        self._offset += len(block)
+
+    def add(self, text, spans):
+        self.append(encode_document(text, spans))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self, file_path=None):
+        # Finishes the store at file_path (default: the path given when created)
+        for offset, length in self._entries:
+            self._file.write(ENTRY.pack(offset, length))
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, 0, len(self._entries), self._offset))
+        self._file.close()
+        os.replace(self.temp_path, file_path or self.file_path)
+
+    def discard(self):
+        self._file.close()
+        os.remove(self.temp_path)
+
+class DocStore:
+    # Read-only store over a memory-mapped file; only the requested block is
+    # decompressed
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._data) < HEADER.size:
+            raise ValueError("Document store is truncated")
+        magic, version, _, self.doc_count, self._table_offset = HEADER.unpack_from(self._data)
+        if magic != MAGIC:
+            raise ValueError("Not a document store")
+        if version != VERSION:
+            raise ValueError(f"Unsupported document store version {version}")
+
+    def __len__(self):
+        return self.doc_count
+
+    def block(self, doc_id):
+        offset, length = ENTRY.unpack_from(self._data, self._table_offset + doc_id * ENTRY.size)
+        return self._data[offset:offset + length]
+
+    def document(self, doc_id):
+        return decode_document(self.block(doc_id))
+
+    def close(self):
+        self._data.close()
+
+def snippet(text, spans, matches, width=8, markers=('[', ']')):
+    # Text around the first match with every match in view wrapped in markers.
+    # matches: (token position, token count) pairs; width tokens of context are
+    # kept on each side.
+    if not matches or not spans:
+        return ''
+    # A longer match starting at the same token wins
+    matches = sorted(matches, key=lambda match: (match[0], -match[1]))
+    first, length = matches[0]
+    lo = max(first - width, 0)
+    hi = min(first + length + width, len(spans))
+    if lo >= hi:
+        return ''
+    parts = ['...' if lo > 0 else '']
+    cursor = spans[lo][0]
+    for position, length in matches:
+        end = min(position + length, hi)
+        if position < lo or position >= hi or spans[position][0] < cursor:
+            continue
+        start_char, end_char = spans[position][0], spans[end - 1][1]
+        parts.append(text[cursor:start_char])
+        parts.append(markers[0] + text[start_char:end_char] + markers[1])
+        cursor = end_char
+    parts.append(text[cursor:spans[hi - 1][1]])
+    parts.append('...' if hi < len(spans) else '')
+    return ''.join(parts)
@@ -0,0 +1,93 @@
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse
+
+# Single pass over a page's markup that collects its visible text and link targets
+# without building a tree. Text inside script, style and template elements is not
+# visible and is dropped; text nodes are joined with a space, as
+# BeautifulSoup.get_text(separator=' ') does.
+SKIPPED_TAGS = frozenset(('script', 'style', 'template'))
+
+DEFAULT_BACKEND = 'html.parser'
+
+class _PageHandler:
+    # Callbacks shared by both backends
+    def __init__(self):
+        self.text = []
+        self.hrefs = []
+        self.skip_depth = 0
+
+    def start(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag == 'a':
+            href = attrs.get('href')
+            if href:
+                self.hrefs.append(href)
+
+    def end(self, tag):
+        if tag in SKIPPED_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+
+    def data(self, data):
+        if not self.skip_depth:
+            self.text.append(data)
+
+    def close(self):
+        return self
+
+class _HTMLParser(HTMLParser):
+    def __init__(self, handler):
+        super().__init__(convert_charrefs=True)
+        self.handler = handler
+
+    def handle_starttag(self, tag, attrs):
+        self.handler.start(tag, dict(attrs))
+
+    def handle_endtag(self, tag):
+        self.handler.end(tag)
+
+    def handle_data(self, data):
+        self.handler.data(data)
+
+def _parse_html_parser(html):
+    handler = _PageHandler()
+    parser = _HTMLParser(handler)
+    parser.feed(html)
+    parser.close()
+    return handler
+
+_lxml_etree = None
+
+def _parse_lxml(html):
+    # lxml is optional: imported on first use. Its parser target interface streams
+    # the same callbacks, still without building a tree.
+    global _lxml_etree
+    if _lxml_etree is None:
+        from lxml import etree
+        _lxml_etree = etree
+    handler = _PageHandler()
+    parser = _lxml_etree.HTMLParser(target=handler)
+    parser.feed(html)
+    return parser.close()
+
+def clean_text(text):
+    return ' '.join(text.split())
+
+def extract(html, base_url, backend=DEFAULT_BACKEND):
+    # Returns (cleaned text, links): whitespace-collapsed visible text, and the
+    # <a href> targets resolved against base_url that stay on its host
+    if backend == 'html.parser':
+        handler = _parse_html_parser(html)
+    elif backend == 'lxml':
+        handler = _parse_lxml(html)
+    else:
+        raise ValueError(f"Unknown HTML extractor backend '{backend}'")
+
+    text = clean_text(' '.join(handler.text))
+    host = urlparse(base_url).netloc
+    links = []
+    for href in handler.hrefs:
+        url = urljoin(base_url, href)
+        if urlparse(url).netloc == host:
+            links.append(url)
+    return text, links
@@ -0,0 +1,117 @@
+import hashlib
+import random
+import threading
+import time
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+VOCABULARY = [
+    'life', 'love', 'world', 'truth', 'friend', 'book', 'dream', 'mind', 'heart', 'time',
+    'change', 'reading', 'humor', 'inspirational', 'simile', 'music', 'light', 'dark',
+    'choice', 'ability', 'wisdom', 'hope', 'fear', 'courage', 'silence', 'poetry',
+    'the', 'a', 'is', 'of', 'and', 'to', 'in', 'that', 'it', 'you', 'not', 'be',
+]
+SYLLABLES = ['ba', 'co', 'di', 'fu', 'ga', 'he', 'ki', 'lo', 'ma', 'ne', 'po', 'ri', 'sa', 'tu', 've', 'zo',
+             'bel', 'dor', 'fin', 'gal', 'mur', 'nax', 'pel', 'quin', 'ros', 'tar', 'vil', 'wen']
+
+def generate_site(pages=50, fanout=5, words_per_page=200, seed=0, duplicates=0, vocabulary=None):
+    # Returns {path: html}. Every page links to its successor so the whole site is
+    # reachable from '/', plus `fanout` pseudo-random links to other pages. The last
+    # `duplicates` pages repeat the text of an earlier page under their own title
+    # and links, like tag and pagination pages listing the same quotes.
+    # Words are drawn uniformly from VOCABULARY, or with a vocabulary size from
+    # that many words with Zipf-like frequencies: VOCABULARY first, then made-up
+    # words as a long tail of rare terms.
+    rng = random.Random(seed)
+    if vocabulary is None:
+        words, weights = VOCABULARY, None
+    else:
+        words = synthetic_vocabulary(vocabulary, seed)
+        weights = [1 / (rank + 1) for rank in range(len(words))]
+    site = {}
+    texts = []
+    originals = pages - duplicates
+    for i in range(pages):
+        targets = {(i + 1) % pages}
+        while len(targets) < min(fanout, pages):
+            targets.add(rng.randrange(pages))
+        links = ''.join(f'<a href="{_page_path(t)}">page {t}</a> ' for t in sorted(targets))
+        if i < originals:
+            if weights is None:
+                text = ' '.join(rng.choice(words) for _ in range(words_per_page))
+            else:
+                text = ' '.join(rng.choices(words, weights, k=words_per_page))
+            texts.append(text)
+        else:
+            text = texts[duplicate_source(i, originals)]
+        site[_page_path(i)] = (
+            f"<html><head><title>Page {i}</title></head>"
+            f"<body><h1>Page {i}</h1><p>{text}</p><div>{links}</div></body></html>"
+        )
+    return site
+
+def synthetic_vocabulary(size, seed=0):
+    # VOCABULARY followed by distinct made-up words of two to four syllables
+    rng = random.Random(seed)
+    words = VOCABULARY[:size]
+    seen = set(words)
+    while len(words) < size:
+        word = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+def duplicate_source(i, originals):
+    # Page whose text duplicate page i repeats
+    return i * 7 % originals
+
+def _page_path(i):
+    return '/' if i == 0 else f'/page/{i}'
+
+@contextmanager
+def serve_site(site, latency=0, validators=True):
+    # Serves the generated site on an ephemeral localhost port; latency (seconds) is
+    # added to every response to simulate a remote server. With validators, pages
+    # carry an ETag and Last-Modified and a matching If-None-Match gets a 304.
+    # Changes to the site dict are served from the next request on.
+    started = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+            body = site.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            data = body.encode('utf-8')
+            etag = f'"{hashlib.sha1(data).hexdigest()}"'
+            if validators and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            if validators:
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', started)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,152 @@
+from bisect import bisect_left
+
+# Typo-tolerant term lookup. The sorted terms are walked as a trie: the terms
+# sharing a prefix are a contiguous range, split by next character with a binary
+# search. Each prefix is in a state of the edit distance table against the query
+# (its row and the row before it), and a prefix whose last two rows are both over
+# the limit is not descended into, since no longer term can come back within it.
+# A lookup so only visits the prefixes within a few edits of the query's, a
+# number growing far slower than the vocabulary, at a binary search each. Many
+# prefixes share a state, so each transition is computed once per lookup, and
+# ranges of a few terms are finished term by term through the same transitions.
+LEAF_TERMS = 8  # Ranges of at most this many terms are not split further
+
+def max_edits(word):
+    # Edits tolerated for a word of this length: none for very short words
+    if len(word) < 3:
+        return 0
+    return 1 if len(word) <= 5 else 2
+
+def edit_distance(a, b, limit=None):
+    # Edits (insert, delete, substitute, or swap two adjacent characters) turning
+    # a into b. With limit, only cells within limit of the diagonal are computed
+    # and any distance over it is returned as limit + 1 as soon as it is certain.
+    if len(a) < len(b):
+        a, b = b, a
+    if limit is None:
+        limit = len(a)
+    if len(a) - len(b) > limit:
+        return limit + 1
+    over = limit + 1
+    before, previous = None, [j if j <= limit else over for j in range(len(b) + 1)]
+    for i, char in enumerate(a, 1):
+        current = [over] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+            other = b[j - 1]
+            distance = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other))
+            if i > 1 and j > 1 and char == b[j - 2] and a[i - 2] == other and before[j - 2] + 1 < distance:
+                distance = before[j - 2] + 1
+            current[j] = distance if distance < over else over
+        # A swap reaches back two rows, so both must be over the limit
+        if min(current) > limit and min(previous) > limit:
+            return over
+        before, previous = previous, current
+    return previous[-1]
+
+class _Automaton:
+    # States of the edit distance table of one query word, numbered as reached:
+    # a state is a prefix's row, the row before it and the prefix's last
+    # character, which a swap of adjacent characters looks back at. Distances
+    # over max_distance are all max_distance + 1, so there are few states.
+    DEAD = -1  # No term through the prefix can be within max_distance
+
+    def __init__(self, word, max_distance):
+        self.word = word
+        self.max_distance = max_distance
+        self.chars = set(word)
+        self.distances = []  # Per state: the distance of the prefix itself
+        self.moves = {}  # (state, char) -> next state, filled by step
+        self._states = {}
+        self._rows = []
+        over = max_distance + 1
+        self.start = self._state(tuple(j if j <= max_distance else over for j in range(len(word) + 1)), None, '')
+
+    def _state(self, row, before, last):
+        key = (row, before, last)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = len(self._rows)
+            self._rows.append(key)
+            self.distances.append(row[-1])
+        return state
+
+    def step(self, state, char):
+        # The state after appending char, or DEAD; callers look in moves first
+        # (no move leads back to the start, state 0). Characters not in the word
+        # all move alike.
+        key = char if char in self.chars else ''
+        move = self.moves.get((state, key))
+        if move is None:
+            move = self.moves[state, key] = self._next(state, key)
+        self.moves[state, char] = move
+        return move
+
+    def _next(self, state, char):
+        word, max_distance = self.word, self.max_distance
+        over = max_distance + 1
+        row, before, last = self._rows[state]
+        current = [min(row[0] + 1, over)]
+        for j in range(1, len(word) + 1):
+            other = word[j - 1]
+            distance = min(row[j] + 1, current[j - 1] + 1, row[j - 1] + (char != other))
+            if char and before is not None and j > 1 and char == word[j - 2] and last == other \
+                    and before[j - 2] + 1 < distance:
+                distance = before[j - 2] + 1
+            current.append(distance if distance < over else over)
+        # A swap reaches back two rows, so both must be over the limit
+        if min(current) > max_distance and min(row) > max_distance:
+            return self.DEAD
+        return self._state(tuple(current), row, char)
+
+class FuzzyIndex:
+    def __init__(self, terms):
+        # terms: distinct terms, sorted here unless they already are
+        self.terms = sorted(terms)
+
+    def search(self, word, max_distance=None, stats=None):
+        # [(distance, term)] for the terms within max_distance edits of word
+        # (default: max_edits(word)), closest first. stats, a dict, receives the
+        # number of trie prefixes visited as 'prefixes'.
+        if max_distance is None:
+            max_distance = max_edits(word)
+        terms = self.terms
+        automaton = _Automaton(word, max_distance)
+        step, moves, distances, dead = automaton.step, automaton.moves, automaton.distances, automaton.DEAD
+        length = len(word)
+        matches = []
+        visited = 0
+        stack = [(0, 0, len(terms), automaton.start)]  # (prefix length, its range of terms, its state)
+        while stack:
+            depth, lo, hi, state = stack.pop()
+            visited += 1
+            if hi - lo <= LEAF_TERMS:
+                for term in terms[lo:hi]:
+                    if abs(len(term) - length) > max_distance:
+                        continue
+                    term_state = state
+                    for char in term[depth:]:
+                        term_state = moves.get((term_state, char)) or step(term_state, char)
+                        if term_state == dead:
+                            break
+                    else:
+                        if distances[term_state] <= max_distance:
+                            matches.append((distances[term_state], term))
+                continue
+            # A term equal to the prefix sorts first in the range
+            if len(terms[lo]) == depth:
+                if distances[state] <= max_distance:
+                    matches.append((distances[state], terms[lo]))
+                lo += 1
+            prefix = terms[lo][:depth]
+            while lo < hi:
+                char = terms[lo][depth]
+                end = bisect_left(terms, prefix + chr(ord(char) + 1), lo, hi)
+                child = moves.get((state, char)) or step(state, char)
+                if child != dead:
+                    stack.append((depth + 1, lo, end, child))
+                lo = end
+        if stats is not None:
+            stats['prefixes'] = visited
+        return sorted(matches)
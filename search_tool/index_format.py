@@ -0,0 +1,340 @@
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict
+from itertools import accumulate, chain
+
+from inverted_index import InvertedIndex, TermPostings
+from termdict import TermDictionary
+
+# Binary index layout (all integers little-endian):
+#   header      MAGIC, version, flags, doc count, term count, doc table offset, term dict offset
+#   postings    per term: varint doc count, then per doc: varint doc-id delta,
+#               varint position count, varint position deltas
+#   doc table   per doc id: varint url length, utf-8 url, varint doc length (v2+)
+#   term dict   per term (sorted): varint term length, utf-8 term,
+#               varint postings offset, varint postings length, varint doc frequency
+MAGIC = b'SIDX'
+VERSION = 2
+HEADER = struct.Struct('<4sHHIIQQ')
+
+def encode_varints(values, out):
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+def decode_varints(data, start=0, end=None):
+    block = data[start:end]
+    # Most deltas fit in one byte, in which case the bytes are the values
+    if not block or max(block) < 0x80:
+        return list(block)
+    values = []
+    append = values.append
+    value = shift = 0
+    for byte in block:
+        if byte < 0x80:
+            if shift:
+                append(value | (byte << shift))
+                value = shift = 0
+            else:
+                append(byte)
+        else:
+            value |= (byte & 0x7F) << shift
+            shift += 7
+    return values
+
+def encode_postings(postings, out):
+    # postings: iterable of (doc_id, sorted positions) in ascending doc_id order
+    postings = list(postings)
+    encode_varints((len(postings),), out)
+    encode_postings_body(postings, 0, out)
+
+def encode_postings_body(postings, previous_doc, out):
+    # Like encode_postings without the doc count, the first delta taken from
+    # previous_doc (see append_postings). Returns the doc count and last doc ID.
+    count = 0
+    for doc_id, positions in postings:
+        encode_varints((doc_id - previous_doc, len(positions)), out)
+        encode_varints((b - a for a, b in zip(chain((0,), positions), positions)), out)
+        previous_doc = doc_id
+        count += 1
+    return count, previous_doc
+
+def decode_postings(values, i=0):
+    # Inverse of encode_postings over a flat list of decoded varints starting at
+    # values[i]; returns the postings and the index just past them
+    postings = []
+    doc_id = 0
+    count = values[i]
+    i += 1
+    for _ in range(count):
+        doc_id += values[i]
+        end = i + 2 + values[i + 1]
+        postings.append((doc_id, list(accumulate(values[i + 2:end]))))
+        i = end
+    return postings, i
+
+def append_postings(data, start, end, shift, previous_doc, out):
+    # Appends the postings encoded in data[start:end] to out without their doc
+    # count, with doc IDs shifted by shift and the first delta taken from
+    # previous_doc, so the postings of consecutive doc ID ranges concatenate.
+    # Only the first delta is re-encoded; the rest is copied as it is.
+    # Returns the doc count and the last doc ID.
+    count, pos = _read_varint(data, start)
+    first, rest = _read_varint(data, pos)
+    values = decode_varints(data, pos, end)
+    doc_id = i = 0
+    for _ in range(count):
+        doc_id += values[i]
+        i += 2 + values[i + 1]
+    encode_varints((first + shift - previous_doc,), out)
+    out += data[rest:end]
+    return count, doc_id + shift
+
+class IndexWriter:
+    # Streams an index file to file_path + '.tmp': postings are written as each
+    # term is added, in ascending term order, and the doc table is spooled to a
+    # temporary file, so only the term dict entries are held in memory. close()
+    # writes the doc table, term dict and header, then renames the file into place.
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.temp_path = file_path + '.tmp'
+        self._file = open(self.temp_path, 'wb')
+        self._file.write(bytes(HEADER.size))
+        self._offset = HEADER.size
+        self._term_entries = []
+        self._doc_table = tempfile.SpooledTemporaryFile(max_size=1 << 20)
+        self._doc_count = 0
+
+    def add_term(self, term, postings):
+        # postings: iterable of (doc_id, sorted positions) in ascending doc_id order
+        postings = list(postings)
+        out = bytearray()
+        encode_postings(postings, out)
+        self._file.write(out)
+        self._term_entries.append((term, self._offset, len(out), len(postings)))
+        self._offset += len(out)
+
+    def add_encoded_term(self, term, doc_count, body):
+        # body: encoded postings without their leading doc count (see append_postings)
+        out = bytearray()
+        encode_varints((doc_count,), out)
+        out += body
+        self._file.write(out)
+        self._term_entries.append((term, self._offset, len(out), doc_count))
+        self._offset += len(out)
+
+    def add_document(self, url, length):
+        # Documents are added in doc ID order
+        out = bytearray()
+        encoded = url.encode('utf-8')
+        encode_varints((len(encoded),), out)
+        out += encoded
+        encode_varints((length,), out)
+        self._doc_table.write(out)
+        self._doc_count += 1
+
+    def close(self):
+        doc_table_offset = self._offset
+        self._doc_table.seek(0)
+        shutil.copyfileobj(self._doc_table, self._file)
+        self._doc_table.close()
+        term_dict_offset = self._file.tell()
+        out = bytearray()
+        for term, offset, length, doc_freq in self._term_entries:
+            encoded = term.encode('utf-8')
+            encode_varints((len(encoded),), out)
+            out += encoded
+            encode_varints((offset, length, doc_freq), out)
+        self._file.write(out)
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, 0, self._doc_count, len(self._term_entries),
+                                     doc_table_offset, term_dict_offset))
+        self._term_entries = []
+        self._file.close()
+        # Write then rename, so readers that have the old file mapped keep a valid view
+        os.replace(self.temp_path, self.file_path)
+
+    def discard(self):
+        self._doc_table.close()
+        self._file.close()
+        os.remove(self.temp_path)
+
+def write_index(index, file_path):
+    # index: an InvertedIndex; its doc IDs are written as they are
+    writer = IndexWriter(file_path)
+    for term in sorted(index.terms):
+        writer.add_term(term, ((doc_id, sorted(positions)) for doc_id, positions in index.terms[term]))
+    for url, length in zip(index.urls, index.doc_lengths):
+        writer.add_document(url, length)
+    writer.close()
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def read_header(data):
+    if len(data) < HEADER.size:
+        raise ValueError("Index file is truncated")
+    magic, version, _, doc_count, term_count, doc_table_offset, term_dict_offset = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a binary index file")
+    if not 1 <= version <= VERSION:
+        raise ValueError(f"Unsupported index version {version}")
+    return version, doc_count, term_count, doc_table_offset, term_dict_offset
+
+def read_doc_table(data, offset, doc_count, version=VERSION):
+    # Returns the URLs and document lengths; version 1 files have no lengths
+    urls = []
+    doc_lengths = array('I')
+    for _ in range(doc_count):
+        length, offset = _read_varint(data, offset)
+        urls.append(bytes(data[offset:offset + length]).decode('utf-8'))
+        offset += length
+        if version >= 2:
+            doc_length, offset = _read_varint(data, offset)
+            doc_lengths.append(doc_length)
+    return urls, doc_lengths
+
+def iter_term_dict(data, offset, term_count):
+    # Yields (term, postings offset, postings length, doc frequency) in term order
+    for _ in range(term_count):
+        length, offset = _read_varint(data, offset)
+        term = bytes(data[offset:offset + length]).decode('utf-8')
+        offset += length
+        postings_offset, offset = _read_varint(data, offset)
+        postings_length, offset = _read_varint(data, offset)
+        doc_freq, offset = _read_varint(data, offset)
+        yield term, postings_offset, postings_length, doc_freq
+
+def read_term_dict(data, offset, term_count):
+    # Returns {term: (postings offset, postings length, doc frequency)}
+    return {term: (postings_offset, postings_length, doc_freq)
+            for term, postings_offset, postings_length, doc_freq in iter_term_dict(data, offset, term_count)}
+
+def read_index(file_path):
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    version, doc_count, term_count, doc_table_offset, term_dict_offset = read_header(data)
+    urls, doc_lengths = read_doc_table(data, doc_table_offset, doc_count, version)
+    terms = read_term_dict(data, term_dict_offset, term_count)
+
+    index = InvertedIndex()
+    for url in urls:
+        index.doc_id(url)
+    if version < 2:
+        doc_lengths = array('I', [0]) * doc_count
+
+    # Postings are stored back to back in term order, so decode them in one pass
+    values = decode_varints(data, HEADER.size, doc_table_offset)
+    i = 0
+    for term in terms:
+        postings = index.terms[term] = TermPostings()
+        doc_id = 0
+        count = values[i]
+        i += 1
+        for _ in range(count):
+            doc_id += values[i]
+            end = i + 2 + values[i + 1]
+            postings.docs.append(doc_id)
+            postings.starts.append(len(postings.positions))
+            postings.positions.extend(accumulate(values[i + 2:end]))
+            if version < 2:
+                doc_lengths[doc_id] += end - i - 2
+            i = end
+    index.doc_lengths = doc_lengths
+    index.total_length = sum(doc_lengths)
+    return index
+
+class LazyIndex:
+    # Read-only index over a memory-mapped binary file with the same accessors as
+    # InvertedIndex. Only the doc table and term dictionary are decoded up front;
+    # postings are decoded on first access and the most recently used
+    # cache_size terms are kept. Safe to query from several threads.
+    def __init__(self, file_path, cache_size=1024):
+        self.file_path = file_path
+        with open(file_path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        version, doc_count, term_count, doc_table_offset, term_dict_offset = read_header(self._data)
+        self.urls, self.doc_lengths = read_doc_table(self._data, doc_table_offset, doc_count, version)
+        self.total_length = sum(self.doc_lengths)
+        self.terms = read_term_dict(self._data, term_dict_offset, term_count)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._dictionary = None
+
+    def term_dictionary(self):
+        # The term dict is stored sorted, so this needs no sort
+        if self._dictionary is None:
+            self._dictionary = TermDictionary(list(self.terms))
+        return self._dictionary
+
+    def term_postings(self, term):
+        with self._cache_lock:
+            postings = self._cache.get(term)
+            if postings is not None:
+                self._cache.move_to_end(term)
+                return postings
+        if term not in self.terms:
+            return None
+        offset, length, _ = self.terms[term]
+        decoded, _ = decode_postings(decode_varints(self._data, offset, offset + length))
+        postings = TermPostings()
+        for doc_id, positions in decoded:
+            postings.docs.append(doc_id)
+            postings.starts.append(len(postings.positions))
+            postings.positions.extend(positions)
+        with self._cache_lock:
+            self._cache[term] = postings
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return postings
+
+    def postings(self, term):
+        postings = self.term_postings(term)
+        if postings is None:
+            return []
+        return [(self.urls[doc_id], positions) for doc_id, positions in postings]
+
+    def average_doc_length(self):
+        return self.total_length / len(self.urls) if self.urls else 0
+
+    def document_frequency(self, term):
+        return self.terms[term][2] if term in self.terms else 0
+
+    def __contains__(self, term):
+        return term in self.terms
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def close(self):
+        self._cache.clear()
+        self._data.close()
+
+def is_binary_index(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def convert_json_index(json_path, file_path):
+    with open(json_path, 'r') as f:
+        index = InvertedIndex.from_dict(json.load(f))
+    write_index(index, file_path)
+    return index
@@ -0,0 +1,164 @@
+from array import array
+from bisect import bisect_left
+
+from termdict import TermDictionary
+
+class TermPostings:
+    # Postings of one term as three flat arrays: sorted doc IDs, the offset of each
+    # doc's first position in `positions`, and all positions back to back.
+    __slots__ = ('docs', 'starts', 'positions')
+
+    def __init__(self):
+        self.docs = array('I')
+        self.starts = array('I')
+        self.positions = array('I')
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _end(self, i):
+        return self.starts[i + 1] if i + 1 < len(self.starts) else len(self.positions)
+
+    def add(self, doc_id, positions):
+        # Appending to the last doc is the common case while a document is indexed
+        if self.docs and self.docs[-1] == doc_id:
+            self.positions.extend(positions)
+            return
+        if not self.docs or self.docs[-1] < doc_id:
+            self.docs.append(doc_id)
+            self.starts.append(len(self.positions))
+            self.positions.extend(positions)
+            return
+
+        # Out-of-order doc (e.g. when merging indexes): splice into place
+        i = bisect_left(self.docs, doc_id)
+        added = array('I', positions)
+        if self.docs[i] == doc_id:
+            end = self._end(i)
+        else:
+            end = self.starts[i]
+            self.docs.insert(i, doc_id)
+            self.starts.insert(i, end)
+        self.positions[end:end] = added
+        for j in range(i + 1, len(self.starts)):
+            self.starts[j] += len(added)
+
+    def positions_of(self, i):
+        return self.positions[self.starts[i]:self._end(i)]
+
+    def __iter__(self):
+        # Yields (doc_id, positions) in doc ID order
+        for i, doc_id in enumerate(self.docs):
+            yield doc_id, self.positions_of(i)
+
+class InvertedIndex:
+    # In-memory inverted index: a doc ID <-> URL table, the number of indexed terms
+    # in each document, and TermPostings per term
+    def __init__(self):
+        self.urls = []
+        self.doc_ids = {}
+        self.doc_lengths = array('I')
+        self.total_length = 0
+        self.terms = {}
+
+    def doc_id(self, url):
+        doc_id = self.doc_ids.get(url)
+        if doc_id is None:
+            doc_id = self.doc_ids[url] = len(self.urls)
+            self.urls.append(url)
+            self.doc_lengths.append(0)
+        return doc_id
+
+    def _add_length(self, doc_id, length):
+        self.doc_lengths[doc_id] += length
+        self.total_length += length
+
+    def add_document(self, url, term_positions):
+        # term_positions: {term: [positions]} for one document
+        doc_id = self.doc_id(url)
+        terms = self.terms
+        length = 0
+        for term, positions in term_positions.items():
+            postings = terms.get(term)
+            if postings is None:
+                postings = terms[term] = TermPostings()
+            postings.add(doc_id, positions)
+            length += len(positions)
+        self._add_length(doc_id, length)
+
+    def add_postings(self, term, url, positions):
+        self.add_document(url, {term: positions})
+
+    def merge(self, other):
+        # Adds every posting of another index. URLs new to this index get doc IDs in
+        # the other index's order, so merging partial indexes built over consecutive
+        # shards of a page list reproduces the doc IDs of a single serial build.
+        doc_map = [self.doc_id(url) for url in other.urls]
+        if not doc_map:
+            return self
+        for doc_id, length in zip(doc_map, other.doc_lengths):
+            self._add_length(doc_id, length)
+        offset = doc_map[0]
+        contiguous = doc_map == list(range(offset, offset + len(doc_map)))
+        for term, postings in other.terms.items():
+            mine = self.terms.get(term)
+            if mine is None:
+                mine = self.terms[term] = TermPostings()
+            if contiguous and (not mine.docs or mine.docs[-1] < offset):
+                # Every doc sorts after this term's last doc: bulk-append the columns
+                base = len(mine.positions)
+                mine.docs.extend(doc_id + offset for doc_id in postings.docs)
+                mine.starts.extend(start + base for start in postings.starts)
+                mine.positions.extend(postings.positions)
+            else:
+                for doc_id, positions in postings:
+                    mine.add(doc_map[doc_id], positions)
+        return self
+
+    def postings(self, term):
+        # [(url, positions)] for a term, in doc ID order; empty if the term is unknown
+        postings = self.terms.get(term)
+        if postings is None:
+            return []
+        urls = self.urls
+        return [(urls[doc_id], positions) for doc_id, positions in postings]
+
+    def term_postings(self, term):
+        return self.terms.get(term)
+
+    def average_doc_length(self):
+        return self.total_length / len(self.urls) if self.urls else 0
+
+    def document_frequency(self, term):
+        postings = self.terms.get(term)
+        return len(postings) if postings is not None else 0
+
+    def term_dictionary(self):
+        # Sorted on each call, since terms can still be added
+        return TermDictionary(sorted(self.terms))
+
+    def __contains__(self, term):
+        return term in self.terms
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def to_dict(self):
+        return {term: {url: list(positions) for url, positions in self.postings(term)} for term in self.terms}
+
+    @classmethod
+    def from_dict(cls, index):
+        # Builds from the legacy {term: {url: [positions]}} structure
+        inverted_index = cls()
+        for url in sorted({url for postings in index.values() for url in postings}):
+            inverted_index.doc_id(url)
+        doc_ids = inverted_index.doc_ids
+        for term, postings in index.items():
+            term_postings = inverted_index.terms[term] = TermPostings()
+            for url, positions in sorted(postings.items(), key=lambda item: doc_ids[item[0]]):
+                term_postings.add(doc_ids[url], sorted(positions))
+                inverted_index._add_length(doc_ids[url], len(positions))
+        return inverted_index
@@ -0,0 +1,89 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import urlsplit, urlencode
+
+from fixture_site import VOCABULARY
+
+# Load test for server.py: `concurrency` clients, each on one keep-alive
+# connection, send /find requests for queries drawn from a list until `requests`
+# have been answered. Reports throughput and latency percentiles.
+DEFAULT_QUERIES = [word for word in VOCABULARY if len(word) > 3] + [
+    'love life', 'true friend', 'lov*', 'wisdm', 'heart of the world']
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of an unsorted list
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+
+async def _request(reader, writer, host, path):
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode('latin-1'))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+async def _client(host, port, paths, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while paths:
+            path = paths.pop()
+            start = time.perf_counter()
+            status, body = await _request(reader, writer, host, path)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append((path, status, body[:200]))
+    finally:
+        writer.close()
+
+async def run_load(base_url, queries=DEFAULT_QUERIES, requests=1000, concurrency=16, mode='phrase', seed=0):
+    # Returns {'requests', 'errors', 'seconds', 'qps', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms'}
+    address = urlsplit(base_url)
+    rng = random.Random(seed)
+    paths = ['/find?' + urlencode({'q': rng.choice(queries), 'mode': mode}) for _ in range(requests)]
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*(_client(address.hostname, address.port, paths, latencies, errors)
+                           for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    return {
+        'requests': len(latencies), 'errors': len(errors), 'seconds': round(seconds, 3),
+        'qps': round(len(latencies) / seconds, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p90_ms': round(percentile(latencies, 0.9) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'max_ms': round(max(latencies, default=0) * 1000, 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a running search server.")
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--mode', default='phrase', choices=('phrase', 'bm25', 'bool'))
+    parser.add_argument('--queries', help="file with one query per line (default: built-in list)")
+    parser.add_argument('--json', action='store_true', help="print the result as JSON")
+    args = parser.parse_args()
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+    result = asyncio.run(run_load(args.url, queries, args.requests, args.concurrency, args.mode))
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(f"{result['requests']} requests, {result['errors']} errors in {result['seconds']:.2f} s: "
+              f"{result['qps']:.1f} queries/s, p50 {result['p50_ms']:.2f} ms, p90 {result['p90_ms']:.2f} ms, "
+              f"p99 {result['p99_ms']:.2f} ms, max {result['max_ms']:.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+from bisect import bisect_left, bisect_right
+
+# Positional intersection over sorted, duplicate-free position lists. Lookups
+# gallop forward from the last match, so cost follows the shorter list.
+
+def gallop(positions, target, lo=0):
+    # Index of the first element >= target at or after lo
+    n = len(positions)
+    if lo >= n or positions[lo] >= target:
+        return lo
+    step = 1
+    while lo + step < n and positions[lo + step] < target:
+        lo += step
+        step *= 2
+    return bisect_left(positions, target, lo + 1, min(lo + step + 1, n))
+
+def intersect_shifted(first, second, shift):
+    # Elements p of first with p + shift in second
+    matches = []
+    if len(first) <= len(second):
+        j = 0
+        for p in first:
+            j = gallop(second, p + shift, j)
+            if j == len(second):
+                break
+            if second[j] == p + shift:
+                matches.append(p)
+    else:
+        i = 0
+        for q in second:
+            i = gallop(first, q - shift, i)
+            if i == len(first):
+                break
+            if first[i] == q - shift:
+                matches.append(first[i])
+    return matches
+
+def phrase_positions(position_lists, offsets=None):
+    # Start positions p with p + offsets[i] in position_lists[i] for every i
+    # (offsets default to 0, 1, 2, ...). The rarest word drives the intersection
+    # so frequent words are only probed.
+    if not position_lists or any(not positions for positions in position_lists):
+        return []
+    if offsets is None:
+        offsets = range(len(position_lists))
+    order = sorted(range(len(position_lists)), key=lambda i: len(position_lists[i]))
+    anchor = order[0]
+    # Candidates are expressed as phrase start positions
+    candidates = [p - offsets[anchor] for p in position_lists[anchor]]
+    for i in order[1:]:
+        candidates = intersect_shifted(candidates, position_lists[i], offsets[i])
+        if not candidates:
+            break
+    return candidates
+
+def pair_positions(first, second):
+    # Positions p of first with p + 1 in second
+    return intersect_shifted(first, second, 1)
+
+def proximity_positions(first, second, k, ordered=False):
+    # Positions p of first with some q in second where 0 < |q - p| <= k (or
+    # 0 < q - p <= k when ordered)
+    matches = []
+    lo = 0
+    for p in first:
+        lo = gallop(second, p - (0 if ordered else k), lo)
+        hi = bisect_right(second, p + k, lo)
+        for q in second[lo:hi]:
+            if q != p and (not ordered or q > p):
+                matches.append(p)
+                break
+    return matches
@@ -0,0 +1,299 @@
+import re
+
+from positional import gallop, intersect_shifted, phrase_positions, proximity_positions
+from tokenizer import term_positions
+
+# Boolean query language over the inverted index:
+#   query    := or_expr
+#   or_expr  := and_expr ('OR' and_expr)*
+#   and_expr := not_expr (['AND'] not_expr)*
+#   not_expr := 'NOT' not_expr | near_expr
+#   near     := primary ('NEAR/k' primary)*
+#   primary  := word | '"' phrase '"' | '(' or_expr ')'
+# Operators are case-insensitive; the words and/or/not are stopwords, so they are
+# never needed as search terms. Every node evaluates to a sorted list of doc IDs.
+
+class QuerySyntaxError(ValueError):
+    pass
+
+LEXER = re.compile(r'\s*(?:"([^"]*)"|(\()|(\))|near/(\d+)(?=[\s()"]|$)|([^\s()"]+))', re.IGNORECASE)
+
+def _postings(index, term):
+    postings = index.term_postings(term)
+    return postings if postings is not None and len(postings) else None
+
+def _intersect(first, second):
+    return intersect_shifted(first, second, 0)
+
+# Term, Phrase and Near are positional: doc_positions(index, candidates) returns
+# [(doc_id, positions)] for the matching docs, walking each postings list once.
+
+class Term:
+    def __init__(self, term):
+        self.term = term
+
+    def estimate(self, index):
+        return index.document_frequency(self.term)
+
+    def evaluate(self, index, candidates=None):
+        postings = _postings(index, self.term)
+        if postings is None:
+            return []
+        if candidates is None:
+            return list(postings.docs)
+        return _intersect(candidates, postings.docs)
+
+    def doc_positions(self, index, candidates=None):
+        postings = _postings(index, self.term)
+        if postings is None:
+            return []
+        if candidates is None:
+            return list(postings)
+        matches = []
+        docs = postings.docs
+        j = 0
+        for doc_id in candidates:
+            j = gallop(docs, doc_id, j)
+            if j == len(docs):
+                break
+            if docs[j] == doc_id:
+                matches.append((doc_id, postings.positions_of(j)))
+        return matches
+
+    def __repr__(self):
+        return f"Term({self.term!r})"
+
+class Phrase:
+    def __init__(self, terms, offsets):
+        self.terms = terms
+        self.offsets = offsets
+
+    def estimate(self, index):
+        return min(index.document_frequency(term) for term in self.terms)
+
+    def evaluate(self, index, candidates=None):
+        return [doc_id for doc_id, _ in self.doc_positions(index, candidates)]
+
+    def doc_positions(self, index, candidates=None):
+        # Docs holding every word first (rarest word first), then positions
+        docs = candidates
+        for term in sorted(set(self.terms), key=index.document_frequency):
+            docs = Term(term).evaluate(index, docs)
+            if not docs:
+                return []
+        columns = {term: [positions for _, positions in Term(term).doc_positions(index, docs)]
+                   for term in set(self.terms)}
+        matches = []
+        for i, doc_id in enumerate(docs):
+            positions = phrase_positions([columns[term][i] for term in self.terms], self.offsets)
+            if positions:
+                matches.append((doc_id, positions))
+        return matches
+
+    def __repr__(self):
+        return f"Phrase({' '.join(self.terms)!r})"
+
+class Near:
+    def __init__(self, left, right, distance):
+        self.left = left
+        self.right = right
+        self.distance = distance
+
+    def estimate(self, index):
+        return min(self.left.estimate(index), self.right.estimate(index))
+
+    def evaluate(self, index, candidates=None):
+        return [doc_id for doc_id, _ in self.doc_positions(index, candidates)]
+
+    def doc_positions(self, index, candidates=None):
+        first, second = sorted((self.left, self.right), key=lambda node: node.estimate(index))
+        docs = first.evaluate(index, candidates)
+        if docs:
+            docs = second.evaluate(index, docs)
+        if not docs:
+            return []
+        right = dict(self.right.doc_positions(index, docs))
+        matches = []
+        for doc_id, positions in self.left.doc_positions(index, docs):
+            positions = proximity_positions(positions, right[doc_id], self.distance)
+            if positions:
+                matches.append((doc_id, positions))
+        return matches
+
+    def __repr__(self):
+        return f"Near({self.left!r}, {self.right!r}, {self.distance})"
+
+class And:
+    def __init__(self, children):
+        self.children = children
+
+    def estimate(self, index):
+        positives = [child.estimate(index) for child in self.children if not isinstance(child, Not)]
+        return min(positives) if positives else len(index.urls)
+
+    def evaluate(self, index, candidates=None):
+        # Planner: positive operands from the smallest estimated result up, each one
+        # restricted to the docs that survived so far, then NOT operands subtract
+        positives = sorted((c for c in self.children if not isinstance(c, Not)), key=lambda c: c.estimate(index))
+        negatives = [c.child for c in self.children if isinstance(c, Not)]
+        docs = candidates
+        for child in positives:
+            docs = child.evaluate(index, docs)
+            if not docs:
+                return []
+        if docs is None:
+            docs = list(range(len(index.urls)))
+        for child in negatives:
+            excluded = set(child.evaluate(index, docs))
+            docs = [doc_id for doc_id in docs if doc_id not in excluded]
+        return docs
+
+    def __repr__(self):
+        return f"And({self.children!r})"
+
+class Or:
+    def __init__(self, children):
+        self.children = children
+
+    def estimate(self, index):
+        return min(sum(child.estimate(index) for child in self.children), len(index.urls))
+
+    def evaluate(self, index, candidates=None):
+        docs = set()
+        for child in self.children:
+            docs.update(child.evaluate(index, candidates))
+        return sorted(docs)
+
+    def __repr__(self):
+        return f"Or({self.children!r})"
+
+class Not:
+    def __init__(self, child):
+        self.child = child
+
+    def estimate(self, index):
+        return len(index.urls) - self.child.estimate(index)
+
+    def evaluate(self, index, candidates=None):
+        return And([self]).evaluate(index, candidates)
+
+    def __repr__(self):
+        return f"Not({self.child!r})"
+
+def tokenize_query(text):
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = LEXER.match(text, pos)
+        if match is None or match.end() == pos:
+            raise QuerySyntaxError(f"Unexpected input at '{text[pos:]}'")
+        phrase, lparen, rparen, distance, word = match.groups()
+        if phrase is not None:
+            tokens.append(('PHRASE', phrase))
+        elif lparen:
+            tokens.append(('(', None))
+        elif rparen:
+            tokens.append((')', None))
+        elif distance is not None:
+            tokens.append(('NEAR', int(distance)))
+        elif word.upper() in ('AND', 'OR', 'NOT'):
+            tokens.append((word.upper(), None))
+        else:
+            tokens.append(('WORD', word))
+        pos = match.end()
+    return tokens
+
+def _text_node(text):
+    # A word or quoted phrase becomes a Term, or a Phrase when it tokenizes into
+    # several indexed terms (e.g. "don't" -> do n't); positions keep their gaps
+    terms = list(term_positions(text))
+    if not terms:
+        return None
+    if len(terms) == 1:
+        return Term(terms[0][1])
+    first = terms[0][0]
+    return Phrase([term for _, term in terms], [position - first for position, _ in terms])
+
+class _Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.i = 0
+
+    def peek(self):
+        return self.tokens[self.i][0] if self.i < len(self.tokens) else None
+
+    def take(self):
+        token = self.tokens[self.i]
+        self.i += 1
+        return token
+
+    def parse(self):
+        node = self.or_expr()
+        if self.peek() is not None:
+            raise QuerySyntaxError(f"Unexpected '{self.tokens[self.i][1] or self.peek()}'")
+        if node is None:
+            raise QuerySyntaxError("Query has no searchable terms")
+        return node
+
+    def or_expr(self):
+        children = [self.and_expr()]
+        while self.peek() == 'OR':
+            self.take()
+            children.append(self.and_expr())
+        children = [child for child in children if child is not None]
+        if not children:
+            return None
+        return children[0] if len(children) == 1 else Or(children)
+
+    def and_expr(self):
+        children = [self.not_expr()]
+        while self.peek() in ('AND', 'NOT', 'WORD', 'PHRASE', '('):
+            if self.peek() == 'AND':
+                self.take()
+            children.append(self.not_expr())
+        children = [child for child in children if child is not None]
+        if not children:
+            return None
+        return children[0] if len(children) == 1 else And(children)
+
+    def not_expr(self):
+        if self.peek() == 'NOT':
+            self.take()
+            child = self.not_expr()
+            return Not(child) if child is not None else None
+        return self.near_expr()
+
+    def near_expr(self):
+        node = self.primary()
+        while self.peek() == 'NEAR':
+            _, distance = self.take()
+            right = self.primary()
+            if node is None or right is None:
+                raise QuerySyntaxError("NEAR needs a word or phrase on each side")
+            if not hasattr(node, 'doc_positions') or not hasattr(right, 'doc_positions'):
+                raise QuerySyntaxError("NEAR only combines words and phrases")
+            node = Near(node, right, distance)
+        return node
+
+    def primary(self):
+        kind = self.peek()
+        if kind is None:
+            raise QuerySyntaxError("Query ends unexpectedly")
+        kind, value = self.take()
+        if kind in ('WORD', 'PHRASE'):
+            return _text_node(value)
+        if kind == '(':
+            node = self.or_expr()
+            if self.peek() != ')':
+                raise QuerySyntaxError("Missing ')'")
+            self.take()
+            return node
+        raise QuerySyntaxError(f"Unexpected '{value if value is not None else kind}'")
+
+def parse_query(text):
+    return _Parser(tokenize_query(text)).parse()
+
+def evaluate_query(text, index):
+    # Returns the sorted doc IDs matching a query string
+    return parse_query(text).evaluate(index)
@@ -0,0 +1,102 @@
+import heapq
+import math
+
+from positional import gallop
+
+K1 = 1.2
+B = 0.75
+
+def bm25_idf(doc_count, doc_freq):
+    return math.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+
+class _TermCursor:
+    __slots__ = ('docs', 'starts', 'positions', 'idf', 'upper_bound', 'i')
+
+    def __init__(self, postings, idf, k1):
+        self.docs = postings.docs
+        self.starts = postings.starts
+        self.positions = postings.positions
+        self.idf = idf
+        # tf / (tf + K) < 1 for any tf and length, so idf * (k1 + 1) bounds the term
+        self.upper_bound = idf * (k1 + 1)
+        self.i = 0
+
+    def tf(self, i):
+        end = self.starts[i + 1] if i + 1 < len(self.starts) else len(self.positions)
+        return end - self.starts[i]
+
+def bm25_top_k(terms, index, k=10, k1=K1, b=B, doc_count=None, avg_length=None, doc_freqs=None):
+    # Returns up to k (url, score) pairs, best first. Uses MaxScore: terms are
+    # ordered by their score upper bound, and once the k-th best score exceeds the
+    # summed bounds of the weakest terms those terms can no longer introduce a
+    # result, so they are only probed for documents found through the others.
+    # doc_count, avg_length and doc_freqs ({term: document frequency}) default to
+    # the index's own; a shard is given those of the whole collection, so its
+    # scores are the ones the unsharded index would give.
+    if len(index.doc_lengths) != len(index.urls):
+        b = 0  # Index written without document lengths
+    doc_lengths = index.doc_lengths
+    if doc_count is None:
+        doc_count = len(index.urls)
+    if avg_length is None:
+        avg_length = index.average_doc_length()
+    avg_length = avg_length or 1
+    doc_freqs = doc_freqs or {}
+
+    cursors = []
+    for term in dict.fromkeys(terms):
+        postings = index.term_postings(term)
+        if postings is not None and len(postings):
+            idf = bm25_idf(doc_count, doc_freqs.get(term, len(postings)))
+            cursors.append(_TermCursor(postings, idf, k1))
+    if not cursors or k <= 0:
+        return []
+    cursors.sort(key=lambda cursor: cursor.upper_bound)
+
+    # bounds[i] = sum of upper bounds of cursors[0..i]
+    bounds = []
+    total = 0
+    for cursor in cursors:
+        total += cursor.upper_bound
+        bounds.append(total)
+
+    def score(cursor, i, doc_id):
+        tf = cursor.tf(i)
+        norm = k1 * (1 - b + b * doc_lengths[doc_id] / avg_length) if b else k1
+        return cursor.idf * tf * (k1 + 1) / (tf + norm)
+
+    heap = []
+    threshold = 0
+    first_essential = 0
+    while True:
+        if len(heap) == k:
+            while first_essential < len(cursors) and bounds[first_essential] <= threshold:
+                first_essential += 1
+        essential = [c for c in cursors[first_essential:] if c.i < len(c.docs)]
+        if not essential:
+            break
+
+        doc_id = min(c.docs[c.i] for c in essential)
+        doc_score = 0
+        for cursor in essential:
+            if cursor.docs[cursor.i] == doc_id:
+                doc_score += score(cursor, cursor.i, doc_id)
+                cursor.i += 1
+
+        for j in range(first_essential - 1, -1, -1):
+            if doc_score + bounds[j] <= threshold:
+                break
+            cursor = cursors[j]
+            cursor.i = gallop(cursor.docs, doc_id, cursor.i)
+            if cursor.i < len(cursor.docs) and cursor.docs[cursor.i] == doc_id:
+                doc_score += score(cursor, cursor.i, doc_id)
+
+        if len(heap) < k:
+            heapq.heappush(heap, (doc_score, -doc_id))
+        elif doc_score > threshold:
+            heapq.heapreplace(heap, (doc_score, -doc_id))
+        if len(heap) == k:
+            threshold = heap[0][0]
+
+    results = sorted(heap, key=lambda item: (-item[0], -item[1]))
+    return [(index.urls[-neg_doc_id], doc_score) for doc_score, neg_doc_id in results]
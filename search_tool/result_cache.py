@@ -0,0 +1,56 @@
+import threading
+from collections import OrderedDict
+
+# Least-recently-used cache of query results with a size bound. An entry costs 1
+# plus the size its caller gives it (e.g. the pages of a result), and the least
+# recently used entries are dropped while the total is over capacity, so a few
+# huge results cannot take the room of many small ones. An entry costing more than
+# the whole capacity is not kept; a capacity of 0 disables the cache.
+CAPACITY = 20000
+
+class ResultCache:
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.cost = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, cost), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=0):
+        cost = 1 + size
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.cost -= previous[1]
+            if cost > self.capacity:
+                return
+            self._entries[key] = (value, cost)
+            self.cost += cost
+            while self.cost > self.capacity:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.cost -= evicted
+
+    def clear(self):
+        # Drops every entry; the hit and miss counts are kept
+        with self._lock:
+            self._entries.clear()
+            self.cost = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self._entries), 'cost': self.cost, 'capacity': self.capacity,
+                'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
@@ -1,112 +1,449 @@
-import time
-import requests
-from bs4 import BeautifulSoup
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 import json
 import os
-from urllib.parse import urljoin, urlparse, urldefrag
-import nltk
-nltk.download('stopwords')
-nltk.download('punkt')
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-
-STOP_WORDS = set(stopwords.words('english'))
-
-def normalize_url(url):
-    url = urldefrag(url)[0]
-    parsed_url = urlparse(url)
-    normalized_url = f"{parsed_url.scheme}://{parsed_url.netloc}{parsed_url.path}"
-    if normalized_url.endswith('/'):
-        normalized_url = normalized_url[:-1]
-    return normalized_url
-
-def clean_text(text):
-    return ' '.join(text.split())
-
-def crawl_website(start_url, delay=0, existing_urls=None):
-    if existing_urls is None:
-        existing_urls = set()
-    urls_to_crawl = [start_url]
-    crawled_urls = set(existing_urls)
-    page_contents = []
-
-    while urls_to_crawl:
-        url = urls_to_crawl.pop(0)
-        normalized_url = normalize_url(url)
-        if normalized_url in crawled_urls:
-            continue
-
-        print(f"Crawling URL: {url}")
-
-        response = requests.get(url)
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            text = soup.get_text(separator=' ')
-            cleaned_text = clean_text(text)
-            if cleaned_text:
-                page_contents.append((normalized_url, cleaned_text))
-
-            crawled_urls.add(normalized_url)
-            for link in soup.find_all('a'):
-                new_url = link.get('href')
-                if new_url:
-                    new_url = urljoin(start_url, new_url)
-                    normalized_new_url = normalize_url(new_url)
-                    if normalized_new_url not in crawled_urls and urlparse(new_url).netloc == urlparse(start_url).netloc:
-                        urls_to_crawl.append(new_url)
-
-            time.sleep(delay)
+import resource
+import tempfile
+from tokenizer import STOP_WORDS, tokenize, term_positions, token_spans
+from crawler import crawl_website, crawl_pages, CrawlMetadata, CrawlJournal
+from index_format import write_index, read_index, is_binary_index, convert_json_index, LazyIndex
+from inverted_index import InvertedIndex
+from positional import phrase_positions, pair_positions
+from ranking import bm25_top_k
+from query import evaluate_query, QuerySyntaxError
+from segments import SegmentedIndex
+from dedupe import DuplicateDetector, filter_duplicates
+from docstore import encode_document, snippet
+from termdict import is_wildcard
+from spimi import SpimiBuilder
+from result_cache import ResultCache
+
+TOKENIZER = 'regex'  # or 'nltk' to tokenize with nltk.word_tokenize
+HTML_BACKEND = 'html.parser'  # or 'lxml' when installed
+CRAWL_WORKERS = 8
+CRAWL_PER_HOST = 4
+BUILD_WORKERS = os.cpu_count() or 1
+TOP_K = 10
+# Near-duplicate pages: 'alias' indexes one canonical copy and lists the others
+# with it in results, 'skip' drops them, 'index' indexes every page
+DUPLICATES = 'alias'
+DUPLICATE_SIMILARITY = 0.9  # Fraction of equal SimHash bits
+INDEX_FILE = 'index.bin'
+JSON_INDEX_FILE = 'index.json'
+INDEX_DIR = 'segments'
+CRAWL_META_FILE = 'crawl_meta.json'
+CRAWL_JOURNAL_FILE = 'crawl.journal'
+SNIPPET_WIDTH = 8  # Words of context on each side of a highlighted match
+HIGHLIGHT = ('**', '**')
+WILDCARD_LIMIT = 50  # Terms a `prefix*` or `*suffix` word expands to at most
+SUGGESTIONS = 3  # Closest vocabulary terms searched for a word missing from the index
+QUERY_CACHE_SIZE = 20000  # Result pages of find queries kept in RESULT_CACHE; 0 disables it
+BUILD_MEMORY_BUDGET = None  # Bytes; set to build segments out of core (SPIMI) within this budget
+
+# Results of find queries on segmented indexes, by words and index generation
+RESULT_CACHE = ResultCache(QUERY_CACHE_SIZE)
+
+def index_documents(page_contents, tokenizer=TOKENIZER, documents=None, inverted_index=None):
+    # With documents (a DocStoreWriter or a list), each page's text and token
+    # offsets are also appended as a document store block, in doc ID order.
+    # Pages are added to inverted_index (e.g. a SpimiBuilder) when given.
+    if inverted_index is None:
+        inverted_index = InvertedIndex()
+
+    for url, content in page_contents:
+        positions = defaultdict(list)
+        if documents is None:
+            for position, word in term_positions(content, tokenizer):
+                positions[word].append(position)
         else:
-            print(f"Failed to retrieve URL: {url} with status code: {response.status_code}")
+            spans = []
+            for position, (token, start, end) in enumerate(token_spans(content, tokenizer)):
+                spans.append((start, end))
+                if token.isalnum():
+                    positions[token].append(position)
+            # Offsets index the lowercased text; keep it if lowercasing changed the length
+            lowered = content.lower()
+            documents.append(encode_document(content if len(lowered) == len(content) else lowered, spans))
+        inverted_index.add_document(url, positions)
 
-    return page_contents
+    return inverted_index
 
-def build_inverted_index(page_contents):
-    inverted_index = defaultdict(lambda: defaultdict(list))
+def _index_chunk(chunk, tokenizer, store_documents):
+    blocks = [] if store_documents else None
+    return index_documents(chunk, tokenizer, blocks), blocks
 
-    for url, content in page_contents:
-        words = word_tokenize(content.lower())
-        for position, word in enumerate(words):
-            if word.isalnum():  # Ensure the word is alphanumeric
-                inverted_index[word][url].append(position)
+def build_inverted_index(page_contents, workers=1, chunk_size=32, tokenizer=TOKENIZER, documents=None,
+                         memory_budget=None, file_path=None):
+    # With memory_budget (bytes), the index is built out of core into file_path
+    # and returned as a LazyIndex: postings beyond the budget are spilled to sorted
+    # runs that are merged at the end. URLs must then be distinct.
+    target = SpimiBuilder(file_path, memory_budget) if memory_budget else None
+    try:
+        if workers > 1:
+            inverted_index = parallel_index_documents(page_contents, workers, chunk_size, tokenizer, documents, target)
+        else:
+            inverted_index = index_documents(page_contents, tokenizer, documents, target)
+    except BaseException:
+        if target is not None:
+            target.discard()
+        raise
+    if target is not None:
+        print(f"Merging {target.run_count} sorted runs into {file_path}...")
+        inverted_index = target.finish()
 
     print(f"Built inverted index with {len(inverted_index)} unique words.")
     return inverted_index
 
+def parallel_index_documents(page_contents, workers, chunk_size=32, tokenizer=TOKENIZER, documents=None,
+                             inverted_index=None):
+    # Tokenizes consecutive chunks of pages in worker processes and merges the
+    # partial indexes in chunk order, which gives the same index as index_documents.
+    # At most two chunks per worker are in flight, so a streaming input is not
+    # read arbitrarily far ahead.
+    if inverted_index is None:
+        inverted_index = InvertedIndex()
+    pending = deque()
+    pages = iter(page_contents)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            chunk = list(islice(pages, chunk_size))
+            if chunk:
+                pending.append(executor.submit(_index_chunk, chunk, tokenizer, documents is not None))
+            if pending and (not chunk or len(pending) >= workers * 2):
+                partial_index, blocks = pending.popleft().result()
+                inverted_index.merge(partial_index)
+                for block in blocks or ():
+                    documents.append(block)
+            if not chunk and not pending:
+                break
+
+    return inverted_index
+
+def stream_build_index(start_url, existing_urls=None, metadata=None, journal=None, detector=None,
+                       duplicates=None, fingerprints=None, documents=None, file_path=None, outcomes=None):
+    # Tokenizes each page as soon as the crawler yields it, so indexing overlaps
+    # with fetches still in flight and page text is never held for the whole corpus.
+    # With a DuplicateDetector, near-duplicate pages are left out and recorded in
+    # duplicates. Page texts go to documents (a DocStoreWriter) when given. With
+    # BUILD_MEMORY_BUDGET set, the index is built out of core into file_path.
+    # outcomes receives the fetch outcome of every crawled URL (see crawl_pages).
+    indexed_urls = set()
+
+    def counted(pages):
+        for url, content in pages:
+            indexed_urls.add(url)
+            yield url, content
+
+    pages = crawl_pages(start_url, delay=0, existing_urls=existing_urls,
+                        max_workers=CRAWL_WORKERS, max_per_host=CRAWL_PER_HOST, metadata=metadata,
+                        extractor=HTML_BACKEND, journal=journal, outcomes=outcomes)
+    if detector is not None:
+        pages = filter_duplicates(pages, detector, duplicates, fingerprints)
+    index = build_inverted_index(counted(pages), workers=BUILD_WORKERS, documents=documents,
+                                 memory_budget=BUILD_MEMORY_BUDGET, file_path=file_path)
+    return index, len(indexed_urls)
+
+def build_index(start_url, resume=False, segments=None):
+    # Recrawls the site into a new segment of segments, the open index, or of
+    # INDEX_DIR opened here. Every page is revisited with a
+    # conditional request and only new and changed pages are indexed; their old
+    # copies are replaced, and removed pages are deleted (see removed_pages).
+    # Crawled pages are journaled until the segment is saved, so an interrupted
+    # build can be resumed without fetching them again.
+    print("Starting the build process...")
+    if segments is None:
+        segments, load_message, success = open_segments()
+        print(load_message if success else "Starting a fresh build...")
+    journal = CrawlJournal(CRAWL_JOURNAL_FILE)
+    if resume and not journal.exists():
+        print("No interrupted build to resume; starting a new one.")
+    elif not resume:
+        journal.discard()
+
+    metadata = CrawlMetadata.load(CRAWL_META_FILE)
+    metadata.retain(list(segments.urls) + list(segments.aliases))
+    detector = duplicates = fingerprints = None
+    if DUPLICATES != 'index':
+        # Seeded with the fingerprints of indexed pages, so a new page is also
+        # compared with pages from earlier builds
+        detector, duplicates, fingerprints = DuplicateDetector(DUPLICATE_SIMILARITY), {}, {}
+        for url in segments.urls:
+            fingerprint = metadata.pages.get(url, {}).get('simhash')
+            if fingerprint is not None:
+                detector.add(url, fingerprint)
+    documents = segments.document_writer()
+    outcomes = {}
+    try:
+        new_index, page_count = stream_build_index(start_url, metadata=metadata, journal=journal, detector=detector,
+                                                   duplicates=duplicates, fingerprints=fingerprints,
+                                                   documents=documents, file_path=segments.pending_index_path(),
+                                                   outcomes=outcomes)
+    except BaseException:
+        documents.discard()
+        raise
+    finally:
+        journal.close()
+    for url, fingerprint in (fingerprints or {}).items():
+        metadata.pages.setdefault(url, {})['simhash'] = fingerprint
+    if duplicates:
+        print(f"{'Aliased' if DUPLICATES == 'alias' else 'Skipped'} {len(duplicates)} near-duplicate pages.")
+    if not page_count and not (duplicates and DUPLICATES == 'alias'):
+        documents.discard()
+        if isinstance(new_index, LazyIndex):
+            os.remove(new_index.file_path)
+        print("No new or changed pages found. Index remains unchanged.")
+    else:
+        segments.add_documents(new_index, aliases=duplicates if DUPLICATES == 'alias' else None,
+                               documents=documents)
+        print(f"Indexed {page_count} pages.")
+    removed = removed_pages(list(segments.urls) + list(segments.aliases), outcomes)
+    if removed:
+        # Near-duplicates of a removed page go with it; forgetting their crawl
+        # metadata gets them indexed on their own by the next build
+        removed |= {url for url, canonical in segments.aliases.items() if canonical in removed}
+        segments.delete(removed)
+        metadata.retain(list(segments.urls) + list(segments.aliases))
+        print(f"Removed {len(removed)} pages that are gone or no longer linked.")
+    # Saved after the segment, so a page is never recorded as seen but not indexed
+    metadata.save(CRAWL_META_FILE)
+    journal.discard()
+    return segments
+
+def removed_pages(indexed_urls, outcomes):
+    # The indexed URLs a finished crawl found removed: answered 404 or 410, or
+    # no longer reached from the start page. After a failed fetch the pages only
+    # it linked to were not reached either, so then only gone pages count.
+    if 'failed' in outcomes.values():
+        return {url for url in indexed_urls if outcomes.get(url) == 'gone'}
+    return {url for url in indexed_urls if outcomes.get(url) != 'ok'}
+
+def peak_rss_mb():
+    # VmHWM is the peak of this process image only; ru_maxrss survives exec on Linux.
+    # Both are reported in kilobytes.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
 def save_index(index, file_path):
-    with open(file_path, 'w') as f:
-        json.dump(index, f)
+    # .json paths keep the legacy JSON format; anything else gets the binary format
+    if file_path.endswith('.json'):
+        with open(file_path, 'w') as f:
+            json.dump(index.to_dict(), f)
+    else:
+        write_index(index, file_path)
     print(f"Inverted index saved to {file_path}")
 
 def load_index(file_path):
     if not os.path.exists(file_path):
-        return defaultdict(lambda: defaultdict(list)), "Initialized empty index", False
+        return InvertedIndex(), "Initialized empty index", False
     
     try:
+        if is_binary_index(file_path):
+            return read_index(file_path), "Loaded successfully!", True
         with open(file_path, 'r') as f:
-            index = json.load(f, object_hook=lambda d: defaultdict(list, d))
+            index = InvertedIndex.from_dict(json.load(f))
             return index, "Loaded successfully!", True
-    except (json.JSONDecodeError, ValueError) as e:
+    except (json.JSONDecodeError, ValueError, IndexError) as e:
         clear_index(file_path)
-        return defaultdict(lambda: defaultdict(list)), "Failed to load; initialized new index", False
+        return InvertedIndex(), "Failed to load; initialized new index", False
 
-def merge_indices(existing_index, new_index):
-    for word, urls in new_index.items():
-        for url, positions in urls.items():
-            existing_index[word][url].extend(positions)
-    return existing_index
+def open_index(file_path, cache_size=1024):
+    # Memory-maps a binary index for querying; JSON and missing files go through load_index
+    if not os.path.exists(file_path) or not is_binary_index(file_path):
+        return load_index(file_path)
+    try:
+        return LazyIndex(file_path, cache_size), "Loaded successfully!", True
+    except (ValueError, IndexError):
+        clear_index(file_path)
+        return InvertedIndex(), "Failed to load; initialized new index", False
 
-def find_pages(phrase, index):
-    words = word_tokenize(phrase.lower())
+def open_segments(directory=INDEX_DIR, legacy_file=INDEX_FILE):
+    # Opens the segmented index; the first time, an existing single-file index
+    # becomes its first segment
+    try:
+        if not SegmentedIndex.exists(directory) and os.path.exists(legacy_file):
+            legacy_index, _, success = load_index(legacy_file)
+            segments = SegmentedIndex(directory)
+            if success:
+                segments.add_documents(legacy_index, background=False)
+                return segments, f"Imported {legacy_file} into {directory}", True
+            return segments, "Initialized empty index", False
+        if not SegmentedIndex.exists(directory):
+            return SegmentedIndex(directory), "Initialized empty index", False
+        return SegmentedIndex(directory), "Loaded successfully!", True
+    except (OSError, json.JSONDecodeError, KeyError, ValueError, IndexError) as e:
+        SegmentedIndex.clear(directory)
+        print(f"Cleared the index in {directory}: {e}")
+        return SegmentedIndex(directory), "Failed to load; initialized new index", False
+
+def page_aliases(url, index):
+    # Segmented and sharded indexes record near-duplicate pages
+    return index.aliases_of(url) if hasattr(index, 'aliases_of') else []
+
+def page_label(url, index):
+    aliases = page_aliases(url, index)
+    return f"{url} (also at {', '.join(aliases)})" if aliases else url
+
+def page_snippet(url, index, words, matches=()):
+    # Highlighted text around the page's first match, from the document store of a
+    # segmented or sharded index. matches are (token position, token count) pairs,
+    # e.g. phrase occurrences; every token equal to one of words is highlighted as well.
+    document = index.document(url) if hasattr(index, 'document') else None
+    if document is None:
+        return ''
+    text, spans = document
+    words = set(words)
+    matches = list(matches)
+    # Tokens are only compared with words up to the end of the snippet window,
+    # which follows the first match
+    first = min(matches, key=lambda match: (match[0], -match[1])) if matches else None
+    end = min(first[0] + first[1] + SNIPPET_WIDTH, len(spans)) if first else len(spans)
+    position = 0
+    while position < end:
+        start, stop = spans[position]
+        if text[start:stop].lower() in words:
+            if first is None or position < first[0]:
+                first = (position, 1)
+                end = min(position + 1 + SNIPPET_WIDTH, len(spans))
+            matches.append((position, 1))
+        position += 1
+    return snippet(text, spans, matches, SNIPPET_WIDTH, HIGHLIGHT)
+
+def snippet_line(url, index, words, matches=()):
+    text = page_snippet(url, index, words, matches)
+    return f"    ├── {text}\n" if text else ''
+
+def query_words(phrase):
+    # Lowercased tokens of phrase; wildcard words such as lov* are kept whole
+    phrase = phrase.lower()
+    if not is_wildcard(phrase):
+        return tokenize(phrase, TOKENIZER)
+    words = []
+    for chunk in phrase.split():
+        words.extend([chunk] if is_wildcard(chunk) else tokenize(chunk, TOKENIZER))
+    return words
+
+def similar_terms(word, index, limit=SUGGESTIONS):
+    # Index terms at the smallest edit distance from word (within fuzzy.max_edits),
+    # most frequent first
+    matches = [(distance, term) for distance, term in index.term_dictionary().fuzzy().search(word)
+               if term in index]
+    closest = [term for distance, term in matches if distance == matches[0][0]] if matches else []
+    return sorted(closest, key=lambda term: (-index.document_frequency(term), term))[:limit]
+
+def expand_query(words, index, report=print):
+    # {word: index terms it stands for} for a find query. A word missing from the
+    # index is replaced by its closest terms, with a "did you mean" line passed to
+    # report. Raises ValueError for a bare '*'.
+    expansions = {word: expand_terms(word, index, report=report) for word in words}
+    corrections = {}
+    for word in words:
+        if not is_wildcard(word) and word not in index:
+            expansions[word] = similar_terms(word, index)
+            if expansions[word]:
+                corrections[word] = expansions[word][0]
+    if corrections:
+        searched = ', '.join(f"{word} -> {' / '.join(expansions[word])}" for word in corrections)
+        report(f"Did you mean '{' '.join(corrections.get(word, word) for word in words)}'? Searching for {searched}.")
+    return expansions
+
+def expand_terms(word, index, limit=WILDCARD_LIMIT, report=print):
+    # The index terms a wildcard word stands for, from the sorted term dictionary;
+    # any other word stands for itself. Raises ValueError for a bare '*'.
+    if not is_wildcard(word):
+        return [word]
+    terms = [term for term in index.term_dictionary().expand(word, limit + 1) if term in index]
+    if len(terms) > limit:
+        report(f"'{word}' matches more than {limit} terms; using the first {limit}.")
+        terms = terms[:limit]
+    return terms
+
+def phrase_words(phrase, report=print):
+    # The words of a find query without stop words, or None, after reporting why,
+    # when there is nothing to search for
+    words = query_words(phrase)
     if all(word in STOP_WORDS for word in words):
-        print(f"No pages found containing only stop words.")
-        return
+        report(f"No pages found containing only stop words.")
+        return None
 
     valid_words = [word for word in words if word not in STOP_WORDS]
     if not valid_words:
-        print(f"No pages found containing the phrase '{phrase}'.")
-        return
+        report(f"No pages found containing the phrase '{phrase}'.")
+        return None
+    return valid_words
+
+def phrase_query(phrase, index, report=print, valid_words=None):
+    # (words, {word: index terms it stands for}) of a find query, or None, after
+    # reporting why, when there is nothing to search for
+    if valid_words is None:
+        valid_words = phrase_words(phrase, report)
+        if valid_words is None:
+            return None
+    try:
+        return valid_words, expand_query(valid_words, index, report)
+    except ValueError as e:
+        report(str(e))
+        return None
+
+def phrase_order(item):
+    # Sort key of a (url, data) phrase result: most occurrences, then earliest
+    _, data = item
+    return (-data['phrase_count'], min(data['phrase_positions']), -data['count'],
+            min(pos for positions in data['positions'].values() for pos in positions))
+
+def word_order(item):
+    # Sort key of a (url, data) individual word result
+    _, data = item
+    return (-data['count'], min(pos for positions in data['positions'].values() for pos in positions))
+
+def match_phrase(phrase, index, report=print, query=None):
+    # The pages of a find query: {'words', 'terms' (every index term searched),
+    # 'phrase', 'consecutive', 'individual'}, each result list holding sorted
+    # (url, data) pairs. Returns None, after reporting why, when there is nothing
+    # to search for. query, from phrase_query, may be resolved beforehand (e.g.
+    # over every shard of a sharded index).
+    # Otherwise the results of an index with a generation (a segmented index) are
+    # kept in RESULT_CACHE under its words and generation, together with the
+    # notes passed to report, which a cache hit repeats. Cached results are
+    # shared, so callers must not change them.
+    if query is not None:
+        return _match_query(*query, index)
+    valid_words = phrase_words(phrase, report)
+    if valid_words is None:
+        return None
+    generation = getattr(index, 'generation', None)
+    key = (generation, tuple(valid_words))
+    if generation is not None:
+        cached = RESULT_CACHE.get(key)
+        if cached is not None:
+            notes, matches = cached
+            for note in notes:
+                report(note)
+            return matches
+    notes = []
+
+    def record(note):
+        notes.append(note)
+        report(note)
+
+    query = phrase_query(phrase, index, record, valid_words)
+    if query is None:
+        return None
+    matches = _match_query(*query, index)
+    if generation is not None:
+        RESULT_CACHE.put(key, (notes, matches),
+                         len(matches['phrase']) + len(matches['consecutive']) + len(matches['individual']))
+    return matches
+
+def _match_query(valid_words, expansions, index):
+    highlighted = [term for terms in expansions.values() for term in terms]
 
     page_scores = defaultdict(lambda: {
         'count': 0,
@@ -119,9 +456,12 @@ def find_pages(phrase, index):
     })
 
     # Populate the page_scores with positions and counts
+    # A wildcard or misspelled word counts the positions of every term it stands for
     for word in valid_words:
-        if word in index:
-            for url, positions in index[word].items():
+        for term in expansions[word]:
+            if term not in index:
+                continue
+            for url, positions in index.postings(term):
                 page_scores[url]['count'] += len(positions)
                 page_scores[url]['positions'][word].extend(positions)
                 page_scores[url]['individual_counts'][word] += len(positions)
@@ -129,41 +469,21 @@ def find_pages(phrase, index):
     # Function to count the occurrences of the phrase and consecutive pairs
     def count_phrase_occurrences(page_scores, word_count):
         for url, data in page_scores.items():
-            word_positions = [sorted(data['positions'][word]) for word in valid_words]
+            word_positions = [sorted(set(data['positions'][word])) for word in valid_words]
             if any(len(pos) == 0 for pos in word_positions):
                 continue
 
-            phrase_positions = []
-            pos_indices = [0] * word_count
-
-            while True:
-                current_positions = [word_positions[i][pos_indices[i]] for i in range(word_count)]
-                if all((current_positions[0] + i) == current_positions[i] for i in range(word_count)):
-                    phrase_positions.append(current_positions[0])
-                    for i in range(word_count):
-                        pos_indices[i] += 1
-                        if pos_indices[i] >= len(word_positions[i]):
-                            pos_indices[i] = float('inf')
-
-                min_pos = min(current_positions)
-                min_index = current_positions.index(min_pos)
-                pos_indices[min_index] += 1
-
-                if any(pos_indices[i] >= len(word_positions[i]) for i in range(word_count)):
-                    break
+            positions = phrase_positions(word_positions)
 
-            data['phrase_count'] = len(phrase_positions)
-            data['phrase_positions'] = phrase_positions
+            data['phrase_count'] = len(positions)
+            data['phrase_positions'] = positions
 
             # Count consecutive word pairs
             for i in range(word_count - 1):
-                pair_positions = []
-                for pos in word_positions[i]:
-                    if (pos + 1) in word_positions[i + 1]:
-                        pair_positions.append(pos)
+                positions = pair_positions(word_positions[i], word_positions[i + 1])
                 pair = f"{valid_words[i]} {valid_words[i + 1]}"
-                data['consecutive_counts'][pair] = len(pair_positions)
-                data['consecutive_positions'][pair] = pair_positions
+                data['consecutive_counts'][pair] = len(positions)
+                data['consecutive_positions'][pair] = positions
 
     count_phrase_occurrences(page_scores, len(valid_words))
 
@@ -180,52 +500,166 @@ def find_pages(phrase, index):
         if data['count'] > 0:
             individual_results.append((url, data))
 
-    # Sort and print phrase results
-    if phrase_results:
-        phrase_results.sort(key=lambda item: (
-            -item[1]['phrase_count'],
-            min(item[1]['phrase_positions']),
-            -item[1]['count'],
-            min([pos for positions in item[1]['positions'].values() for pos in positions])
-        ))
+    # Sort phrase and individual results; pages with the phrase are not repeated
+    phrase_results.sort(key=phrase_order)
+    individual_results.sort(key=word_order)
+    phrase_pages = {url for url, _ in phrase_results}
+    individual_results = [(url, data) for url, data in individual_results if url not in phrase_pages]
+    return {'words': valid_words, 'terms': highlighted, 'phrase': phrase_results,
+            'consecutive': consecutive_results,
+            'individual': individual_results}
+
+def find_pages(phrase, index):
+    matches = match_phrase(phrase, index)
+    if matches is not None:
+        print_matches(phrase, matches, index)
+
+def print_matches(phrase, matches, index):
+    valid_words = matches['words']
+
+    # Print phrase results
+    if matches['phrase']:
         print(f"Pages containing '{phrase}':")
-        for page, data in phrase_results:
-            print(f"  - {page}\n    │\n    └──('{phrase}' count: {data['phrase_count']}, positions: {data['phrase_positions']})\n")
+        for page, data in matches['phrase']:
+            phrase_matches = [(position, len(valid_words)) for position in data['phrase_positions']]
+            print(f"  - {page_label(page, index)}\n    │\n{snippet_line(page, index, (), phrase_matches)}    └──('{phrase}' count: {data['phrase_count']}, positions: {data['phrase_positions']})\n")
 
-    # Sort and print consecutive results
-    if consecutive_results and len(valid_words) >= 3:
+    # Print consecutive results
+    if matches['consecutive']:
         print(f"\nPages containing phrases from '{phrase}':")
-        for page, data in consecutive_results:
+        for page, data in matches['consecutive']:
             for pair, count in data['consecutive_counts'].items():
                 if count > 0:
-                    print(f"  - {page}\n    │\n    └──('{pair}' count: {count}, positions: {data['consecutive_positions'][pair]})\n")
-
-    # Sort and print individual word results
-    if individual_results:
-        individual_results.sort(key=lambda item: (
-            -item[1]['count'],
-            min([pos for positions in item[1]['positions'].values() for pos in positions])
-        ))
+                    print(f"  - {page_label(page, index)}\n    │\n    └──('{pair}' count: {count}, positions: {data['consecutive_positions'][pair]})\n")
+
+    # Print individual word results
+    if matches['individual']:
         print(f"\nPages containing individual words from '{phrase}':")
-        for page, data in individual_results:
-            if any(page == result[0] for result in phrase_results):
-                continue
-            if data['count'] > 0:
-                word_count_details = ", ".join([f"{word}: {data['individual_counts'][word]}, positions: {data['positions'][word]}" for word in valid_words])
-                print(f"  - {page}\n    │\n    └──(total count: {data['count']}, {word_count_details})\n")
+        for page, data in matches['individual']:
+            word_count_details = ", ".join([f"{word}: {data['individual_counts'][word]}, positions: {data['positions'][word]}" for word in valid_words])
+            print(f"  - {page_label(page, index)}\n    │\n{snippet_line(page, index, matches['terms'])}    └──(total count: {data['count']}, {word_count_details})\n")
+
+def query_terms(phrase, index, report=print):
+    # Index terms to rank a phrase by; raises ValueError for a bare '*'
+    words = [word for word in query_words(phrase) if word not in STOP_WORDS]
+    return [term for word_terms in expand_query(words, index, report).values()
+            for term in word_terms if term.isalnum()]
+
+def rank_pages(phrase, index, k=TOP_K):
+    try:
+        terms = query_terms(phrase, index)
+    except ValueError as e:
+        print(e)
+        return
+    results = bm25_top_k(terms, index, k) if terms else []
+    print_ranking(phrase, terms, results, index)
+
+def print_ranking(phrase, terms, results, index):
+    if not results:
+        print(f"No pages found containing the phrase '{phrase}'.")
+        return
+
+    print(f"Top {len(results)} pages for '{phrase}' (BM25):")
+    for rank, (page, score) in enumerate(results, 1):
+        print(f"  {rank}. {page_label(page, index)}\n    │\n{snippet_line(page, index, terms)}    └──(score: {score:.3f})\n")
+
+def boolean_search(expression, index):
+    try:
+        doc_ids = evaluate_query(expression, index)
+    except QuerySyntaxError as e:
+        print(f"Invalid query: {e}")
+        return
+    print_boolean(expression, [index.urls[doc_id] for doc_id in doc_ids], index)
+
+def print_boolean(expression, urls, index):
+    if not urls:
+        print(f"No pages found matching '{expression}'.")
+        return
+
+    print(f"Pages matching '{expression}' ({len(urls)}):")
+    for url in urls:
+        print(f"  - {page_label(url, index)}")
+
+def search_results(text, index, mode='phrase', k=TOP_K, snippets=True):
+    # Structured results of a find query, ready for JSON: {'query', 'mode', 'notes'}
+    # and, in phrase mode, 'phrase_results', 'pair_results' and 'word_results', or
+    # 'results' in bm25 and bool mode. Each list is cut to its first k pages, with
+    # 'totals' giving the full counts. Raises ValueError for an unknown mode or an
+    # invalid query.
+    notes = []
+    body = {'query': text, 'mode': mode, 'notes': notes}
+
+    def page(url, highlight=(), matches=(), **fields):
+        entry = dict(url=url, aliases=page_aliases(url, index), **fields)
+        if snippets:
+            entry['snippet'] = page_snippet(url, index, highlight, matches)
+        return entry
+
+    if mode == 'phrase':
+        # Cached results are shared, so missing words are read with get
+        matches = match_phrase(text, index, notes.append) or {
+            'words': [], 'terms': [], 'phrase': [], 'consecutive': [], 'individual': []}
+        length = len(matches['words'])
+        pairs = [(url, data, pair, count) for url, data in matches['consecutive']
+                 for pair, count in data['consecutive_counts'].items() if count]
+        body['totals'] = {'phrase_results': len(matches['phrase']), 'pair_results': len(pairs),
+                          'word_results': len(matches['individual'])}
+        body['phrase_results'] = [
+            page(url, (), [(p, length) for p in data['phrase_positions']], count=data['phrase_count'],
+                 positions=data['phrase_positions'])
+            for url, data in matches['phrase'][:k]]
+        body['pair_results'] = [
+            {'url': url, 'pair': pair, 'count': count, 'positions': data['consecutive_positions'][pair]}
+            for url, data, pair, count in pairs[:k]]
+        body['word_results'] = [
+            page(url, matches['terms'], count=data['count'],
+                 words={word: {'count': data['individual_counts'].get(word, 0),
+                               'positions': data['positions'].get(word, [])}
+                        for word in matches['words']})
+            for url, data in matches['individual'][:k]]
+    elif mode == 'bm25':
+        terms = query_terms(text, index, notes.append)
+        results = bm25_top_k(terms, index, k) if terms else []
+        body['results'] = [page(url, terms, score=score) for url, score in results]
+    elif mode == 'bool':
+        try:
+            doc_ids = evaluate_query(text, index)
+        except QuerySyntaxError as e:
+            raise ValueError(f"Invalid query: {e}")
+        body['totals'] = {'results': len(doc_ids)}
+        body['results'] = [dict(url=index.urls[doc_id], aliases=page_aliases(index.urls[doc_id], index))
+                           for doc_id in doc_ids[:k]]
+    else:
+        raise ValueError(f"Unknown mode '{mode}'; use phrase, bm25 or bool")
+    return body
+
+def index_entries(word, index):
+    # (url, positions) of a term, sorted by count and position
+    entries = [(url, list(positions)) for url, positions in index.postings(word)]
+    return sorted(entries, key=lambda item: (-len(item[1]), item[1][0]))
 
 def print_index(word, index):
     word = word.lower()
+    if is_wildcard(word):
+        try:
+            terms = expand_terms(word, index)
+        except ValueError as e:
+            print(e)
+            return
+        if not terms:
+            print(f"No terms match '{word}'.")
+        for term in terms:
+            print_index(term, index)
+        return
     if word in index:
         print(f"Inverted index for '{word}':")
-        
-        # Extract and sort entries by count and position
-        entries = [(url, positions) for url, positions in index[word].items()]
-        sorted_entries = sorted(entries, key=lambda item: (-len(item[1]), item[1][0]))
-
-        for url, positions in sorted_entries:
+        for url, positions in index_entries(word, index):
             print(f"  - {url}\n    (count: {len(positions)}, positions: {positions})")
     else:
+        suggestions = similar_terms(word, index) if word.isalnum() else []
+        if suggestions:
+            print(f"No entries found for '{word}'. Did you mean {' or '.join(suggestions)}?")
+            return
         print(f"No entries found for '{word}'. The 'print' command only supports single words, not phrases. Use 'find' for phrases.")
 
 def clear_index(file_path):
@@ -235,63 +669,78 @@ def clear_index(file_path):
 
 def print_usage():
     print("Available commands:")
-    print("  build             - Crawl the website, build the index, and save it to index.json.")
-    print("  load              - Load the index from index.json.")
-    print("  print <word>      - Print the inverted index for a specific word. (Single words only)")
-    print("  find <phrase>     - Find pages containing the specified phrase.")
+    print(f"  build             - Recrawl the website and add new or changed pages as a segment in {INDEX_DIR}/.")
+    print("  build --resume    - Continue a build that was interrupted, without refetching its pages.")
+    print(f"  load              - Load the segmented index from {INDEX_DIR}/ (imports {INDEX_FILE} on first use).")
+    print(f"  convert           - Convert a legacy {JSON_INDEX_FILE} index to {INDEX_FILE}.")
+    print("  print <word>      - Print the inverted index for a specific word, or for lov*, *ness. (Single words only)")
+    print("  find <phrase>     - Find pages containing the specified phrase; words may be lov* or *ness.")
+    print(f"  find --bm25 <phrase> - Rank pages for the phrase with BM25 and show the top {TOP_K}.")
+    print('  find --bool <query>  - Boolean search, e.g. love and (life or "true friend") not death, truth near/3 lie.')
+    print("  cache             - Show the hits, misses and size of the find query cache.")
     print("  exit              - Exit the program.")
 
-def test_crawl_and_index():
-    start_url = "https://quotes.toscrape.com"
+def test_crawl_and_index(page_count=214):
+    # Crawls a generated site served on localhost, so it runs offline; see
+    # benchmark.py suite for timings of each stage
+    from fixture_site import generate_site, serve_site
+    site = generate_site(pages=page_count)
     print("Starting the build process...")
-    index_file = 'index.json'
-    clear_index(index_file)
-
-    pages = crawl_website(start_url, delay=0)
-    index = build_inverted_index(pages)
-    save_index(index, index_file)
-
-    unique_urls = {url for url, _ in pages}
-    expected_page_count = 214
-    assert len(unique_urls) == expected_page_count, f"Expected {expected_page_count} pages, but got {len(unique_urls)}"
+    with tempfile.TemporaryDirectory() as tmp:
+        index_file = os.path.join(tmp, INDEX_FILE)
+        with serve_site(site) as start_url:
+            pages = crawl_website(start_url, delay=0)
+        index = build_inverted_index(pages)
+        save_index(index, index_file)
+
+        unique_urls = {url for url, _ in pages}
+        expected_page_count = len(site)
+        assert len(unique_urls) == expected_page_count, f"Expected {expected_page_count} pages, but got {len(unique_urls)}"
+        loaded, _, success = load_index(index_file)
+        assert success and sorted(loaded.urls) == sorted(unique_urls)
 
     print(f"Indexed {len(unique_urls)} pages.")
 
 def main():
     index = None
-    index_file = 'index.json'
+    index_file = INDEX_FILE
 
     print_usage()
 
     while True:
         command = input("\nEnter a command: ").strip().lower()
 
-        if command == 'build':
-            start_url = "https://quotes.toscrape.com"
-            print("Starting the build process...")
-            existing_index, load_message, success = load_index(index_file)
-            if success:
-                print(load_message)
-                existing_urls = {url for urls in existing_index.values() for url in urls}
-                pages = crawl_website(start_url, delay=0, existing_urls=existing_urls)
-                if not pages:
-                    print("No new pages found. Index remains unchanged.")
-                else:
-                    new_index = build_inverted_index(pages)
-                    index = merge_indices(existing_index, new_index)
-                    save_index(index, index_file)
-                    unique_urls = {url for url, _ in pages}
-                    print(f"Indexed {len(unique_urls)} pages.")
-            else:
-                print("Starting a fresh build...")
-                pages = crawl_website(start_url, delay=0)
-                index = build_inverted_index(pages)
-                save_index(index, index_file)
-                unique_urls = {url for url, _ in pages}
-                print(f"Indexed {len(unique_urls)} pages.")
+        if command.startswith('build'):
+            options = command.split()[1:]
+            if options not in ([], ['--resume']):
+                print("Usage: build [--resume]")
+                continue
+            # One writable index per process: the open one is built into, so a
+            # second instance never removes its merge's files or reuses its names
+            writable = index if isinstance(index, SegmentedIndex) else None
+            try:
+                index = build_index("https://quotes.toscrape.com", resume=bool(options), segments=writable)
+            except KeyboardInterrupt:
+                print("\nBuild interrupted. Use 'build --resume' to continue it.")
+                continue
+            print(f"Peak RSS: {peak_rss_mb():.1f} MB")
+            # Entries of the previous generation can no longer be hit
+            RESULT_CACHE.clear()
         elif command == 'load':
-            index, message, _ = load_index(index_file)
+            # The index is reopened from disk once its background merge is done
+            if isinstance(index, SegmentedIndex):
+                index.wait()
+            index, message, _ = open_segments()
+            RESULT_CACHE.clear()
+            # Vocabulary indexes for wildcard and typo-tolerant lookups
+            index.term_dictionary().fuzzy()
             print(message)
+        elif command == 'convert':
+            if not os.path.exists(JSON_INDEX_FILE):
+                print(f"No {JSON_INDEX_FILE} found to convert.")
+                continue
+            convert_json_index(JSON_INDEX_FILE, index_file)
+            print(f"Converted {JSON_INDEX_FILE} to {index_file}.")
         elif command.startswith('print'):
             if index is None:
                 print("Index not loaded. Use 'load' command first.")
@@ -307,10 +756,23 @@ def main():
                 continue
             try:
                 _, phrase = command.split(maxsplit=1)
-                find_pages(phrase, index)
+                if phrase.startswith('--bm25'):
+                    _, phrase = phrase.split(maxsplit=1)
+                    rank_pages(phrase, index)
+                elif phrase.startswith('--bool'):
+                    _, expression = phrase.split(maxsplit=1)
+                    boolean_search(expression, index)
+                else:
+                    find_pages(phrase, index)
             except ValueError:
                 print("Usage: find <phrase>")
+        elif command == 'cache':
+            stats = RESULT_CACHE.stats()
+            print(f"Query cache: {stats['entries']} queries, {stats['cost']}/{stats['capacity']} pages, "
+                  f"{stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)")
         elif command == 'exit':
+            if isinstance(index, SegmentedIndex):
+                index.wait()
             print("Exiting the program.")
             break
         else:
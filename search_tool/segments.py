@@ -0,0 +1,512 @@
+import fnmatch
+import heapq
+import json
+import mmap
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from itertools import count
+
+from index_format import (write_index, read_header, read_doc_table, iter_term_dict, decode_varints, decode_postings,
+                          append_postings, encode_postings_body, IndexWriter, LazyIndex)
+from docstore import DocStore, DocStoreWriter
+from inverted_index import TermPostings
+from termdict import TermDictionary
+
+MANIFEST = 'manifest.json'
+MERGE_FACTOR = 4  # Adjacent segments of one size tier merged together
+# Files this module writes into the directory; only these are ever removed from it
+OWN_FILES = ('segment-*.bin', 'segment-*.docs', 'pending.*', '*.tmp')
+
+# An index kept as immutable binary segments (index_format files) in a directory,
+# listed oldest first in a manifest together with each segment's tombstones: the
+# URLs whose copy in that segment was deleted or replaced by a newer segment. A
+# build only writes its new pages as a segment, so its cost follows the number of
+# changed pages. Adjacent segments of similar size are merged in the background.
+
+_generations = count(1)
+
+def docs_name(name):
+    # Document store file of a segment
+    return os.path.splitext(name)[0] + '.docs'
+
+def size_tier(doc_count, merge_factor=MERGE_FACTOR):
+    tier = 0
+    while doc_count >= merge_factor:
+        doc_count //= merge_factor
+        tier += 1
+    return tier
+
+class SegmentView:
+    # Read-only snapshot of the live documents of a list of segments, with the same
+    # accessors as InvertedIndex. Doc IDs number the live documents segment by
+    # segment, so merging adjacent segments in order leaves them unchanged.
+    # generation identifies the documents the view holds: it is new for each view
+    # opened in this process, except one that only merged segments, so results
+    # cached for a generation (see search.RESULT_CACHE) stay valid until it changes.
+    # Safe to query from several threads.
+    def __init__(self, readers, tombstones, cache_size=1024, stores=None, generation=None):
+        self.readers = readers
+        self.generation = next(_generations) if generation is None else generation
+        self.stores = stores or [None] * len(readers)  # DocStore per segment, if it has one
+        self.urls = []
+        self.doc_lengths = array('I')
+        self.doc_maps = []  # Per segment: local doc ID -> view doc ID, or -1 when deleted
+        self.offsets = []  # Per segment without deletions: view doc ID of its doc 0
+        for reader, deleted in zip(readers, tombstones):
+            self.offsets.append(None if deleted.intersection(reader.urls) else len(self.urls))
+            doc_map = array('i')
+            for url, length in zip(reader.urls, reader.doc_lengths):
+                if url in deleted:
+                    doc_map.append(-1)
+                else:
+                    doc_map.append(len(self.urls))
+                    self.urls.append(url)
+                    self.doc_lengths.append(length)
+            self.doc_maps.append(doc_map)
+        self.total_length = sum(self.doc_lengths)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._terms = None
+        self._dictionary = None
+        self._locations = None
+
+    def document(self, url):
+        # (text, token spans) of a live document, or None without a document store
+        if self._locations is None:
+            # url -> (segment, local doc ID), built on first use and only then
+            # published, so a concurrent query never sees part of it
+            locations = {}
+            for segment, (reader, doc_map) in enumerate(zip(self.readers, self.doc_maps)):
+                for local_id, doc_id in enumerate(doc_map):
+                    if doc_id >= 0:
+                        locations[reader.urls[local_id]] = (segment, local_id)
+            self._locations = locations
+        location = self._locations.get(url)
+        if location is None or self.stores[location[0]] is None:
+            return None
+        segment, local_id = location
+        return self.stores[segment].document(local_id)
+
+    def term_postings(self, term):
+        with self._cache_lock:
+            postings = self._cache.get(term)
+            if postings is not None:
+                self._cache.move_to_end(term)
+                return postings
+        postings = TermPostings()
+        for reader, doc_map, offset in zip(self.readers, self.doc_maps, self.offsets):
+            segment_postings = reader.term_postings(term)
+            if segment_postings is None:
+                continue
+            if offset is not None:
+                base = len(postings.positions)
+                postings.docs.extend(doc_id + offset for doc_id in segment_postings.docs)
+                postings.starts.extend(start + base for start in segment_postings.starts)
+                postings.positions.extend(segment_postings.positions)
+                continue
+            for i, doc_id in enumerate(segment_postings.docs):
+                if doc_map[doc_id] >= 0:
+                    postings.add(doc_map[doc_id], segment_postings.positions_of(i))
+        if not len(postings):
+            return None
+        with self._cache_lock:
+            self._cache[term] = postings
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return postings
+
+    def postings(self, term):
+        postings = self.term_postings(term)
+        if postings is None:
+            return []
+        return [(self.urls[doc_id], positions) for doc_id, positions in postings]
+
+    def average_doc_length(self):
+        return self.total_length / len(self.urls) if self.urls else 0
+
+    def document_frequency(self, term):
+        postings = self.term_postings(term)
+        return len(postings) if postings is not None else 0
+
+    def _term_set(self):
+        # Terms of every segment; a term whose documents were all deleted is kept
+        # until its segment is merged
+        if self._terms is None:
+            terms = set()
+            for reader in self.readers:
+                terms.update(reader.terms)
+            self._terms = terms
+        return self._terms
+
+    def term_dictionary(self):
+        # Like _term_set, it may list terms whose documents were all deleted
+        if self._dictionary is None:
+            self._dictionary = TermDictionary.merged([reader.term_dictionary() for reader in self.readers])
+        return self._dictionary
+
+    def __contains__(self, term):
+        return term in self._term_set() and self.term_postings(term) is not None
+
+    def __iter__(self):
+        return iter(sorted(self._term_set()))
+
+    def __len__(self):
+        return len(self._term_set())
+
+class SegmentedIndex:
+    def __init__(self, directory, merge_factor=MERGE_FACTOR, cache_size=1024, read_only=False):
+        # read_only opens the current manifest for querying alongside a process
+        # that builds into the directory: files the manifest does not list yet are
+        # left alone, and the index cannot be changed
+        self.directory = directory
+        self.read_only = read_only
+        self.merge_factor = merge_factor
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._merge_thread = None
+        self._readers = {}
+        self._stores = {}
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        else:
+            manifest = {'next_segment': 0, 'segments': []}
+        self._next_segment = manifest['next_segment']
+        # {alias URL: canonical URL} for near-duplicate pages indexed only once
+        self.aliases = manifest.get('aliases', {})
+        self._alias_lists = None
+        # [{'name', 'docs', 'deleted': set of URLs, 'store': has a document store}],
+        # oldest first
+        self._segments = [dict(entry, deleted=set(entry['deleted'])) for entry in manifest['segments']]
+        if not read_only:
+            self._remove_orphans()
+        self.view = self._open_view()
+
+    @classmethod
+    def exists(cls, directory):
+        return os.path.exists(os.path.join(directory, MANIFEST))
+
+    @classmethod
+    def clear(cls, directory):
+        # Removes the manifest and segment files of a directory that failed to
+        # load; other files in it are kept
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            if name == MANIFEST or any(fnmatch.fnmatchcase(name, pattern) for pattern in OWN_FILES):
+                os.remove(os.path.join(directory, name))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _remove_orphans(self):
+        # Segment and temp files left by a build or merge that crashed before its
+        # manifest was written; other files in the directory are not touched
+        live = set()
+        for entry in self._segments:
+            live.add(entry['name'])
+            if entry.get('store'):
+                live.add(docs_name(entry['name']))
+        for name in os.listdir(self.directory):
+            if name not in live and any(fnmatch.fnmatchcase(name, pattern) for pattern in OWN_FILES):
+                os.remove(self._path(name))
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ValueError(f"Index {self.directory} is open read-only")
+
+    def _write_manifest(self):
+        manifest = {
+            'next_segment': self._next_segment,
+            'segments': [dict(entry, deleted=sorted(entry['deleted'])) for entry in self._segments],
+            'aliases': self.aliases,
+        }
+        temp_path = self._path(MANIFEST + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, self._path(MANIFEST))
+
+    def _open_view(self, generation=None):
+        readers = []
+        stores = []
+        for entry in self._segments:
+            name = entry['name']
+            if name not in self._readers:
+                self._readers[name] = LazyIndex(self._path(name), self.cache_size)
+                if entry.get('store'):
+                    self._stores[name] = DocStore(self._path(docs_name(name)))
+            readers.append(self._readers[name])
+            stores.append(self._stores.get(name))
+        names = {entry['name'] for entry in self._segments}
+        # Dropped readers are not closed: a query may still hold the previous view
+        self._readers = {name: reader for name, reader in self._readers.items() if name in names}
+        self._stores = {name: store for name, store in self._stores.items() if name in names}
+        return SegmentView(readers, [entry['deleted'] for entry in self._segments], self.cache_size, stores,
+                           generation)
+
+    def _new_segment_name(self):
+        # Called with the lock held. The name is reserved in the manifest before
+        # its file is written, and numbers another instance has reserved since
+        # this one was opened are skipped, so no two writers use the same name.
+        manifest_path = self._path(MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self._next_segment = max(self._next_segment, json.load(f)['next_segment'])
+        name = f"segment-{self._next_segment:06d}.bin"
+        self._next_segment += 1
+        self._write_manifest()
+        return name
+
+    def _tombstone(self, urls):
+        for entry, reader in zip(self._segments, self.view.readers):
+            stale = urls.intersection(reader.urls) - entry['deleted']
+            entry['deleted'] |= stale
+
+    def pending_index_path(self):
+        # Where an out-of-core build writes the index file for the next
+        # add_documents call, which then moves it into place as a segment
+        return self._path('pending.bin')
+
+    def document_writer(self):
+        # A DocStoreWriter for the pages of the next add_documents call
+        self._check_writable()
+        return DocStoreWriter(self._path('pending.docs'))
+
+    def add_documents(self, index, background=True, aliases=None, documents=None):
+        # Writes an InvertedIndex of new or re-crawled pages as the newest segment;
+        # older copies of its URLs are tombstoned. aliases ({URL: canonical URL})
+        # records near-duplicate pages, whose own older copies are tombstoned too.
+        # documents, a DocStoreWriter from document_writer holding the same pages
+        # in doc ID order, becomes the segment's document store.
+        self._check_writable()
+        aliases = aliases or {}
+        if documents is not None and (not index.urls or len(documents) != len(index.urls)):
+            documents.discard()
+            documents = None
+        written = isinstance(index, LazyIndex)  # Already written, by an out-of-core build
+        if written and not index.urls:
+            os.remove(index.file_path)
+        if not index.urls and not aliases:
+            return
+        name = None
+        if index.urls:
+            with self._lock:
+                name = self._new_segment_name()
+            if written:
+                os.replace(index.file_path, self._path(name))
+            else:
+                write_index(index, self._path(name))
+            if documents is not None:
+                documents.close(self._path(docs_name(name)))
+        with self._lock:
+            self._tombstone(set(index.urls) | set(aliases))
+            if name is not None:
+                self._segments.append({'name': name, 'docs': len(index.urls), 'deleted': set(),
+                                       'store': documents is not None})
+            self._set_aliases(index.urls, aliases)
+            self._write_manifest()
+            self.view = self._open_view()
+        self.maybe_merge(background)
+
+    def delete(self, urls):
+        self._check_writable()
+        with self._lock:
+            self._tombstone(set(urls))
+            self._set_aliases(urls, {})
+            self._write_manifest()
+            self.view = self._open_view()
+
+    def _set_aliases(self, removed, added):
+        for url in removed:
+            self.aliases.pop(url, None)
+        self.aliases.update(added)
+        self._alias_lists = None
+
+    def aliases_of(self, url):
+        # URLs recorded as near-duplicates of url
+        alias_lists = self._alias_lists
+        if alias_lists is None:
+            alias_lists = {}
+            for alias, canonical in self.aliases.items():
+                alias_lists.setdefault(canonical, []).append(alias)
+            self._alias_lists = alias_lists
+        return alias_lists.get(url, [])
+
+    def _plan_merge(self):
+        # First run of merge_factor adjacent segments in one size tier, counting
+        # live documents only
+        run = []
+        for entry in self._segments:
+            tier = size_tier(entry['docs'] - len(entry['deleted']), self.merge_factor)
+            if run and run[-1][1] != tier:
+                run = []
+            run.append((entry, tier))
+            if len(run) == self.merge_factor:
+                return [entry for entry, _ in run]
+        return None
+
+    def maybe_merge(self, background=True):
+        if self._merge_thread is not None and self._merge_thread.is_alive():
+            return
+        if background:
+            self._merge_thread = threading.Thread(target=self._merge_all, daemon=True)
+            self._merge_thread.start()
+        else:
+            self._merge_all()
+
+    def _merge_all(self):
+        while True:
+            with self._lock:
+                inputs = self._plan_merge()
+                if inputs is None:
+                    return
+                inputs = [(entry['name'], set(entry['deleted']), entry.get('store')) for entry in inputs]
+                name = self._new_segment_name()
+            self._merge(inputs, name)
+
+    def _merge(self, inputs, name):
+        # Streams the live documents of the inputs into one segment: their term
+        # dicts are k-way merged and each term's postings are concatenated in
+        # input order, as the encoded bytes when nothing in the input was deleted,
+        # else decoded, filtered and renumbered. Memory holds the doc tables and
+        # one term's postings, as in an out-of-core (SPIMI) build.
+        writer = IndexWriter(self._path(name))
+        files, maps, doc_maps, input_urls = [], [], [], []
+        live_count = 0
+        try:
+            for input_name, deleted, _ in inputs:
+                files.append(open(self._path(input_name), 'rb'))
+                maps.append(mmap.mmap(files[-1].fileno(), 0, access=mmap.ACCESS_READ))
+                version, doc_count, _, doc_table_offset, _ = read_header(maps[-1])
+                urls, doc_lengths = read_doc_table(maps[-1], doc_table_offset, doc_count, version)
+                input_urls.append(urls)
+                # Local doc ID -> merged doc ID, or -1 when deleted; None when
+                # nothing was, so the merged IDs are the local ones shifted
+                doc_map = array('i') if deleted.intersection(urls) else None
+                base = live_count
+                for url, length in zip(urls, doc_lengths):
+                    if doc_map is not None:
+                        doc_map.append(-1 if url in deleted else live_count)
+                    if url not in deleted:
+                        writer.add_document(url, length)
+                        live_count += 1
+                doc_maps.append(base if doc_map is None else doc_map)
+
+            def input_terms(position, data):
+                _, _, term_count, _, term_dict_offset = read_header(data)
+                for term, offset, length, _ in iter_term_dict(data, term_dict_offset, term_count):
+                    yield term, position, offset, length
+
+            entries = heapq.merge(*(input_terms(position, data) for position, data in enumerate(maps)))
+            term, doc_count, body, last_doc = None, 0, bytearray(), 0
+            for entry_term, position, offset, length in entries:
+                if entry_term != term:
+                    if doc_count:
+                        writer.add_encoded_term(term, doc_count, body)
+                    term, doc_count, body, last_doc = entry_term, 0, bytearray(), 0
+                data, doc_map = maps[position], doc_maps[position]
+                if isinstance(doc_map, int):
+                    count, last_doc = append_postings(data, offset, offset + length, doc_map, last_doc, body)
+                else:
+                    postings, _ = decode_postings(decode_varints(data, offset, offset + length))
+                    live = ((doc_map[doc_id], positions) for doc_id, positions in postings if doc_map[doc_id] >= 0)
+                    count, end_doc = encode_postings_body(live, last_doc, body)
+                    if count:
+                        last_doc = end_doc
+                doc_count += count
+            if doc_count:
+                writer.add_encoded_term(term, doc_count, body)
+            writer.close()
+        except BaseException:
+            writer.discard()
+            raise
+        finally:
+            for data in maps:
+                data.close()
+            for f in files:
+                f.close()
+
+        # The merged document store keeps the live blocks as they are, in the same
+        # order as the merged doc IDs; it is only written if every input has one
+        store = all(has_store for _, _, has_store in inputs)
+        if store:
+            writer = DocStoreWriter(self._path(docs_name(name)))
+            for (input_name, deleted, _), urls in zip(inputs, input_urls):
+                documents = DocStore(self._path(docs_name(input_name)))
+                for doc_id, url in enumerate(urls):
+                    if url not in deleted:
+                        writer.append(documents.block(doc_id))
+                documents.close()
+            writer.close()
+
+        with self._lock:
+            names = [input_name for input_name, _, _ in inputs]
+            position = [entry['name'] for entry in self._segments].index(names[0])
+            # Tombstones added to the inputs while they were being merged carry over
+            deleted = set()
+            for entry, (_, merged_deleted, _) in zip(self._segments[position:], inputs):
+                deleted |= entry['deleted'] - merged_deleted
+            self._segments[position:position + len(inputs)] = [
+                {'name': name, 'docs': live_count, 'deleted': deleted, 'store': store}]
+            self._write_manifest()
+            # The live documents are unchanged, so the generation is kept
+            self.view = self._open_view(self.view.generation)
+        for input_name, _, has_store in inputs:
+            os.remove(self._path(input_name))
+            if has_store:
+                os.remove(self._path(docs_name(input_name)))
+
+    def wait(self):
+        # Blocks until a background merge, if any, has finished
+        if self._merge_thread is not None:
+            self._merge_thread.join()
+
+    def segment_names(self):
+        return [entry['name'] for entry in self._segments]
+
+    # Index accessors read the current view; callers that make several calls for
+    # one query can hold on to `view` to keep a consistent snapshot
+    @property
+    def urls(self):
+        return self.view.urls
+
+    @property
+    def doc_lengths(self):
+        return self.view.doc_lengths
+
+    @property
+    def generation(self):
+        return self.view.generation
+
+    def term_postings(self, term):
+        return self.view.term_postings(term)
+
+    def postings(self, term):
+        return self.view.postings(term)
+
+    def average_doc_length(self):
+        return self.view.average_doc_length()
+
+    def document_frequency(self, term):
+        return self.view.document_frequency(term)
+
+    def term_dictionary(self):
+        return self.view.term_dictionary()
+
+    def __contains__(self, term):
+        return term in self.view
+
+    def __iter__(self):
+        return iter(self.view)
+
+    def __len__(self):
+        return len(self.view)
+
+    def document(self, url):
+        return self.view.document(url)
@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+
+from segments import SegmentedIndex, MANIFEST
+from search import (INDEX_DIR, TOP_K, RESULT_CACHE, search_results, expand_terms, similar_terms,
+                    index_entries)
+from termdict import is_wildcard
+
+# Search server: keeps the segmented index open and answers queries as JSON over
+# HTTP on localhost.
+#   GET  /find?q=<phrase>[&mode=phrase|bm25|bool][&k=10]   (k results per list, at most MAX_K)
+#   GET  /print?word=<word or wildcard>
+#   GET  /status
+#   POST /reload
+# The event loop reads and writes every connection concurrently, while queries
+# run one at a time on a query thread, so the index caches are never used by two
+# threads at once. The index is opened read-only. When a build writes a new
+# manifest, the new index is opened and warmed on another thread, then swapped in
+# between two queries; queries already running finish on the old one.
+HOST = '127.0.0.1'
+PORT = 8080
+RELOAD_INTERVAL = 2.0  # Seconds between checks for a newly built index
+MAX_K = 100  # Larger k are answered with this many results per list
+
+def _int_param(params, name, default):
+    try:
+        return int(params.get(name, default))
+    except ValueError:
+        raise ValueError(f"'{name}' must be an integer")
+
+def find_results(index, params):
+    # JSON body for /find; raises ValueError for an invalid query
+    text = params.get('q', '').strip()
+    if not text:
+        raise ValueError("Missing query parameter 'q'")
+    k = _int_param(params, 'k', TOP_K)
+    if k < 1:
+        raise ValueError("'k' must be at least 1")
+    return search_results(text, index, params.get('mode', 'phrase'), min(k, MAX_K))
+
+def print_results(index, params):
+    # JSON body for /print; raises ValueError for an invalid word
+    word = params.get('word', '').strip().lower()
+    if not word:
+        raise ValueError("Missing query parameter 'word'")
+    notes = []
+    terms = expand_terms(word, index, report=notes.append) if is_wildcard(word) else [word]
+    terms = [term for term in terms if term in index]
+    body = {'word': word, 'notes': notes, 'terms': [
+        {'term': term, 'entries': [{'url': url, 'count': len(positions), 'positions': positions}
+                                   for url, positions in index_entries(term, index)]}
+        for term in terms]}
+    if not terms and not is_wildcard(word) and word.isalnum():
+        body['suggestions'] = similar_terms(word, index)
+    return body
+
+class SearchServer:
+    ROUTES = {
+        ('GET', '/find'): find_results,
+        ('GET', '/print'): print_results,
+    }
+
+    def __init__(self, directory=INDEX_DIR, reload_interval=RELOAD_INTERVAL):
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self.index = None
+        self.manifest_mtime = None
+        self.loaded_at = None
+        self.queries = 0
+        self.reloads = 0
+        self._reloading = None
+        self._query_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='query')
+
+    def _manifest_mtime(self):
+        try:
+            return os.stat(os.path.join(self.directory, MANIFEST)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _open(self):
+        # Runs off the event loop; the manifest time is read first, so a build
+        # finishing while the index is opened is picked up by the next check
+        mtime = self._manifest_mtime()
+        index = SegmentedIndex(self.directory, read_only=True)
+        index.term_dictionary().fuzzy()
+        return index, mtime
+
+    async def reload(self):
+        # Opens the index on disk and swaps it in; concurrent calls share one load.
+        # On failure (e.g. a segment merged away while opening), the current index
+        # stays and the next check retries.
+        if self._reloading is None:
+            self._reloading = asyncio.ensure_future(self._reload())
+        try:
+            return await asyncio.shield(self._reloading)
+        finally:
+            self._reloading = None
+
+    async def _reload(self):
+        try:
+            index, mtime = await asyncio.get_running_loop().run_in_executor(None, self._open)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Reload of {self.directory} failed: {e}")
+            return False
+        self.index, self.manifest_mtime, self.loaded_at = index, mtime, time.time()
+        self.reloads += 1
+        # Results cached for the previous index are keyed by its generation and
+        # would only take room
+        RESULT_CACHE.clear()
+        print(f"Loaded {self.directory}: {len(index.urls)} pages in {len(index.segment_names())} segments")
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            if self._manifest_mtime() != self.manifest_mtime:
+                await self.reload()
+
+    def status(self):
+        index = self.index
+        return {'directory': self.directory, 'pages': len(index.urls), 'segments': index.segment_names(),
+                'loaded_at': self.loaded_at, 'reloads': self.reloads, 'queries': self.queries,
+                'cache': RESULT_CACHE.stats()}
+
+    async def dispatch(self, method, target):
+        # Returns (HTTPStatus, JSON body)
+        url = urlsplit(target)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if (method, url.path) == ('GET', '/status'):
+            return HTTPStatus.OK, self.status()
+        if (method, url.path) == ('POST', '/reload'):
+            loaded = await self.reload()
+            return (HTTPStatus.OK if loaded else HTTPStatus.SERVICE_UNAVAILABLE), self.status()
+        handler = self.ROUTES.get((method, url.path))
+        if handler is None:
+            if url.path in ('/find', '/print', '/status', '/reload'):
+                return HTTPStatus.METHOD_NOT_ALLOWED, {'error': f"{method} not allowed on {url.path}"}
+            return HTTPStatus.NOT_FOUND, {'error': f"No such endpoint {url.path}"}
+        self.queries += 1
+        # The index is taken once per query, so a swap never splits a query
+        index = self.index
+        try:
+            body = await asyncio.get_running_loop().run_in_executor(self._query_thread, handler, index, params)
+        except ValueError as e:
+            return HTTPStatus.BAD_REQUEST, {'error': str(e)}
+        except Exception as e:
+            print(f"Error answering {target}: {e!r}")
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {'error': 'Internal error'}
+        return HTTPStatus.OK, body
+
+    async def handle(self, reader, writer):
+        # One connection; HTTP/1.1 requests on it are answered in turn until the
+        # client closes it or asks to
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length') or 0)
+                if length:
+                    await reader.readexactly(length)
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    status, body, keep_alive = HTTPStatus.BAD_REQUEST, {'error': 'Malformed request'}, False
+                else:
+                    method, target, version = parts
+                    status, body = await self.dispatch(method, target)
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                payload = json.dumps(body).encode('utf-8')
+                writer.write(
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host=HOST, port=PORT):
+        # Loads the index and starts listening; returns the asyncio server
+        if not await self.reload():
+            raise OSError(f"Could not open the index in {self.directory}")
+        server = await asyncio.start_server(self.handle, host, port, backlog=256)
+        self._watcher = asyncio.ensure_future(self._watch())
+        return server
+
+    def close(self):
+        self._watcher.cancel()
+        self._query_thread.shutdown(wait=False)
+
+    async def serve(self, host=HOST, port=PORT):
+        server = await self.start(host, port)
+        print(f"Serving {self.directory} on http://{host}:{server.sockets[0].getsockname()[1]}")
+        async with server:
+            await server.serve_forever()
+
+@contextmanager
+def serve_in_background(directory=INDEX_DIR, reload_interval=RELOAD_INTERVAL):
+    # Runs a SearchServer on an ephemeral localhost port in a background thread and
+    # yields its base URL
+    loop = asyncio.new_event_loop()
+    search_server = SearchServer(directory, reload_interval)
+    server = loop.run_until_complete(search_server.start(HOST, 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://{HOST}:{server.sockets[0].getsockname()[1]}"
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        server.close()
+        search_server.close()
+        loop.run_until_complete(asyncio.gather(search_server._watcher, return_exceptions=True))
+        loop.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the search index over HTTP on localhost.")
+    parser.add_argument('--directory', default=INDEX_DIR, help=f"segmented index directory (default: {INDEX_DIR})")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--reload-interval', type=float, default=RELOAD_INTERVAL,
+                        help="seconds between checks for a newly built index")
+    args = parser.parse_args()
+    try:
+        asyncio.run(SearchServer(args.directory, args.reload_interval).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("\nServer stopped.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,432 @@
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import threading
+import zlib
+from heapq import merge
+from itertools import chain, islice
+from queue import Empty, Full
+
+from inverted_index import InvertedIndex
+from query import evaluate_query, QuerySyntaxError
+from ranking import bm25_top_k
+from segments import SegmentedIndex
+from spimi import SpimiBuilder
+from termdict import TermDictionary, is_wildcard
+from search import (INDEX_DIR, TOKENIZER, TOP_K, WILDCARD_LIMIT, STOP_WORDS, index_documents, query_words,
+                    phrase_query, match_phrase, phrase_order, word_order, query_terms, print_matches,
+                    print_ranking, print_boolean)
+
+# Index partitioned by document into shards: a page belongs to shard
+# crc32(url) % shard count, a segmented index of its own in the shard directory,
+# so a page is always re-indexed or deleted in the same shard. Shards are built in
+# parallel, one process each.
+#
+# ShardPool keeps each shard open in a worker process and answers a query by
+# scatter-gather. The query is expanded (wildcards, misspellings) in the
+# coordinator over the merged term dictionary of every shard, and the document
+# frequencies of its terms are summed over the shards, so every shard searches the
+# same terms and BM25 scores with collection-wide statistics. Each shard returns
+# its own top k of each result list, which are merged into the top k overall.
+SHARDS_FILE = 'shards.json'
+SHARD_DIR = 'shards'
+SHARDS = os.cpu_count() or 1
+CHUNK_SIZE = 32  # Pages per message to a shard's build process
+PENDING_CHUNKS = 4  # Messages queued per shard before the reader waits
+
+def shard_of(url, shard_count):
+    # crc32 rather than hash(), which differs between processes
+    return zlib.crc32(url.encode('utf-8')) % shard_count
+
+def shard_directory(directory, shard):
+    return os.path.join(directory, f"shard-{shard:03d}")
+
+def shard_count(directory):
+    # Number of shards of the sharded index in directory, or None if there is none
+    try:
+        with open(os.path.join(directory, SHARDS_FILE)) as f:
+            return json.load(f)['shards']
+    except FileNotFoundError:
+        return None
+
+def _build_shard(directory, shard, chunks, results, tokenizer, memory_budget, aliases):
+    # Build process of one shard: indexes the chunks of pages it is sent until
+    # None, then adds them to the shard as one segment
+    segments = documents = target = None
+    try:
+        segments = SegmentedIndex(directory)
+        documents = segments.document_writer()
+        target = SpimiBuilder(segments.pending_index_path(), memory_budget) if memory_budget else InvertedIndex()
+        added = 0
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            index_documents(chunk, tokenizer, documents, target)
+            added += len(chunk)
+        index = target.finish() if memory_budget else target
+        target = None
+        segments.add_documents(index, background=False, aliases=aliases, documents=documents)
+        results.put((shard, added, None))
+    except Exception as e:
+        if documents is not None:
+            documents.discard()
+        if isinstance(target, SpimiBuilder):
+            target.discard()
+        results.put((shard, None, f"{type(e).__name__}: {e}"))
+
+def _put(chunks, process, item):
+    # Waits for room in a shard's queue, unless its process has stopped
+    while True:
+        try:
+            chunks.put(item, timeout=0.5)
+            return
+        except Full:
+            if not process.is_alive():
+                raise RuntimeError(f"Build process of {process.name} stopped")
+
+def build_shards(page_contents, directory=SHARD_DIR, shards=None, tokenizer=TOKENIZER, memory_budget=None,
+                 aliases=None):
+    # Adds (url, content) pages to the sharded index in directory, which is created
+    # with `shards` shards (default: SHARDS) when it does not exist. Each shard's
+    # pages are indexed by a process of its own and become a new segment of the
+    # shard, with a document store; pages are read once and streamed to the
+    # processes. aliases ({URL: canonical URL}) are kept by the canonical page's
+    # shard. Returns the number of pages added to each shard.
+    count = shard_count(directory)
+    if count is not None and shards is not None and shards != count:
+        raise ValueError(f"{directory} already has {count} shards")
+    if count is None:
+        count = shards or SHARDS
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, SHARDS_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'shards': count}, f)
+        os.replace(path + '.tmp', path)
+    shard_aliases = [{} for _ in range(count)]
+    for alias, canonical in (aliases or {}).items():
+        shard_aliases[shard_of(canonical, count)][alias] = canonical
+
+    results = multiprocessing.Queue()
+    queues = [multiprocessing.Queue(PENDING_CHUNKS) for _ in range(count)]
+    processes = [multiprocessing.Process(target=_build_shard, name=f"shard {shard}",
+                                         args=(shard_directory(directory, shard), shard, queues[shard], results,
+                                               tokenizer, memory_budget, shard_aliases[shard]))
+                 for shard in range(count)]
+    for process in processes:
+        process.start()
+    try:
+        chunks = [[] for _ in range(count)]
+        for url, content in page_contents:
+            shard = shard_of(url, count)
+            chunks[shard].append((url, content))
+            if len(chunks[shard]) == CHUNK_SIZE:
+                _put(queues[shard], processes[shard], chunks[shard])
+                chunks[shard] = []
+        for shard in range(count):
+            if chunks[shard]:
+                _put(queues[shard], processes[shard], chunks[shard])
+            _put(queues[shard], processes[shard], None)
+
+        added, errors = [None] * count, []
+        while sum(result is not None for result in added) + len(errors) < count:
+            try:
+                shard, pages, error = results.get(timeout=0.5)
+            except Empty:
+                if any(process.exitcode not in (None, 0) for process in processes):
+                    raise RuntimeError("A shard build process stopped without a result")
+                continue
+            if error is None:
+                added[shard] = pages
+            else:
+                errors.append(f"shard {shard}: {error}")
+        if errors:
+            raise RuntimeError(f"Building {directory} failed: {'; '.join(errors)}")
+    except BaseException:
+        for process in processes:
+            process.terminate()
+        raise
+    finally:
+        for process in processes:
+            process.join()
+    return added
+
+def _open_shard(state, directory, cache_size):
+    # (sorted terms, doc count, total doc length) of the shard, reopened from disk
+    index = state['index'] = SegmentedIndex(directory, read_only=True, cache_size=cache_size)
+    return index.term_dictionary().terms, len(index.urls), index.view.total_length
+
+def _doc_freqs(state, terms):
+    index = state['index']
+    return [index.document_frequency(term) for term in terms]
+
+def _find_shard(state, phrase, query, k):
+    # The shard's top k of each find result list, and the full length of each
+    matches = match_phrase(phrase, state['index'], query=query)
+    totals = {name: len(matches[name]) for name in ('phrase', 'consecutive', 'individual')}
+    return dict(matches, totals=totals, **{name: matches[name][:k] for name in totals})
+
+def _rank_shard(state, terms, k, doc_count, avg_length, doc_freqs):
+    return bm25_top_k(terms, state['index'], k, doc_count=doc_count, avg_length=avg_length, doc_freqs=doc_freqs)
+
+def _match_shard(state, expression):
+    index = state['index']
+    return [index.urls[doc_id] for doc_id in evaluate_query(expression, index)]
+
+OPERATIONS = {
+    'open': _open_shard,
+    'doc_freqs': _doc_freqs,
+    'find': _find_shard,
+    'bm25': _rank_shard,
+    'bool': _match_shard,
+    'document': lambda state, url: state['index'].document(url),
+    'aliases': lambda state, url: state['index'].aliases_of(url),
+}
+
+def _serve_shard(connection):
+    # Worker process of one shard: answers (operation, args) requests with
+    # (True, result) or (False, exception) until it receives None
+    state = {}
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        operation, args = request
+        try:
+            answer = (True, OPERATIONS[operation](state, *args))
+        except Exception as e:
+            answer = (False, e)
+        try:
+            connection.send(answer)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            connection.send((False, RuntimeError(repr(answer[1]))))
+    connection.close()
+
+class CollectionTerms:
+    # Term lookups for search.expand_query over every shard of a pool: the merged
+    # term dictionary, and document frequencies summed over the shards, fetched
+    # once per term and batched by fetch()
+    def __init__(self, pool):
+        self.pool = pool
+        self.doc_freqs = {}
+
+    def fetch(self, terms):
+        missing = [term for term in dict.fromkeys(terms) if term not in self.doc_freqs]
+        if missing:
+            self.doc_freqs.update(self.pool.document_frequencies(missing))
+
+    def document_frequency(self, term):
+        self.fetch((term,))
+        return self.doc_freqs[term]
+
+    def term_dictionary(self):
+        return self.pool.dictionary
+
+    def __contains__(self, term):
+        return term in self.pool.dictionary and self.document_frequency(term) > 0
+
+class ShardPool:
+    # Worker processes with the shards of directory open, and the merged term
+    # dictionary. Queries from several threads are answered one at a time.
+    # Reads the index as it was when opened (or last reloaded).
+    def __init__(self, directory=SHARD_DIR, cache_size=1024):
+        count = shard_count(directory)
+        if count is None:
+            raise FileNotFoundError(f"No sharded index in {directory}")
+        self.directory = directory
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._connections = []
+        self._processes = []
+        for shard in range(count):
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve_shard, args=(child,), name=f"shard {shard}", daemon=True)
+            process.start()
+            child.close()
+            self._connections.append(connection)
+            self._processes.append(process)
+        try:
+            self.reload()
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._connections)
+
+    def _call(self, requests):
+        # {shard: (operation, args)}: sends every request before reading any
+        # answer, so the shards work in parallel; returns the results in the
+        # order of requests, or raises the first error
+        with self._lock:
+            for shard, request in requests.items():
+                self._connections[shard].send(request)
+            answers = [self._connections[shard].recv() for shard in requests]
+        for ok, value in answers:
+            if not ok:
+                raise value
+        return [value for _, value in answers]
+
+    def _scatter(self, operation, *args):
+        return self._call({shard: (operation, args) for shard in range(len(self))})
+
+    def reload(self):
+        # Reopens every shard, e.g. after build_shards added pages
+        opened = self._call({shard: ('open', (shard_directory(self.directory, shard), self.cache_size))
+                             for shard in range(len(self))})
+        self.dictionary = TermDictionary.merged([TermDictionary(terms) for terms, _, _ in opened])
+        self.doc_count = sum(doc_count for _, doc_count, _ in opened)
+        self.total_length = sum(total_length for _, _, total_length in opened)
+
+    def close(self):
+        for connection in self._connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+        for process in self._processes:
+            process.join()
+        self._connections, self._processes = [], []
+
+    def document_frequencies(self, terms):
+        # {term: document frequency over every shard}
+        terms = list(terms)
+        totals = dict.fromkeys(terms, 0)
+        for doc_freqs in self._scatter('doc_freqs', terms):
+            for term, doc_freq in zip(terms, doc_freqs):
+                totals[term] += doc_freq
+        return totals
+
+    def _collection_terms(self, words):
+        # CollectionTerms prefetched with every term expand_query may look up for
+        # words: themselves, their wildcard expansions, and the close spellings of
+        # words missing from the dictionary
+        terms = CollectionTerms(self)
+        candidates = []
+        for word in words:
+            if is_wildcard(word):
+                try:
+                    candidates.extend(self.dictionary.expand(word, WILDCARD_LIMIT + 1))
+                except ValueError:
+                    pass  # Reported by expand_query
+            else:
+                candidates.append(word)
+                if word not in self.dictionary:
+                    candidates.extend(term for _, term in self.dictionary.fuzzy().search(word))
+        terms.fetch(candidates)
+        return terms
+
+    def match_phrase(self, phrase, k=TOP_K, report=print):
+        # Like search.match_phrase, with each result list cut to its top k, and
+        # 'totals' giving the full length of each. The pages of 'consecutive' are
+        # listed shard by shard.
+        words = [word for word in query_words(phrase) if word not in STOP_WORDS]
+        query = phrase_query(phrase, self._collection_terms(words), report)
+        if query is None:
+            return None
+        partials = self._scatter('find', phrase, query, k)
+        return {
+            'words': partials[0]['words'], 'terms': partials[0]['terms'],
+            'totals': {name: sum(partial['totals'][name] for partial in partials)
+                       for name in ('phrase', 'consecutive', 'individual')},
+            'phrase': list(islice(merge(*(partial['phrase'] for partial in partials), key=phrase_order), k)),
+            'consecutive': list(islice(chain.from_iterable(partial['consecutive'] for partial in partials), k)),
+            'individual': list(islice(merge(*(partial['individual'] for partial in partials), key=word_order), k)),
+        }
+
+    def rank(self, phrase, k=TOP_K, report=print):
+        # (terms, up to k (url, score) pairs) of a BM25 query; raises ValueError
+        # for a bare '*'
+        words = [word for word in query_words(phrase) if word not in STOP_WORDS]
+        collection = self._collection_terms(words)
+        terms = query_terms(phrase, collection, report)
+        if not terms or not self.doc_count:
+            return terms, []
+        collection.fetch(terms)
+        doc_freqs = {term: collection.doc_freqs[term] for term in terms}
+        partials = self._scatter('bm25', terms, k, self.doc_count, self.total_length / self.doc_count, doc_freqs)
+        return terms, list(islice(merge(*partials, key=lambda result: -result[1]), k))
+
+    def match(self, expression):
+        # URLs matching a boolean query, shard by shard; raises QuerySyntaxError
+        return list(chain.from_iterable(self._scatter('bool', expression)))
+
+    # Single pages are read from the shard that holds them
+    def document(self, url):
+        return self._call({shard_of(url, len(self)): ('document', (url,))})[0]
+
+    def aliases_of(self, url):
+        return self._call({shard_of(url, len(self)): ('aliases', (url,))})[0]
+
+def split_index(segments, directory=SHARD_DIR, shards=None, tokenizer=TOKENIZER, memory_budget=None):
+    # Builds a sharded index from the pages of a segmented index, re-tokenized
+    # from its document stores; returns the number of pages left out because
+    # their segment has no document store
+    missing = []
+
+    def pages():
+        for url in segments.urls:
+            document = segments.document(url)
+            if document is None:
+                missing.append(url)
+            else:
+                yield url, document[0]
+
+    build_shards(pages(), directory, shards, tokenizer, memory_budget, segments.aliases)
+    return len(missing)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query a sharded index.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    split = commands.add_parser('split', help="shard the pages of a segmented index")
+    split.add_argument('--source', default=INDEX_DIR, help=f"segmented index directory (default: {INDEX_DIR})")
+    split.add_argument('--shards', type=int, default=None, help=f"number of shards (default: {SHARDS})")
+    split.add_argument('--directory', default=SHARD_DIR)
+    find = commands.add_parser('find', help="run a query on every shard and merge the results")
+    find.add_argument('--directory', default=SHARD_DIR)
+    find.add_argument('--mode', default='phrase', choices=('phrase', 'bm25', 'bool'))
+    find.add_argument('-k', type=int, default=TOP_K, help="results per list")
+    find.add_argument('query', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'split':
+        if not SegmentedIndex.exists(args.source):
+            parser.error(f"No segmented index in {args.source}")
+        missing = split_index(SegmentedIndex(args.source, read_only=True), args.directory, args.shards)
+        if missing:
+            print(f"Left out {missing} pages without a document store; rebuild them to shard them.")
+        print(f"Sharded {args.source} into {shard_count(args.directory)} shards in {args.directory}.")
+        return
+    text = ' '.join(args.query)
+    with ShardPool(args.directory) as pool:
+        if args.mode == 'phrase':
+            matches = pool.match_phrase(text, args.k)
+            if matches is not None:
+                print_matches(text, matches, pool)
+        elif args.mode == 'bm25':
+            try:
+                terms, results = pool.rank(text, args.k)
+            except ValueError as e:
+                print(e)
+                return
+            print_ranking(text, terms, results, pool)
+        else:
+            try:
+                print_boolean(text, pool.match(text), pool)
+            except QuerySyntaxError as e:
+                print(f"Invalid query: {e}")
+
+if __name__ == "__main__":
+    main()
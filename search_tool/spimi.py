@@ -0,0 +1,127 @@
+import heapq
+import mmap
+import os
+import tempfile
+
+from index_format import IndexWriter, write_index, read_header, iter_term_dict, append_postings, LazyIndex
+from inverted_index import InvertedIndex
+
+# Out-of-core index build (single-pass in-memory indexing, SPIMI). Documents are
+# indexed into an in-memory block until its estimated size reaches the memory
+# budget; the block is then written as a sorted run (an index_format file with
+# block-local doc IDs) and a new block is started. finish() k-way merges the runs
+# term by term into the final index file, so memory holds one block, or one
+# term's encoded postings and the term dict during the merge.
+MEMORY_BUDGET = 256 * 1024 * 1024  # Bytes per in-memory block
+
+# Estimated bytes of a block: per term (dict entry, string, TermPostings and its
+# three arrays), per (term, doc) posting (docs and starts entries) and per position.
+# Doc IDs and URLs go straight to the output file's spooled doc table.
+TERM_BYTES = 320
+POSTING_BYTES = 8
+POSITION_BYTES = 4
+
+def block_bytes(index):
+    # Estimated memory held by an InvertedIndex's postings
+    size = 0
+    for term, postings in index.terms.items():
+        size += TERM_BYTES + POSTING_BYTES * len(postings.docs) + POSITION_BYTES * len(postings.positions)
+    return size
+
+class SpimiBuilder:
+    # Takes documents like an InvertedIndex (add_document, or merge of partial
+    # indexes in doc order) and writes the index to file_path. Doc IDs are given
+    # in the order documents arrive; URLs must be distinct.
+    def __init__(self, file_path, memory_budget=MEMORY_BUDGET, temp_dir=None):
+        self.file_path = file_path
+        self.memory_budget = memory_budget
+        self._temp = tempfile.TemporaryDirectory(dir=temp_dir or os.path.dirname(os.path.abspath(file_path)))
+        self._runs = []  # (run file path, doc ID of its first document)
+        self._writer = IndexWriter(file_path)
+        self._doc_count = 0
+        self._new_block()
+
+    def _new_block(self):
+        self._block = InvertedIndex()
+        self._block_base = self._doc_count
+        self._block_size = 0
+
+    def add_document(self, url, term_positions):
+        term_count = len(self._block.terms)
+        self._block.add_document(url, term_positions)
+        length = self._block.doc_lengths[-1]
+        self._writer.add_document(url, length)
+        self._doc_count += 1
+        self._block_size += (TERM_BYTES * (len(self._block.terms) - term_count)
+                             + POSTING_BYTES * len(term_positions) + POSITION_BYTES * length)
+        self._maybe_spill()
+
+    def merge(self, other):
+        # Adds a partial InvertedIndex whose documents follow the ones added so far
+        self._block.merge(other)
+        for url, length in zip(other.urls, other.doc_lengths):
+            self._writer.add_document(url, length)
+        self._doc_count += len(other.urls)
+        self._block_size += block_bytes(other)
+        self._maybe_spill()
+        return self
+
+    def _maybe_spill(self):
+        if self._block_size >= self.memory_budget:
+            self._spill()
+
+    def _spill(self):
+        if not self._block.urls:
+            return
+        path = os.path.join(self._temp.name, f"run-{len(self._runs):06d}.bin")
+        write_index(self._block, path)
+        self._runs.append((path, self._block_base))
+        self._new_block()
+
+    @property
+    def run_count(self):
+        return len(self._runs)
+
+    def _run_terms(self, run, data):
+        # (term, run, postings offset, postings length) of one run, in term order
+        _, _, term_count, _, term_dict_offset = read_header(data)
+        for term, offset, length, _ in iter_term_dict(data, term_dict_offset, term_count):
+            yield term, run, offset, length
+
+    def finish(self):
+        # Merges the runs into file_path and returns it opened as a LazyIndex
+        self._spill()
+        files, maps = [], []
+        try:
+            for path, _ in self._runs:
+                files.append(open(path, 'rb'))
+                maps.append(mmap.mmap(files[-1].fileno(), 0, access=mmap.ACCESS_READ))
+            # Runs hold consecutive doc ID ranges, so a term's postings are its run
+            # postings concatenated in run order, rebased onto the run's first doc ID
+            entries = heapq.merge(*(self._run_terms(run, data) for run, data in enumerate(maps)))
+            term, doc_count, body, last_doc = None, 0, bytearray(), 0
+            for entry_term, run, offset, length in entries:
+                if entry_term != term:
+                    if term is not None:
+                        self._writer.add_encoded_term(term, doc_count, body)
+                    term, doc_count, body, last_doc = entry_term, 0, bytearray(), 0
+                count, last_doc = append_postings(maps[run], offset, offset + length, self._runs[run][1],
+                                                  last_doc, body)
+                doc_count += count
+            if term is not None:
+                self._writer.add_encoded_term(term, doc_count, body)
+            self._writer.close()
+        except BaseException:
+            self._writer.discard()
+            raise
+        finally:
+            for data in maps:
+                data.close()
+            for f in files:
+                f.close()
+            self._temp.cleanup()
+        return LazyIndex(self.file_path)
+
+    def discard(self):
+        self._writer.discard()
+        self._temp.cleanup()
@@ -0,0 +1,83 @@
+import re
+from bisect import bisect_left
+from heapq import merge
+
+from fuzzy import FuzzyIndex
+
+# Sorted term dictionary for wildcard lookups. Terms sharing a prefix are
+# adjacent in sorted order, so `prefix*` is a binary search followed by a scan of
+# the matches only; `*suffix` does the same over the reversed terms, which are
+# sorted on first use. A pattern with both ends (`pre*suf`, `a*b*c`) scans the
+# range of its longer literal end and filters it.
+MAX_EXPANSIONS = 64
+WILDCARD = '*'
+
+def is_wildcard(word):
+    return WILDCARD in word
+
+def _range(sorted_terms, prefix):
+    # Yields the terms of sorted_terms starting with prefix, in order
+    for i in range(bisect_left(sorted_terms, prefix), len(sorted_terms)):
+        term = sorted_terms[i]
+        if not term.startswith(prefix):
+            return
+        yield term
+
+class TermDictionary:
+    def __init__(self, sorted_terms):
+        # sorted_terms: every term once, in ascending order (e.g. the term dict
+        # of an index_format file, which is written sorted)
+        self.terms = sorted_terms
+        self._reversed = None
+        self._fuzzy = None
+
+    @classmethod
+    def merged(cls, dictionaries):
+        # Union of several dictionaries, merged without re-sorting
+        terms = []
+        for term in merge(*(dictionary.terms for dictionary in dictionaries)):
+            if not terms or terms[-1] != term:
+                terms.append(term)
+        return cls(terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        i = bisect_left(self.terms, term)
+        return i < len(self.terms) and self.terms[i] == term
+
+    def prefix(self, prefix):
+        return _range(self.terms, prefix)
+
+    def suffix(self, suffix):
+        # Terms ending with suffix, in the order of their reversed spelling
+        if self._reversed is None:
+            self._reversed = sorted(term[::-1] for term in self.terms)
+        return (term[::-1] for term in _range(self._reversed, suffix[::-1]))
+
+    def fuzzy(self):
+        # Trie walk over the terms for typo-tolerant lookups, built on first use
+        if self._fuzzy is None:
+            self._fuzzy = FuzzyIndex(self.terms)
+        return self._fuzzy
+
+    def expand(self, pattern, limit=MAX_EXPANSIONS):
+        # Up to limit terms matching pattern, where '*' stands for any characters,
+        # sorted. Raises ValueError when the pattern has no literal start or end.
+        parts = pattern.split(WILDCARD)
+        head, tail = parts[0], parts[-1]
+        if not head and not tail:
+            raise ValueError(f"Wildcard pattern '{pattern}' needs a literal prefix or suffix")
+        candidates = self.prefix(head) if len(head) >= len(tail) else self.suffix(tail)
+        if len(parts) == 2 and not (head and tail):
+            matches = candidates
+        else:
+            regex = re.compile('.*'.join(map(re.escape, parts)), re.DOTALL)
+            matches = (term for term in candidates if regex.fullmatch(term))
+        expansions = []
+        for term in matches:
+            if len(expansions) == limit:
+                break
+            expansions.append(term)
+        return sorted(expansions)
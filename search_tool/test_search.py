@@ -0,0 +1,779 @@
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+
+from crawler import crawl_website, crawl_pages, Frontier, CrawlMetadata, CrawlJournal
+from extractor import extract
+from fixture_site import generate_site, serve_site, duplicate_source, synthetic_vocabulary
+from index_format import write_index, read_index, encode_varints, decode_varints, LazyIndex
+from inverted_index import InvertedIndex
+from search import (build_index, build_inverted_index, similar_terms, match_phrase, query_terms, phrase_order, word_order,
+                    RESULT_CACHE, search_results, open_segments, stream_build_index)
+from tokenizer import tokenize, term_positions, token_spans, STOP_WORDS
+from positional import phrase_positions, pair_positions, proximity_positions
+from ranking import bm25_top_k, bm25_idf, K1, B
+from query import evaluate_query, parse_query, QuerySyntaxError
+from segments import SegmentedIndex
+from dedupe import DuplicateDetector, filter_duplicates, simhash, hamming
+from docstore import DocStore, DocStoreWriter, encode_document, decode_document, snippet
+from termdict import TermDictionary
+from fuzzy import FuzzyIndex, edit_distance, max_edits
+from server import serve_in_background
+from spimi import SpimiBuilder, block_bytes
+from shards import ShardPool, build_shards, split_index, shard_of
+from result_cache import ResultCache
+from batch import batch_search, run_batch
+from benchmark import run_suite, compare_results, SUITE_QUERIES
+
+def test_concurrent_crawl_matches_serial():
+    site = generate_site(pages=30, fanout=4)
+    with serve_site(site) as base_url:
+        serial = crawl_website(base_url)
+        concurrent = crawl_website(base_url, max_workers=8, max_per_host=4)
+
+    assert len(serial) == len(site), f"Expected {len(site)} pages, but got {len(serial)}"
+    assert sorted(serial) == sorted(concurrent)
+
+def test_streaming_build_matches_crawl_then_build():
+    site = generate_site(pages=30, fanout=4, words_per_page=40)
+    with serve_site(site) as base_url, contextlib.redirect_stdout(io.StringIO()):
+        streamed, page_count = stream_build_index(base_url)
+        built = build_inverted_index(crawl_website(base_url))
+    assert page_count == len(site)
+    assert sorted(streamed.urls) == sorted(built.urls)
+    assert streamed.to_dict() == built.to_dict()
+
+def test_crawl_dispatches_at_most_max_workers_ahead_of_consumer():
+    # Every dispatched fetch is printed, so the log shows how far the crawl runs
+    # ahead of a consumer that is slower than the fetches
+    site = generate_site(pages=30, fanout=4)
+    log, outcomes, ahead, consumed = io.StringIO(), {}, [], 0
+    with serve_site(site) as base_url, contextlib.redirect_stdout(log):
+        for _ in crawl_pages(base_url, max_workers=3, outcomes=outcomes):
+            consumed += 1
+            ahead.append(log.getvalue().count("Crawling URL:") - len(outcomes))
+            time.sleep(0.02)
+    assert consumed == len(site)
+    assert max(ahead) < 3
+
+def test_frontier_deduplicates_at_enqueue():
+    frontier = Frontier('example.com', max_depth=1)
+    assert frontier.push('http://example.com/')
+    assert not frontier.push('http://example.com#top')
+    assert not frontier.push('http://other.com/a')
+    assert not frontier.push('http://example.com/deep', depth=2)
+    assert frontier.push('http://example.com/a', depth=1)
+    assert len(frontier) == 2
+    assert frontier.stats()['duplicates'] == 3
+
+def test_crawl_page_budget():
+    site = generate_site(pages=30, fanout=4)
+    with serve_site(site) as base_url:
+        stats = {}
+        pages = crawl_website(base_url, max_pages=10, stats=stats)
+    assert len(pages) == 10
+    assert stats['popped'] == 10
+
+def test_conditional_recrawl_skips_unchanged_pages():
+    site = generate_site(pages=20, fanout=3)
+    for validators in (True, False):
+        with serve_site(site, validators=validators) as base_url:
+            metadata = CrawlMetadata()
+            assert len(crawl_website(base_url, metadata=metadata)) == len(site)
+            assert metadata.counters['changed'] == len(site)
+
+            metadata = CrawlMetadata(metadata.pages)
+            assert crawl_website(base_url, metadata=metadata) == []
+            skipped = 'not_modified' if validators else 'unchanged'
+            assert metadata.counters[skipped] == len(site)
+            assert metadata.counters['bytes'] == (0 if validators else sum(len(html) for html in site.values()))
+
+            site['/page/5'] = site['/page/5'].replace('</p>', ' courage</p>')
+            metadata = CrawlMetadata(metadata.pages)
+            assert [url for url, _ in crawl_website(base_url, metadata=metadata)] == [base_url + '/page/5']
+            assert metadata.counters['changed'] == 1
+
+def test_rebuild_removes_gone_and_unlinked_pages(tmp_path):
+    site = generate_site(pages=30, words_per_page=100, vocabulary=2000)
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        with serve_site(site) as base_url, contextlib.redirect_stdout(io.StringIO()):
+            segments = build_index(base_url)
+            segments.wait()
+            assert sorted(segments.urls) == sorted(base_url + path.rstrip('/') for path in site)
+            # /page/7 now answers 404 and nothing links to /page/12 any more
+            del site['/page/7']
+            for path, html in site.items():
+                site[path] = html.replace('href="/page/12"', 'href="/page/7"')
+            reachable, queue = set(), ['/']
+            while queue:
+                path = queue.pop()
+                if path in site and path not in reachable:
+                    reachable.add(path)
+                    queue.extend(re.findall(r'href="([^"]+)"', site[path]))
+            assert '/page/12' not in reachable
+            # The open index is built into rather than opened a second time
+            assert build_index(base_url, segments=segments) is segments
+            segments.wait()
+        assert sorted(segments.urls) == sorted(base_url + path.rstrip('/') for path in reachable)
+        assert sorted(SegmentedIndex('segments').urls) == sorted(segments.urls)
+        text = extract(site['/page/3'], base_url)[0]
+        results = search_results(' '.join(text.split()[:2]), segments, 'phrase', k=100, snippets=False)
+        found = {page['url'] for page in results['phrase_results'] + results['word_results']}
+        assert found and not found & {base_url + '/page/7', base_url + '/page/12'}
+    finally:
+        os.chdir(cwd)
+
+def test_interrupted_crawl_resumes_from_journal(tmp_path):
+    site = generate_site(pages=25, fanout=3)
+    path = str(tmp_path / 'crawl.journal')
+    with serve_site(site) as base_url:
+        metadata = CrawlMetadata()
+        first = crawl_website(base_url, max_pages=10, metadata=metadata, journal=CrawlJournal(path, checkpoint_every=3))
+        with open(path, 'a') as f:
+            f.write('{"url": "torn')
+
+        metadata = CrawlMetadata()
+        resumed = crawl_website(base_url, metadata=metadata, journal=CrawlJournal(path))
+    assert len(first) == 10
+    assert resumed[:10] == first
+    assert sorted(url for url, _ in resumed) == sorted(base_url + path.rstrip('/') for path in site)
+    # Only the pages missing from the journal were fetched again
+    assert metadata.counters['fetched'] == len(site) - 10
+    assert len(metadata.pages) == len(site)
+
+def test_extractor_text_and_links():
+    html = ("<html><head><title>Quotes</title><style>p { color: red }</style>"
+            "<script>var a = '<a href=\"/js\">x</a>';</script></head>"
+            "<body><h1>Top&nbsp;ten &amp; more</h1><!-- hidden --><p>wo<b>rd</b>\n  tags</p>"
+            "<a href='/tag/love/'>love</a> <a href='page/2'>next</a> <a href='http://other.com/x'>out</a>"
+            "<a>no href</a><template><p>later</p></template></body></html>")
+    text, links = extract(html, 'http://quotes.com/page/1')
+    assert text == 'Quotes Top ten & more wo rd tags love next out no href'
+    assert links == ['http://quotes.com/tag/love/', 'http://quotes.com/page/page/2']
+
+def test_varint_roundtrip():
+    values = [0, 1, 127, 128, 300, 2 ** 32 + 5]
+    out = bytearray()
+    encode_varints(values, out)
+    assert decode_varints(out) == values
+
+def test_binary_index_roundtrip(tmp_path):
+    index = {
+        'quotes': {'http://a.com': [0, 3, 283], 'http://a.com/login': [0, 3, 9]},
+        'einstein': {'http://a.com/author/einstein': [5, 700, 70000]},
+    }
+    path = str(tmp_path / 'index.bin')
+    write_index(InvertedIndex.from_dict(index), path)
+    assert read_index(path).to_dict() == index
+
+def test_lazy_index_matches_full_read(tmp_path):
+    index = {f'term{i}': {f'http://a.com/{j}': [j, j + i + 1] for j in range(3)} for i in range(10)}
+    path = str(tmp_path / 'index.bin')
+    write_index(InvertedIndex.from_dict(index), path)
+    lazy = LazyIndex(path, cache_size=2)
+    assert len(lazy) == 10 and 'term3' in lazy and 'missing' not in lazy
+    assert {term: {url: list(p) for url, p in lazy.postings(term)} for term in lazy} == index
+    assert len(lazy._cache) == 2
+    lazy.close()
+
+def test_inverted_index_out_of_order_postings():
+    index = InvertedIndex()
+    index.add_postings('life', 'http://a.com/2', [4, 9])
+    index.add_postings('life', 'http://a.com/1', [1])
+    index.add_postings('life', 'http://a.com/2', [12])
+    assert index.document_frequency('life') == 2
+    assert [(url, list(p)) for url, p in index.postings('life')] == [('http://a.com/2', [4, 9, 12]), ('http://a.com/1', [1])]
+
+def test_parallel_build_matches_serial():
+    site = generate_site(pages=40, words_per_page=50)
+    pages = [(path, html) for path, html in site.items()]
+    serial = build_inverted_index(pages)
+    parallel = build_inverted_index(pages, workers=3, chunk_size=7)
+    assert parallel.urls == serial.urls
+    assert parallel.to_dict() == serial.to_dict()
+
+def test_merge_with_existing_urls():
+    first = InvertedIndex.from_dict({'life': {'http://a.com/1': [1]}, 'love': {'http://a.com/2': [2]}})
+    second = InvertedIndex.from_dict({'life': {'http://a.com/2': [5]}, 'hope': {'http://a.com/3': [0]}})
+    first.merge(second)
+    assert first.to_dict() == {
+        'life': {'http://a.com/1': [1], 'http://a.com/2': [5]},
+        'love': {'http://a.com/2': [2]},
+        'hope': {'http://a.com/3': [0]},
+    }
+
+def test_regex_tokenizer_matches_word_tokenize_numbering():
+    # Expected tokens are nltk.word_tokenize output for the same sentences
+    assert tokenize("i don't know, it's 3.14 or $1,000 -- well-known u.s. stuff... (really?)") == [
+        'i', 'do', "n't", 'know', ',', 'it', "'s", '3.14', 'or', '$', '1,000', '--',
+        'well-known', 'u.s.', 'stuff', '...', '(', 'really', '?', ')']
+    assert tokenize("“it cannot be changed without changing our thinking.”") == [
+        '“', 'it', 'can', 'not', 'be', 'changed', 'without', 'changing', 'our', 'thinking', '.', '”']
+    assert list(term_positions("Hello, World!")) == [(0, 'hello'), (2, 'world')]
+
+def test_bundled_stopwords():
+    assert len(STOP_WORDS) == 179
+    assert {'the', 'and', "don't"} <= STOP_WORDS
+
+def test_positional_engine_matches_brute_force():
+    rng = random.Random(1)
+    for _ in range(50):
+        lists = [sorted(rng.sample(range(200), rng.randint(1, 80))) for _ in range(3)]
+        sets = [set(positions) for positions in lists]
+        expected = [p for p in lists[0] if p + 1 in sets[1] and p + 2 in sets[2]]
+        assert phrase_positions(lists) == expected
+        assert pair_positions(lists[0], lists[1]) == [p for p in lists[0] if p + 1 in sets[1]]
+        assert proximity_positions(lists[0], lists[1], 3) == [
+            p for p in lists[0] if any(0 < abs(q - p) <= 3 for q in lists[1])]
+
+def test_bm25_top_k_matches_exhaustive_scoring():
+    rng = random.Random(2)
+    index = InvertedIndex()
+    for d in range(200):
+        words = [f"w{min(int(rng.expovariate(0.3)), 30)}" for _ in range(rng.randint(5, 60))]
+        positions = {}
+        for position, word in enumerate(words):
+            positions.setdefault(word, []).append(position)
+        index.add_document(f"http://a.com/{d}", positions)
+
+    terms = ['w0', 'w3', 'w12', 'w25']
+    avg_length = index.average_doc_length()
+    scores = {}
+    for term in terms:
+        idf = bm25_idf(len(index.urls), index.document_frequency(term))
+        for url, positions in index.postings(term):
+            tf = len(positions)
+            norm = K1 * (1 - B + B * index.doc_lengths[index.doc_ids[url]] / avg_length)
+            scores[url] = scores.get(url, 0) + idf * tf * (K1 + 1) / (tf + norm)
+    expected = sorted(scores.values(), reverse=True)[:10]
+    assert [round(score, 9) for _, score in bm25_top_k(terms, index, k=10)] == [round(score, 9) for score in expected]
+
+def test_boolean_queries_match_brute_force():
+    rng = random.Random(3)
+    index = InvertedIndex()
+    documents = []
+    for d in range(150):
+        words = [rng.choice(['red', 'green', 'blue', 'cat', 'dog', 'fish']) for _ in range(rng.randint(3, 15))]
+        positions = {}
+        for position, word in enumerate(words):
+            positions.setdefault(word, []).append(position)
+        index.add_document(f"http://a.com/{d}", positions)
+        documents.append(words)
+
+    def has_phrase(words, phrase):
+        return any(words[i:i + len(phrase)] == phrase for i in range(len(words)))
+
+    def near(words, a, b, k):
+        return any(x == a and y == b and 0 < abs(i - j) <= k
+                   for i, x in enumerate(words) for j, y in enumerate(words))
+
+    cases = {
+        'red and cat': lambda w: 'red' in w and 'cat' in w,
+        'red cat NOT dog': lambda w: 'red' in w and 'cat' in w and 'dog' not in w,
+        'fish or (blue and not green)': lambda w: 'fish' in w or ('blue' in w and 'green' not in w),
+        'not red': lambda w: 'red' not in w,
+        '"red cat" or "blue dog"': lambda w: has_phrase(w, ['red', 'cat']) or has_phrase(w, ['blue', 'dog']),
+        'cat near/2 dog': lambda w: near(w, 'cat', 'dog', 2),
+        '"red cat" near/1 fish and not green': lambda w: 'green' not in w and any(
+            w[i:i + 2] == ['red', 'cat'] and any(x == 'fish' and 0 < abs(i - j) <= 1 for j, x in enumerate(w))
+            for i in range(len(w))),
+    }
+    for expression, predicate in cases.items():
+        expected = [d for d, words in enumerate(documents) if predicate(words)]
+        assert evaluate_query(expression, index) == expected, expression
+
+def test_query_syntax_errors():
+    for expression in ['', 'red and', '(red or cat', 'red )', 'near/2 cat', '(red or cat) near/2 dog']:
+        try:
+            parse_query(expression)
+        except QuerySyntaxError:
+            continue
+        raise AssertionError(f"{expression!r} should not parse")
+
+def test_segmented_index_updates_deletes_and_merges(tmp_path):
+    rng = random.Random(4)
+    directory = str(tmp_path / 'segments')
+    segments = SegmentedIndex(directory, merge_factor=2)
+    live = {}
+    for build in range(6):
+        batch = InvertedIndex()
+        for url in rng.sample([f"http://a.com/{d}" for d in range(30)], 8):
+            words = [rng.choice(['red', 'green', 'blue', 'cat']) for _ in range(rng.randint(1, 6))]
+            positions = {}
+            for position, word in enumerate(words):
+                positions.setdefault(word, []).append(position)
+            batch.add_document(url, positions)
+            live.pop(url, None)
+            live[url] = positions
+        segments.add_documents(batch, background=build % 2 == 0)
+        segments.wait()
+    deleted = list(live)[:3]
+    segments.delete(deleted)
+    for url in deleted:
+        del live[url]
+
+    def contents(index):
+        return {term: {url: list(positions) for url, positions in index.postings(term)}
+                for term in index if index.postings(term)}
+
+    expected = InvertedIndex()
+    for url, positions in live.items():
+        expected.add_document(url, positions)
+    assert sorted(segments.urls) == sorted(live)
+    assert contents(segments) == contents(expected)
+    assert len(segments.segment_names()) < 6
+    # Merging keeps doc IDs, and reopening from the manifest gives the same view.
+    # Reopening removes files left by a crashed build, but no other files.
+    (tmp_path / 'segments' / 'segment-999999.bin').write_bytes(b'partial')
+    (tmp_path / 'segments' / 'notes.txt').write_text('kept')
+    reopened = SegmentedIndex(directory)
+    assert reopened.urls == segments.urls
+    assert contents(reopened) == contents(segments)
+    assert not (tmp_path / 'segments' / 'segment-999999.bin').exists()
+    assert (tmp_path / 'segments' / 'notes.txt').read_text() == 'kept'
+
+def test_segment_writers_never_share_names_or_files(tmp_path):
+    directory = str(tmp_path / 'segments')
+
+    def page(d):
+        index = InvertedIndex()
+        index.add_document(f"http://a.com/{d}", {'love': [0], f"w{d}": [1]})
+        return index
+
+    first, stale = SegmentedIndex(directory), SegmentedIndex(directory)
+    first.add_documents(page(0), background=False)
+    # A name reserved by one instance is skipped by another opened before it
+    with stale._lock:
+        assert stale._new_segment_name() not in first.segment_names()
+
+    # As the CLI does on load: a background merge finishes before the
+    # directory is reopened and written to
+    for d in range(1, 8):
+        first.add_documents(page(d), background=True)
+    first.wait()
+    reopened = SegmentedIndex(directory)
+    reopened.add_documents(page(8), background=False)
+    reopened.wait()
+    assert sorted(SegmentedIndex(directory).urls) == sorted(f"http://a.com/{d}" for d in range(9))
+
+def test_unloadable_segments_are_cleared_without_other_files(tmp_path):
+    directory = tmp_path / 'segments'
+    index = InvertedIndex()
+    index.add_document('http://a.com/1', {'love': [0]})
+    SegmentedIndex(str(directory)).add_documents(index, background=False)
+    (directory / 'notes.txt').write_text('kept')
+    for name in os.listdir(directory):
+        if name.endswith('.bin'):
+            os.remove(directory / name)
+
+    # The manifest names a segment that is missing
+    with contextlib.redirect_stdout(io.StringIO()):
+        segments, message, success = open_segments(str(directory), str(tmp_path / 'index.bin'))
+    assert not success and message == "Failed to load; initialized new index"
+    assert segments.urls == []
+    assert os.listdir(directory) == ['notes.txt']
+    assert (directory / 'notes.txt').read_text() == 'kept'
+
+def test_document_store_roundtrip_and_snippets(tmp_path):
+    text = "Don't panic: the answer is forty-two, said the computer."
+    spans = [(start, end) for _, start, end in token_spans(text)]
+    assert decode_document(encode_document(text, spans)) == (text, spans)
+
+    writer = DocStoreWriter(str(tmp_path / 'docs'))
+    texts = [f"page {i} " + "word " * i for i in range(20)]
+    for page in texts:
+        writer.add(page, [(start, end) for _, start, end in token_spans(page)])
+    writer.close()
+    store = DocStore(str(tmp_path / 'docs'))
+    assert len(store) == 20
+    for doc_id in (17, 0, 5):
+        assert store.document(doc_id)[0] == texts[doc_id]
+
+    words = [text[start:end].lower() for start, end in spans]
+    answer = words.index('answer')
+    assert snippet(text, spans, [(answer, 1)], width=2) == "...: the [answer] is forty-two..."
+    assert snippet(text, spans, [(answer + 2, 3), (answer + 2, 1)], width=1) == "...is [forty-two, said] the..."
+
+def test_segment_documents_follow_merges(tmp_path):
+    site = generate_site(pages=40, fanout=3, words_per_page=30, seed=9)
+    pages = [(url, ' '.join(word for word in html.split() if word.isalpha()))
+             for url, html in sorted(site.items())]
+    segments = SegmentedIndex(str(tmp_path / 'segments'), merge_factor=2)
+    for start in range(0, len(pages), 10):
+        documents = segments.document_writer()
+        batch = build_inverted_index(pages[start:start + 10], workers=2 if start else 1, chunk_size=3,
+                                     documents=documents)
+        segments.add_documents(batch, background=False, documents=documents)
+    segments.delete([pages[3][0]])
+    assert len(segments.segment_names()) < 4
+    for url, content in pages:
+        document = segments.document(url)
+        if url == pages[3][0]:
+            assert document is None
+            continue
+        text, spans = document
+        assert text == content
+        words = {text[start:end].lower(): None for start, end in spans}
+        for word in words:
+            if word.isalnum():
+                assert url in dict(segments.postings(word))
+
+def test_wildcard_expansion_matches_brute_force(tmp_path):
+    rng = random.Random(6)
+    vocabulary = sorted({''.join(rng.choice('abcde') for _ in range(rng.randint(1, 7))) for _ in range(3000)})
+    dictionary = TermDictionary(vocabulary)
+    for pattern in ('ab*', '*cd', 'a*e', 'b*a*c', 'e*', '*a', 'abcde*', 'zz*'):
+        regex = re.compile(pattern.replace('*', '.*'))
+        expected = [term for term in vocabulary if regex.fullmatch(term)]
+        assert dictionary.expand(pattern, limit=len(vocabulary)) == expected
+        assert len(dictionary.expand(pattern, limit=5)) == min(5, len(expected))
+    try:
+        dictionary.expand('*')
+        raise AssertionError("'*' should not expand")
+    except ValueError:
+        pass
+
+    # Binary, merged-segment and in-memory indexes give the same sorted dictionary
+    index = synthetic_vocabulary_index(vocabulary)
+    write_index(index, str(tmp_path / 'index.bin'))
+    segments = SegmentedIndex(str(tmp_path / 'segments'))
+    segments.add_documents(synthetic_vocabulary_index(vocabulary[::2]), background=False)
+    segments.add_documents(synthetic_vocabulary_index(vocabulary[1::2], 'b'), background=False)
+    assert LazyIndex(str(tmp_path / 'index.bin')).term_dictionary().terms == vocabulary
+    assert segments.term_dictionary().terms == vocabulary
+    assert index.term_dictionary().terms == vocabulary
+
+def test_fuzzy_lookup_matches_brute_force():
+    rng = random.Random(8)
+    vocabulary = sorted({''.join(rng.choice('abcdeo') for _ in range(rng.randint(1, 9))) for _ in range(2000)})
+    fuzzy = FuzzyIndex(vocabulary)
+    for _ in range(40):
+        word = list(rng.choice(vocabulary))
+        i = rng.randrange(len(word))
+        word[i:i + 2] = rng.choice([[], ['x'], word[i:i + 2][::-1], ['a', 'e', 'i']])
+        word = ''.join(word)
+        distances = sorted((edit_distance(word, term), term) for term in vocabulary)
+        for k in (max_edits(word), 1, 2):
+            assert fuzzy.search(word, k) == [(d, term) for d, term in distances if d <= k]
+    assert edit_distance('lvoe', 'love') == 1
+    assert edit_distance('kitten', 'sitting') == 3
+
+    # Lookups visit far fewer trie prefixes than the vocabulary grows by
+    syllables = [c + v for c in 'bcdfghklmnprstvwz' for v in 'aeiou']
+
+    def syllable_words(count):
+        words = set()
+        while len(words) < count:
+            words.add(''.join(rng.choice(syllables) for _ in range(rng.randint(1, 5))))
+        return sorted(words)
+
+    small, large = FuzzyIndex(syllable_words(2000)), FuzzyIndex(syllable_words(32000))
+    visited = {small: 0, large: 0}
+    for _ in range(30):
+        word = list(rng.choice(large.terms))
+        word[rng.randrange(len(word))] = 'x'
+        for fuzzy in visited:
+            stats = {}
+            fuzzy.search(''.join(word), stats=stats)
+            visited[fuzzy] += stats['prefixes']
+    assert visited[large] < 6 * visited[small]
+
+    index = build_inverted_index([('a', 'loving life is lovely'), ('b', 'love the kindness of life'),
+                                  ('c', 'kindred kindness')])
+    assert similar_terms('kindnes', index) == ['kindness']
+    assert similar_terms('lvoe', index) == ['love']
+    assert similar_terms('xyzzy', index) == []
+
+def test_out_of_core_build_matches_in_memory_build(tmp_path):
+    def pages(count=400, words=200):
+        # Generated lazily, so page text is never held for the whole corpus
+        rng = random.Random(3)
+        vocabulary = [f"w{i}" for i in range(2000)]
+        for d in range(count):
+            yield f"http://a.com/{d}", ' '.join(rng.choice(vocabulary) for _ in range(words))
+
+    def contents(index):
+        return {term: [(doc_id, list(positions)) for doc_id, positions in postings]
+                for term, postings in index.terms.items()}
+
+    tracemalloc.start()
+    try:
+        expected = build_inverted_index(pages())
+        in_memory_peak = tracemalloc.get_traced_memory()[1]
+        budget = block_bytes(expected) // 4
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        build_inverted_index(pages(), memory_budget=budget, file_path=str(tmp_path / 'index.bin'))
+        assert tracemalloc.get_traced_memory()[1] - baseline < in_memory_peak / 2
+    finally:
+        tracemalloc.stop()
+
+    for workers in (1, 2):
+        path = str(tmp_path / f"index-{workers}.bin")
+        built = build_inverted_index(pages(), workers=workers, chunk_size=50, memory_budget=budget, file_path=path)
+        index = read_index(path)
+        assert built.urls == expected.urls == index.urls
+        assert list(index.doc_lengths) == list(expected.doc_lengths)
+        assert contents(index) == contents(expected)
+
+    # The corpus is several times the budget, so it was spilled to several runs
+    builder = SpimiBuilder(str(tmp_path / 'runs.bin'), budget)
+    for url, content in pages():
+        builder.add_document(url, {word: [position] for position, word in term_positions(content)})
+    assert builder.run_count >= 4
+    builder.discard()
+
+def test_segment_merge_streams_postings(tmp_path):
+    rng = random.Random(5)
+    vocabulary = [f"w{i}" for i in range(2000)]
+    pages = [(f"http://a.com/{d}", ' '.join(rng.choice(vocabulary) for _ in range(200))) for d in range(400)]
+    segments = SegmentedIndex(str(tmp_path / 'segments'), merge_factor=100)
+    for start in range(0, 400, 100):
+        segments.add_documents(build_inverted_index(pages[start:start + 100]), background=False)
+    # Deletions in two of the inputs, so their postings are renumbered
+    segments.delete(['http://a.com/10', 'http://a.com/250', 'http://a.com/251'])
+    live = [page for page in pages if page[0] not in ('http://a.com/10', 'http://a.com/250', 'http://a.com/251')]
+
+    tracemalloc.start()
+    try:
+        expected = build_inverted_index(live)
+        in_memory_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        segments.merge_factor = 4
+        segments.maybe_merge(background=False)
+        assert tracemalloc.get_traced_memory()[1] - baseline < in_memory_peak / 2
+    finally:
+        tracemalloc.stop()
+
+    assert len(segments.segment_names()) == 1
+    merged = read_index(str(tmp_path / 'segments' / segments.segment_names()[0]))
+    assert merged.urls == expected.urls
+    assert list(merged.doc_lengths) == list(expected.doc_lengths)
+    assert {term: list(postings) for term, postings in merged.terms.items()} == \
+        {term: list(postings) for term, postings in expected.terms.items()}
+
+def test_server_answers_queries_and_swaps_in_new_builds(tmp_path):
+    directory = str(tmp_path / 'segments')
+    segments = SegmentedIndex(directory)
+
+    def add(pages):
+        documents = segments.document_writer()
+        segments.add_documents(build_inverted_index(pages, documents=documents), background=False,
+                               documents=documents)
+
+    def get(base_url, path):
+        try:
+            with urllib.request.urlopen(base_url + path) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as e:
+            return e.code, json.load(e)
+
+    add([('http://a.com/1', 'True love is a true friend'), ('http://a.com/2', 'Love of life')])
+    with serve_in_background(directory, reload_interval=0.05) as base_url:
+        status, body = get(base_url, '/find?q=true+friend')
+        assert status == 200
+        assert [result['url'] for result in body['phrase_results']] == ['http://a.com/1']
+        assert '**true friend**' in body['phrase_results'][0]['snippet']
+        status, body = get(base_url, '/find?q=love&mode=bm25')
+        assert {result['url'] for result in body['results']} == {'http://a.com/1', 'http://a.com/2'}
+        status, body = get(base_url, '/print?word=lov*')
+        assert [term['term'] for term in body['terms']] == ['love']
+        assert get(base_url, '/find?q=(love&mode=bool')[0] == 400
+        assert get(base_url, '/find?q=love&k=0')[0] == 400
+        assert get(base_url, '/find?q=love&k=-1')[0] == 400
+        status, body = get(base_url, '/find?q=love&k=1')
+        assert status == 200 and len(body['phrase_results']) == 1 and body['totals']['phrase_results'] == 2
+        assert get(base_url, '/find?q=love&k=1000000')[0] == 200
+        assert get(base_url, '/nothing')[0] == 404
+
+        # A build in another process is picked up without restarting the server
+        add([('http://a.com/3', 'Hope is the thing with feathers')])
+        deadline = time.time() + 5
+        while get(base_url, '/status')[1]['pages'] < 3 and time.time() < deadline:
+            time.sleep(0.05)
+        status, body = get(base_url, '/find?q=feathers')
+        assert [result['url'] for result in body['phrase_results']] == ['http://a.com/3']
+
+def test_sharded_queries_match_unsharded_index(tmp_path):
+    rng = random.Random(9)
+    vocabulary = sorted({''.join(rng.choice('abcdefg') for _ in range(rng.randint(4, 7))) for _ in range(300)})
+    pages = [(f"http://a.com/{d}", ' '.join(rng.choice(vocabulary) for _ in range(60))) for d in range(150)]
+    segments = SegmentedIndex(str(tmp_path / 'segments'))
+    documents = segments.document_writer()
+    segments.add_documents(build_inverted_index(pages[:100], documents=documents), background=False,
+                           documents=documents, aliases={'http://b.com/0': 'http://a.com/0'})
+    documents = segments.document_writer()
+    segments.add_documents(build_inverted_index(pages[100:], documents=documents), background=False,
+                           documents=documents)
+    directory = str(tmp_path / 'shards')
+    assert split_index(segments, directory, shards=3) == 0
+    # Re-adding pages replaces them within their shard
+    assert sum(build_shards(pages[:10], directory)) == 10
+
+    words = pages[0][1].split()
+    typo = words[3][1:]
+    queries = [f"{words[0]} {words[1]}", f"{words[5]} {words[6]} {words[7]}", f"{words[2][:2]}*", typo]
+    with ShardPool(directory) as pool:
+        assert len(pool) == 3 and pool.doc_count == len(segments.urls)
+        assert pool.dictionary.terms == segments.term_dictionary().terms
+        for query in queries:
+            notes, expected_notes = [], []
+            matches = pool.match_phrase(query, k=5, report=notes.append)
+            expected = match_phrase(query, segments, report=expected_notes.append)
+            assert notes == expected_notes
+            assert matches['terms'] == expected['terms']
+            for name, order in (('phrase', phrase_order), ('individual', word_order)):
+                assert matches['totals'][name] == len(expected[name])
+                # Equal keys may come in another order, but each page has its own data
+                assert [order(item) for item in matches[name]] == [order(item) for item in expected[name][:5]]
+                data = dict(expected[name])
+                assert all(order((url, data[url])) == order((url, result)) for url, result in matches[name])
+
+            terms, ranking = pool.rank(query, k=5, report=notes.append)
+            scores = dict(bm25_top_k(query_terms(query, segments, expected_notes.append), segments, len(pages)))
+            assert terms == query_terms(query, segments, expected_notes.append)
+            assert [score for _, score in ranking] == sorted(scores.values(), reverse=True)[:5]
+            assert all(abs(scores[url] - score) < 1e-9 for url, score in ranking)
+
+        expression = f"{words[0]} or {words[1]} not {words[2]}"
+        assert sorted(pool.match(expression)) == sorted(segments.urls[i] for i in evaluate_query(expression, segments))
+        try:
+            pool.match('love and')
+            raise AssertionError("an incomplete query should not parse")
+        except QuerySyntaxError:
+            pass
+        assert pool.document('http://a.com/7') == segments.document('http://a.com/7')
+        assert pool.aliases_of('http://a.com/0') == ['http://b.com/0']
+    assert {shard_of(url, 3) for url, _ in pages} == {0, 1, 2}
+
+def test_find_results_are_cached_until_the_index_changes(tmp_path):
+    cache = ResultCache(capacity=10)
+    cache.put('a', 1, size=4)
+    cache.put('b', 2, size=4)
+    assert cache.get('a') == 1
+    cache.put('c', 3)  # Over capacity: 'b' is the least recently used
+    assert cache.get('b') is None and cache.get('c') == 3
+    cache.put('d', 4, size=10)  # Larger than the whole cache
+    assert cache.get('d') is None and len(cache) == 2 and cache.cost == 6
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    segments = SegmentedIndex(str(tmp_path / 'segments'))
+    segments.add_documents(build_inverted_index([('http://a.com/1', 'True love is a true friend'),
+                                                 ('http://a.com/2', 'Love of life')]), background=False)
+    RESULT_CACHE.clear()
+    hits, misses = RESULT_CACHE.hits, RESULT_CACHE.misses
+    first = match_phrase('true friend', segments)
+    # The same words after tokenizing and dropping stop words
+    assert match_phrase('True the FRIEND', segments) is first
+    notes = []
+    match_phrase('lvoe', segments, report=notes.append)
+    repeated = []
+    match_phrase('lvoe', segments, report=repeated.append)
+    assert notes == repeated == ["Did you mean 'love'? Searching for lvoe -> love."]
+    assert (RESULT_CACHE.hits - hits, RESULT_CACHE.misses - misses) == (2, 2)
+
+    # A build gives the index a new generation, so nothing stale is served
+    generation = segments.generation
+    segments.add_documents(build_inverted_index([('http://a.com/3', 'a true friend')]), background=False)
+    assert segments.generation != generation
+    assert sorted(url for url, _ in match_phrase('true friend', segments)['phrase']) == ['http://a.com/1', 'http://a.com/3']
+    # Merging leaves the documents, and so the generation, unchanged
+    segments.add_documents(build_inverted_index([('http://a.com/4', 'life')]), background=False)
+    segments.add_documents(build_inverted_index([('http://a.com/5', 'love')]))
+    generation = segments.generation
+    result = match_phrase('life', segments)
+    segments.wait()
+    assert len(segments.segment_names()) == 1
+    assert segments.generation == generation
+    assert match_phrase('life', segments) is result
+
+def test_batch_queries_match_single_queries(tmp_path):
+    rng = random.Random(10)
+    vocabulary = [f"w{i}" for i in range(200)]
+    pages = [(f"http://a.com/{d}", ' '.join(rng.choice(vocabulary) for _ in range(80))) for d in range(60)]
+    # A small postings cache, so concurrent queries keep evicting each other's terms
+    segments = SegmentedIndex(str(tmp_path / 'segments'), cache_size=4)
+    documents = segments.document_writer()
+    segments.add_documents(build_inverted_index(pages, documents=documents), background=False, documents=documents)
+    queries = [' '.join(rng.sample(vocabulary, rng.randint(1, 3))) for _ in range(150)] + ['w1*', 'w1 and', '*']
+
+    def without_timing(results):
+        return [{name: value for name, value in result.items() if name != 'elapsed_ms'} for result in results]
+
+    for mode in ('phrase', 'bm25', 'bool'):
+        RESULT_CACHE.clear()
+        expected = []
+        for query in queries:
+            try:
+                expected.append(search_results(query, segments, mode, 5))
+            except ValueError as e:
+                expected.append({'query': query, 'mode': mode, 'error': str(e)})
+        RESULT_CACHE.clear()
+        assert without_timing(batch_search(queries, segments, mode, 5, workers=4)) == expected
+        assert without_timing(batch_search(queries, segments, mode, 5, workers=2, processes=True)) == expected
+
+    output = io.StringIO()
+    stats = run_batch(['# queries', '', 'w1 w2', 'w3'], output, segments, workers=2)
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [line['query'] for line in lines] == ['w1 w2', 'w3']
+    assert stats['queries'] == 2 and stats['errors'] == 0 and stats['qps'] > 0
+
+def synthetic_vocabulary_index(terms, prefix='a'):
+    index = InvertedIndex()
+    for i in range(0, len(terms), 100):
+        index.add_document(f"http://{prefix}.com/{i}", {term: [j] for j, term in enumerate(terms[i:i + 100])})
+    return index
+
+def test_near_duplicate_pages_are_aliased(tmp_path):
+    site = generate_site(pages=60, words_per_page=1000, duplicates=15)
+    paths = list(site)
+    pages = [(path, extract(html, 'http://a.com' + path)[0]) for path, html in site.items()]
+    duplicates = {}
+    kept = [url for url, _ in filter_duplicates(pages, DuplicateDetector(0.9), duplicates)]
+    # Every detected page is a generated duplicate of the right page, and nearly all are found
+    expected = {paths[i]: paths[duplicate_source(i, 45)] for i in range(45, 60)}
+    assert duplicates.items() <= expected.items()
+    assert len(duplicates) >= 12
+    assert kept == [path for path in paths if path not in duplicates]
+    assert hamming(simhash('a b c d e'.split()), simhash('a b c d e'.split())) == 0
+
+    segments = SegmentedIndex(str(tmp_path / 'segments'))
+    segments.add_documents(build_inverted_index(pages[:45]), aliases=duplicates, background=False)
+    reopened = SegmentedIndex(str(tmp_path / 'segments'))
+    assert sorted(reopened.aliases_of(paths[0])) == sorted(url for url, canonical in duplicates.items() if canonical == paths[0])
+
+def test_benchmark_suite_results_are_comparable():
+    vocabulary = synthetic_vocabulary(500)
+    assert len(set(vocabulary)) == 500 and vocabulary[:3] == ['life', 'love', 'world']
+    assert generate_site(pages=5, vocabulary=500) == generate_site(pages=5, vocabulary=500)
+
+    results = run_suite(pages=20, words_per_page=100, vocabulary=500, repeat=1, query_repeat=2)
+    results = json.loads(json.dumps(results))
+    assert results['counts']['pages'] == 20
+    stages = ['crawl', 'tokenize', 'build', 'save.binary', 'load.binary', 'save.json', 'load.json']
+    assert set(stages + [f'query.{shape}' for shape in SUITE_QUERIES]) <= set(results['timings'])
+    assert all(timing['median'] >= timing['min'] > 0 for timing in results['timings'].values())
+    assert compare_results(results, results) == []
+
+    # A stage twice as fast before is a regression; jitter below the noise floor is not
+    previous = json.loads(json.dumps(results))
+    previous['timings']['build']['median'] /= 2
+    previous['timings']['query.word']['median'] = 10e-6
+    results['timings']['query.word']['median'] = 30e-6
+    assert [stage for stage, _, _ in compare_results(previous, results)] == ['build']
+    previous['site']['pages'] = 40
+    try:
+        compare_results(previous, results)
+        assert False, "compared runs over different sites"
+    except ValueError:
+        pass
@@ -0,0 +1,96 @@
+import re
+
+# NLTK's English stopword list, bundled so nothing has to be downloaded at runtime
+STOP_WORDS = frozenset("""
+i me my myself we our ours ourselves you you're you've you'll you'd your yours yourself
+yourselves he him his himself she she's her hers herself it it's its itself they them their
+theirs themselves what which who whom this that that'll these those am is are was were be
+been being have has had having do does did doing a an the and but if or because as until
+while of at by for with about against between into through during before after above below
+to from up down in out on off over under again further then once here there when where why
+how all any both each few more most other some such no nor not only own same so than too
+very s t can will just don don't should should've now d ll m o re ve y ain aren aren't
+couldn couldn't didn didn't doesn doesn't hadn hadn't hasn hasn't haven haven't isn isn't ma
+mightn mightn't mustn mustn't needn needn't shan shan't shouldn shouldn't wasn wasn't weren
+weren't won won't wouldn wouldn't
+""".split())
+
+# Approximates nltk.word_tokenize (Punkt sentences + Treebank rules) closely enough
+# that every token gets the same position: contractions and clitics are split off,
+# sentence-final periods and the Treebank punctuation set are tokens of their own,
+# and anything else joined to a word (hyphens, slashes, internal periods,
+# apostrophes, digit-grouping commas) stays part of it. Plain words followed by
+# a space, comma or sentence end take the cheap second branch.
+_SPLIT = r"""\s;@#$%&?!\[\](){}<>*"“”‘’«»—–,:.'`"""
+_CORE = rf"(?:[^{_SPLIT}-]|-(?!-))+"
+TOKEN_PATTERN = re.compile(rf"""
+      (?:mr|mrs|ms|dr|jr|sr|st|vs)\.(?=\s)
+    | (?!(?:cannot|gonna|gotta|gimme|lemme|wanna)\b)[^\W_]+(?=\s|,(?!\d)|\.?$|\.\s)
+    | (?:{_CORE}\.){{2,}}(?![^\s,;:!?)\]}}"”’'])
+    | \b(?:can(?=not\b)|gon(?=na\b)|got(?=ta\b)|gim(?=me\b)|lem(?=me\b)|wan(?=na\b))
+    | \w+(?=n't\b)
+    | n't\b
+    | '(?:s|m|d|ll|re|ve)\b
+    | {_CORE}(?:\.{_CORE}|,(?=\d){_CORE}|(?<=\d):(?=\d){_CORE}|'(?!(?:s|m|d|ll|re|ve)\b){_CORE})*
+    | \.\.\.
+    | --
+    | \S
+""", re.VERBOSE | re.IGNORECASE)
+
+DEFAULT_BACKEND = 'regex'
+
+_nltk_word_tokenize = None
+
+def _nltk_tokenize(text):
+    # NLTK is optional: imported, and its Punkt model fetched, only on first use
+    global _nltk_word_tokenize
+    if _nltk_word_tokenize is None:
+        import nltk
+        from nltk.tokenize import word_tokenize
+        try:
+            word_tokenize("Probe.")
+        except LookupError:
+            # NLTK 3.9 and later load the punkt_tab model, earlier versions punkt
+            nltk.download('punkt_tab', quiet=True)
+            nltk.download('punkt', quiet=True)
+            try:
+                word_tokenize("Probe.")
+            except LookupError as e:
+                raise LookupError("NLTK's Punkt model is missing and could not be downloaded; install it "
+                                  "with nltk.download('punkt_tab') or use the 'regex' tokenizer") from e
+        _nltk_word_tokenize = word_tokenize
+    return _nltk_word_tokenize(text)
+
+def tokenize(text, backend=DEFAULT_BACKEND):
+    if backend == 'regex':
+        return TOKEN_PATTERN.findall(text)
+    if backend == 'nltk':
+        return _nltk_tokenize(text)
+    raise ValueError(f"Unknown tokenizer backend '{backend}'")
+
+def term_positions(text, backend=DEFAULT_BACKEND):
+    # Yields (position, term) for the alphanumeric tokens of lowercased text; the
+    # position counts every token, punctuation included
+    for position, token in enumerate(tokenize(text.lower(), backend)):
+        if token.isalnum():
+            yield position, token
+
+def token_spans(text, backend=DEFAULT_BACKEND):
+    # Yields (token, start, end) for every token of text.lower(), numbered like
+    # term_positions; offsets index the lowercased text, which only differs in
+    # length from text for a few characters (e.g. 'İ')
+    lowered = text.lower()
+    if backend == 'regex':
+        for match in TOKEN_PATTERN.finditer(lowered):
+            yield match.group(), match.start(), match.end()
+        return
+    # word_tokenize rewrites some tokens (e.g. quotes), which then get an empty
+    # span where the search for them stopped
+    pos = 0
+    for token in tokenize(lowered, backend):
+        start = lowered.find(token, pos)
+        if start < 0:
+            yield token, pos, pos
+        else:
+            pos = start + len(token)
+            yield token, start, pos